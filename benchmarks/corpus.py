@@ -0,0 +1,98 @@
+"""Synthetic corpus of PDF papers with matching Zotero export
+
+Creates `<workspace>/resources/papers_raw` with PDFs spread over nested
+folders and named the way Zotero exports them, and `<workspace>/Thesis.json`
+with an item for every PDF, so every stage of the pipeline can run on it
+
+Usage:
+    python benchmarks/corpus.py <workspace> [--papers 50] [--pages 20]
+"""
+
+import argparse
+import json
+import os
+import random
+
+SURNAMES = "Smith Doe Lee Garcia Kim Novak Tanaka Muller Rossi Silva Ivanov Okafor".split()
+TOPICS = "blockchain games tokenomics incentives markets players economies rewards NFT governance".split()
+WORDS = (
+    "the a of and in to is that for on with as by this we are model game token player "
+    "market value reward design agent economy protocol chain ledger incentive result"
+).split()
+
+LINES_PER_PAGE = 45
+WORDS_PER_LINE = 14
+
+
+def _title(rng: random.Random, n: int) -> str:
+    return f"{rng.choice(TOPICS).capitalize()} {' '.join(rng.sample(TOPICS, 3))} study {n}"
+
+
+def _page_text(rng: random.Random, title: str, page: int) -> str:
+    lines = [title, ""]
+    if page == 0:
+        lines += ["Abstract", ""]
+    elif page % 5 == 0:
+        lines += [f"{page // 5}. Section {page // 5}", ""]
+    for _ in range(LINES_PER_PAGE):
+        lines.append(" ".join(rng.choice(WORDS) for _ in range(WORDS_PER_LINE)))
+    lines += ["", str(page + 1)]
+    return "\n".join(lines)
+
+
+def generate_corpus(workspace: str, papers: int, pages: int, seed: int = 0, nesting: int = 3) -> list[dict]:
+    """Writes the corpus and returns Zotero items of all the papers"""
+    import pymupdf
+
+    rng = random.Random(seed)
+    raw_folder = os.path.join(workspace, "resources", "papers_raw")
+    os.makedirs(raw_folder, exist_ok=True)
+
+    items = []
+    for n in range(papers):
+        title = _title(rng, n)
+        year = rng.randint(2000, 2025)
+        authors = [{"family": s} for s in rng.sample(SURNAMES, rng.randint(1, 3))]
+        item = {
+            "id": f"{authors[0]['family'].lower()}{title.split()[0].lower()}{year}_{n}",
+            "title": title,
+            "author": authors,
+            "issued": {"date-parts": [[year]]},
+        }
+        items.append(item)
+
+        if len(authors) == 1:
+            author_part = authors[0]["family"]
+        elif len(authors) == 2:
+            author_part = f"{authors[0]['family']} and {authors[1]['family']}"
+        else:
+            author_part = f"{authors[0]['family']} et al."
+
+        folder = os.path.join(raw_folder, *[f"collection_{n % (d + 2)}" for d in range(n % (nesting + 1))])
+        os.makedirs(folder, exist_ok=True)
+
+        document = pymupdf.open()
+        for page in range(pages):
+            document.new_page().insert_text((50, 50), _page_text(rng, title, page), fontsize=8)
+        document.save(os.path.join(folder, f"{author_part} - {year} - {title}.pdf"))
+        document.close()
+
+    with open(os.path.join(workspace, "Thesis.json"), "w") as f:
+        json.dump(items, f, indent=4)
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic PDF corpus")
+    parser.add_argument("workspace")
+    parser.add_argument("--papers", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    items = generate_corpus(args.workspace, args.papers, args.pages, args.seed)
+    print(f"Generated {len(items)} papers in {args.workspace}")
+
+
+if __name__ == "__main__":
+    main()
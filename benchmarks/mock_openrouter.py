@@ -0,0 +1,293 @@
+"""Local stand-in for open router `/chat/completions` endpoint
+
+Answers with synthetic notes in the format the prompts ask for, either as a
+single JSON response or as server-sent events. Latency is drawn from a
+log-normal distribution and 429/5xx errors are injected with given rates, so
+the whole pipeline can be benchmarked without spending API credits
+
+Usage:
+    python benchmarks/mock_openrouter.py --port 8089 --latency-median 2 --rate-429 0.05
+
+and set OPENROUTER_URL = "http://127.0.0.1:8089" in config
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+
+
+@dataclass
+class MockSettings:
+    # Time to first token, log-normal with this median and sigma
+    latency_median: float = 0.5
+    latency_sigma: float = 0.5
+    # Speed of generating output
+    tokens_per_second: float = 2000
+    # Share of requests answered with 429 and 500
+    rate_429: float = 0.0
+    rate_5xx: float = 0.0
+    # Retry-After header sent with 429
+    retry_after: float = 1.0
+    notes_per_response: int = 5
+    words_per_note: int = 120
+    # Share of prompt tokens reported as cached
+    cached_share: float = 0.0
+    seed: int | None = None
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    streamed: int = 0
+    errors_429: int = 0
+    errors_5xx: int = 0
+    latencies: list[float] = field(default_factory=list)
+
+
+WORDS = "token game player chain ledger market incentive design economy reward protocol agent".split()
+
+# Header of every paper in a packed request
+PACKED_PAPER = re.compile(r"^=== PAPER (\d+) ===$", re.MULTILINE)
+
+
+class MockServer:
+    """Minimal HTTP/1.1 server with keep-alive, running in its own thread"""
+
+    def __init__(self, settings: MockSettings | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.settings = settings or MockSettings()
+        self.stats = MockStats()
+        self.host = host
+        self.port = port
+        self.random = random.Random(self.settings.seed)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._server: asyncio.Server | None = None
+        self._thread: threading.Thread | None = None
+        self._note_counter = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    ################ Lifecycle ############################################
+
+    def start(self) -> "MockServer":
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None or self._server is None:
+            return
+
+        async def close():
+            self._server.close()
+            # Handlers of cancelled requests may still be sleeping
+            handlers = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    ################ HTTP #################################################
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self._handle_request(body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status: str, body: bytes, content_type: str, extra_headers: dict | None = None):
+        headers = {
+            "Content-Type": content_type,
+            "Content-Length": str(len(body)),
+            **(extra_headers or {}),
+        }
+        head = f"HTTP/1.1 {status}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def _handle_request(self, body: bytes, writer: asyncio.StreamWriter):
+        self.stats.requests += 1
+        start = time.perf_counter()
+        request = json.loads(body)
+        settings = self.settings
+
+        await asyncio.sleep(self.random.lognormvariate(0, settings.latency_sigma) * settings.latency_median)
+
+        roll = self.random.random()
+        if roll < settings.rate_429:
+            self.stats.errors_429 += 1
+            await self._respond(
+                writer, "429 Too Many Requests", b'{"error": "rate limited"}', "application/json",
+                {"Retry-After": str(settings.retry_after)},
+            )
+            return
+        if roll < settings.rate_429 + settings.rate_5xx:
+            self.stats.errors_5xx += 1
+            await self._respond(writer, "502 Bad Gateway", b'{"error": "upstream"}', "application/json")
+            return
+
+        content = self._notes(self._packed_papers(request))
+        usage = self._usage(request, content)
+
+        if request.get("stream"):
+            self.stats.streamed += 1
+            await self._stream(writer, content, usage)
+        else:
+            await asyncio.sleep(len(content.split()) / settings.tokens_per_second)
+            response = {"choices": [{"message": {"role": "assistant", "content": content}}], "usage": usage}
+            await self._respond(writer, "200 OK", json.dumps(response).encode(), "application/json")
+        self.stats.latencies.append(time.perf_counter() - start)
+
+    async def _stream(self, writer: asyncio.StreamWriter, content: str, usage: dict):
+        head = (
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/event-stream\r\n"
+            "Transfer-Encoding: chunked\r\n\r\n"
+        )
+        writer.write(head.encode())
+
+        async def send(data: str):
+            payload = data.encode()
+            writer.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            await writer.drain()
+
+        await send(": OPENROUTER PROCESSING\n\n")
+        words = content.split(" ")
+        step = 20
+        for i in range(0, len(words), step):
+            piece = " ".join(words[i : i + step]) + (" " if i + step < len(words) else "")
+            await asyncio.sleep(step / self.settings.tokens_per_second)
+            await send("data: " + json.dumps({"choices": [{"delta": {"content": piece}}]}) + "\n\n")
+        await send("data: " + json.dumps({"choices": [], "usage": usage}) + "\n\n")
+        await send("data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    ################ Content ##############################################
+
+    def _packed_papers(self, request: dict) -> int:
+        """Number of papers in a packed request, 0 for a single paper"""
+        content = request.get("messages", [{}])[-1].get("content") or ""
+        if not isinstance(content, str):
+            return 0
+        return len(PACKED_PAPER.findall(content))
+
+    def _section(self) -> str:
+        notes = []
+        for _ in range(self.settings.notes_per_response):
+            self._note_counter += 1
+            body = " ".join(self.random.choice(WORDS) for _ in range(self.settings.words_per_note))
+            notes.append(
+                f"# Synthetic idea {self._note_counter}\n\n> gist of the idea\n\n## Body\n\n{body}\n\n## Quote\n\n> quote"
+            )
+        return "---\n" + "\n---\n".join(notes) + "\n---\n"
+
+    def _notes(self, packed_papers: int = 0) -> str:
+        if packed_papers == 0:
+            return "<thinking>mock</thinking>\n" + self._section()
+        return "<thinking>mock</thinking>\n" + "".join(
+            f"=== NOTES {i + 1} ===\n" + self._section() for i in range(packed_papers)
+        )
+
+    def _usage(self, request: dict, content: str) -> dict:
+        prompt_chars = 0
+        for m in request.get("messages", []):
+            c = m.get("content")
+            if isinstance(c, list):
+                prompt_chars += sum(len(p.get("text", "")) for p in c)
+            else:
+                prompt_chars += len(c or "")
+        prompt_tokens = prompt_chars // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "prompt_tokens_details": {"cached_tokens": int(prompt_tokens * self.settings.cached_share)},
+        }
+
+
+def settings_arguments(parser: argparse.ArgumentParser):
+    defaults = MockSettings()
+    parser.add_argument("--latency-median", type=float, default=defaults.latency_median)
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma)
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429)
+    parser.add_argument("--rate-5xx", type=float, default=defaults.rate_5xx)
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+    parser.add_argument("--notes-per-response", type=int, default=defaults.notes_per_response)
+    parser.add_argument("--cached-share", type=float, default=defaults.cached_share)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def settings_from(args) -> MockSettings:
+    return MockSettings(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        retry_after=args.retry_after,
+        notes_per_response=args.notes_per_response,
+        cached_share=args.cached_share,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock open router server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    settings_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockServer(settings_from(args), args.host, args.port).start()
+    print(f"Listening on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
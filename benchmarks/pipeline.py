@@ -0,0 +1,233 @@
+"""End-to-end throughput benchmark of the pipeline
+
+Generates a synthetic corpus in a temporary workspace, starts the mock open
+router server and runs every stage one after another (flatten, resolve,
+extract, tokenize, notes), then the whole overlapped pipeline once more from
+scratch. Reports time of every stage, papers per minute and p50/p95 time it
+took to create notes of a paper as JSON
+
+Usage:
+    python benchmarks/pipeline.py [--papers 50] [--pages 20] [--rate-429 0.05] [--output report.json]
+
+`--whitespace-tokenizer` counts words instead of loading TOKENIZER_MODEL, for
+machines without transformers or the model downloaded
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+from corpus import generate_corpus
+from mock_openrouter import MockServer, settings_arguments, settings_from
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+class WhitespaceTokenizer:
+    """Just enough of the transformers tokenizer interface for the pipeline"""
+
+    def __init__(self, folder: str | None = None):
+        pass
+
+    def encode(self, text, add_special_tokens=False):
+        return text.split()
+
+    def num_special_tokens_to_add(self):
+        return 0
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {"input_ids": [t.split() for t in texts]}
+
+    def decode(self, ids):
+        return " ".join(ids)
+
+
+def percentile(values: list[float], p: int) -> float | None:
+    if len(values) == 0:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def rounded(value: float | None) -> float | None:
+    return None if value is None else round(value, 3)
+
+
+def timed(function, *args, quiet: bool = True):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w") if quiet else sys.stdout):
+        result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def notes_durations(manifest) -> list[float]:
+    """Seconds it took to create notes of every paper that has them"""
+    from common.manifest import Status
+
+    rows = manifest.connection.execute(
+        "SELECT notes_seconds FROM papers WHERE notes_status = ? AND notes_seconds IS NOT NULL",
+        (Status.DONE.value,),
+    )
+    return [r["notes_seconds"] for r in rows]
+
+
+def notes_report(manifest, seconds: float) -> dict:
+    durations = notes_durations(manifest)
+    return {
+        "seconds": rounded(seconds),
+        "papers": len(durations),
+        "papers_per_minute": rounded(len(durations) / seconds * 60) if seconds > 0 else None,
+        "p50_paper_seconds": rounded(percentile(durations, 50)),
+        "p95_paper_seconds": rounded(percentile(durations, 95)),
+    }
+
+
+def reset_workspace(workspace: str):
+    """Removes everything the pipeline produced, keeps raw PDFs and Zotero export"""
+    resources = os.path.join(workspace, "resources")
+    for f in os.listdir(resources):
+        if f == "papers_raw":
+            continue
+        path = os.path.join(resources, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def run(args, workspace: str, server: MockServer) -> dict:
+    sys.path.insert(0, SRC_FOLDER)
+    os.chdir(workspace)
+
+    import common.extraction
+    import common.model
+    import common.tokenizer
+    import the_thing
+    from common.config import EXTRACTED_TEXT_FOLDER, TOKENIZER_FOLDER
+
+    # Real key never leaves the machine, mock server accepts anything
+    common.model.OPENROUTER_URL = server.url
+    common.model.OPENROUTER_API_KEY = "mock"
+    if args.whitespace_tokenizer:
+        common.tokenizer.load_tokenizer = WhitespaceTokenizer
+        common.extraction.load_tokenizer = WhitespaceTokenizer
+        common.tokenizer.tokenizer_snapshot = lambda: TOKENIZER_FOLDER
+        common.extraction.tokenizer_snapshot = lambda: TOKENIZER_FOLDER
+
+    stage_args = Namespace(all=True, link="auto", jobs=args.jobs, no_cache=True, refresh=False, retry_failed=False)
+    quiet = not args.verbose
+    report = {}
+
+    ################ Stages one by one #####################################
+    _, seconds = timed(the_thing.stage_flatten, stage_args, quiet=quiet)
+    report["flatten"] = {"seconds": rounded(seconds)}
+
+    reference_key_map, seconds = timed(the_thing.stage_resolve, stage_args, quiet=quiet)
+    if reference_key_map is None:
+        raise RuntimeError("Not all the PDFs were resolved to reference keys")
+    report["resolve"] = {"seconds": rounded(seconds), "resolved": len(reference_key_map)}
+
+    _, seconds = timed(the_thing.stage_extract, stage_args, reference_key_map, quiet=quiet)
+    report["extract"] = {
+        "seconds": rounded(seconds),
+        "papers_per_minute": rounded(len(reference_key_map) / seconds * 60),
+    }
+
+    tokenizer, load_seconds = timed(common.tokenizer.load_tokenizer)
+    texts = []
+    for reference_key in reference_key_map.values():
+        with open(os.path.join(EXTRACTED_TEXT_FOLDER, reference_key + ".txt"), encoding="utf-8") as f:
+            texts.append(f.read())
+    encoded, seconds = timed(lambda: tokenizer(texts, add_special_tokens=False)["input_ids"])
+    tokens = sum(len(ids) for ids in encoded)
+    report["tokenize"] = {
+        "load_seconds": rounded(load_seconds),
+        "seconds": rounded(seconds),
+        "tokens": tokens,
+        "tokens_per_second": rounded(tokens / seconds) if seconds > 0 else None,
+    }
+
+    _, seconds = timed(the_thing.stage_notes, stage_args, quiet=quiet)
+    manifest = the_thing.open_manifest()
+    report["notes"] = notes_report(manifest, seconds)
+    manifest.close()
+
+    ################ Whole pipeline with overlapped stages #################
+    if not args.skip_pipeline:
+        reset_workspace(workspace)
+        _, seconds = timed(the_thing.run_all, stage_args, quiet=quiet)
+        manifest = the_thing.open_manifest()
+        report["pipeline"] = notes_report(manifest, seconds)
+        manifest.close()
+
+    # Stage timers, request latencies and retries of both runs together
+    report["metrics"] = the_thing.metrics.report()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end pipeline throughput benchmark")
+    parser.add_argument("--papers", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--jobs", type=int, default=None, help="Extraction processes")
+    parser.add_argument("--workspace", default=None, help="Folder for the corpus (default: temporary)")
+    parser.add_argument("--whitespace-tokenizer", action="store_true")
+    parser.add_argument("--skip-pipeline", action="store_true", help="Only run stages one by one")
+    parser.add_argument("--output", default=None, help="Also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show output of the stages")
+    settings_arguments(parser)
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workspace = os.path.abspath(args.workspace) if args.workspace else tempfile.mkdtemp(prefix="pipeline-bench-")
+    cwd = os.getcwd()
+
+    start = time.perf_counter()
+    generate_corpus(workspace, args.papers, args.pages, seed=args.seed or 0)
+    corpus_seconds = time.perf_counter() - start
+
+    settings = settings_from(args)
+    with MockServer(settings) as server:
+        try:
+            stages = run(args, workspace, server)
+        finally:
+            os.chdir(cwd)
+            if args.workspace is None:
+                shutil.rmtree(workspace, ignore_errors=True)
+
+    latencies = server.stats.latencies
+    report = {
+        "corpus": {
+            "papers": args.papers,
+            "pages_per_paper": args.pages,
+            "generation_seconds": rounded(corpus_seconds),
+        },
+        "mock": {
+            "settings": vars(settings),
+            "requests": server.stats.requests,
+            "streamed": server.stats.streamed,
+            "errors_429": server.stats.errors_429,
+            "errors_5xx": server.stats.errors_5xx,
+            "p50_request_seconds": rounded(percentile(latencies, 50)),
+            "p95_request_seconds": rounded(percentile(latencies, 95)),
+        },
+        "stages": stages,
+    }
+
+    text = json.dumps(report, indent=4)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Startup time benchmark of the CLI
+
+Runs every stage's `--help` (parsing arguments imports all the modules that
+the stage imports at load time) in a fresh interpreter several times and
+reports median time as JSON. Fails if `notes` or `status` import heavy
+modules or if any stage starts slower than the allowed budget
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--budget 1.0]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+STAGES = ["flatten", "resolve", "extract", "notes", "status"]
+
+# Stages that must never load these modules
+LIGHT_STAGES = ["notes", "status"]
+HEAVY_MODULES = ["torch", "transformers"]
+
+# Imports the CLI, parses arguments of a stage without running it and prints
+# heavy modules that got loaded along the way
+PROBE = """
+import sys
+sys.argv = ["the_thing.py", {stage!r}, "--help"]
+import the_thing
+try:
+    the_thing.main()
+except SystemExit:
+    pass
+print("{marker}" + ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+MARKER = "HEAVY_MODULES="
+
+
+def measure(stage: str) -> tuple[float, list[str]]:
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(stage=stage, heavy=HEAVY_MODULES, marker=MARKER)],
+        cwd=SRC_FOLDER,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+    probe_line = next(l for l in result.stdout.splitlines() if l.startswith(MARKER))
+    loaded = [m for m in probe_line[len(MARKER):].split(",") if m]
+    return elapsed, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI startup time benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.0, help="Max median startup seconds")
+    args = parser.parse_args()
+
+    report = {}
+    failures = []
+    for stage in STAGES:
+        timings = []
+        loaded: list[str] = []
+        for _ in range(args.runs):
+            elapsed, loaded = measure(stage)
+            timings.append(elapsed)
+        median = statistics.median(timings)
+        report[stage] = {"median_seconds": round(median, 4), "heavy_modules": loaded}
+
+        if stage in LIGHT_STAGES and len(loaded) > 0:
+            failures.append(f"{stage} imports {', '.join(loaded)}")
+        if median > args.budget:
+            failures.append(f"{stage} starts in {median:.2f}s, budget is {args.budget}s")
+
+    print(json.dumps({"startup": report, "failures": failures}, indent=4))
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+from common import prompts
+from common.config import PROMPT_CACHE_BREAKPOINT
+from common.model import Message, Model, Request, Role
+
+
+def assemble(model: Model, instructions: str, content: str) -> Request:
+    """Builds request out of static prefix and per-request content
+
+    Prefix is the system prompt plus `instructions`, it is byte-identical for
+    all the requests with the same instructions, so providers can reuse it
+    from their prompt cache. Everything specific to a paper goes into the
+    last message
+    """
+    return Request(
+        model=model,
+        messages=[
+            Message(Role.SYSTEM, prompts.system_prompt()),
+            Message(Role.USER, instructions, cache_breakpoint=PROMPT_CACHE_BREAKPOINT),
+            Message(Role.USER, content),
+        ],
+    )
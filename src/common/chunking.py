@@ -0,0 +1,81 @@
+import re
+
+# Lines that usually start a new section in papers and books: "2.1 Method",
+# "IV. Results", "Chapter 3", "References" and so on
+SECTION_HEADING = re.compile(
+    r"^\s*(\d+(\.\d+)*\.?\s+[A-Z]|[IVXLC]+\.\s+[A-Z]|(chapter|part|appendix)\b|(abstract|introduction|conclusions?|references|bibliography)\s*$)",
+    re.IGNORECASE,
+)
+
+# Headings are short, longer lines matching the pattern are usually just text
+MAX_HEADING_LENGTH = 80
+
+
+def _is_heading(line: str) -> bool:
+    return len(line.strip()) <= MAX_HEADING_LENGTH and SECTION_HEADING.match(line) is not None
+
+
+def _sections(text: str) -> list[str]:
+    sections: list[list[str]] = [[]]
+    for line in text.splitlines(keepends=True):
+        if _is_heading(line) and len(sections[-1]) > 0:
+            sections.append([])
+        sections[-1].append(line)
+    return ["".join(s) for s in sections if len(s) > 0]
+
+
+def _token_counts(texts: list[str], tokenizer) -> list[int]:
+    if len(texts) == 0:
+        return []
+    encoded = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    return [len(ids) for ids in encoded]
+
+
+def _split_by_tokens(text: str, tokenizer, max_tokens: int) -> list[str]:
+    ids = tokenizer.encode(text, add_special_tokens=False)
+    return [
+        tokenizer.decode(ids[i : i + max_tokens])
+        for i in range(0, len(ids), max_tokens)
+    ]
+
+
+def _pieces(section: str, tokens: int, tokenizer, max_tokens: int) -> list[tuple[str, int]]:
+    """Breaks a section that doesn't fit into a window into line groups, and a
+    line that doesn't fit into raw token slices
+    """
+    if tokens <= max_tokens:
+        return [(section, tokens)]
+    lines = section.splitlines(keepends=True)
+    pieces = []
+    for line, line_tokens in zip(lines, _token_counts(lines, tokenizer)):
+        if line_tokens <= max_tokens:
+            pieces.append((line, line_tokens))
+        else:
+            for part in _split_by_tokens(line, tokenizer, max_tokens):
+                pieces.append((part, max_tokens))
+    return pieces
+
+
+def split_into_chunks(text: str, tokenizer, max_tokens: int) -> list[str]:
+    """Splits text into windows of at most `max_tokens` tokens
+
+    Windows are filled with whole sections where possible, a section is only
+    cut when it alone doesn't fit into a window
+    """
+    sections = _sections(text)
+    pieces: list[tuple[str, int]] = []
+    for section, tokens in zip(sections, _token_counts(sections, tokenizer)):
+        pieces.extend(_pieces(section, tokens, tokenizer, max_tokens))
+
+    chunks: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    for piece, tokens in pieces:
+        if current_tokens + tokens > max_tokens and len(current) > 0:
+            chunks.append("".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if len(current) > 0:
+        chunks.append("".join(current))
+    return chunks
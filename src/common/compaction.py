@@ -0,0 +1,138 @@
+import re
+from collections import Counter
+
+from common.config import (COMPACT_EDGE_LINES, COMPACT_REPEATED_LINE_SHARE, COMPACT_STRIP_APPENDICES,
+                           COMPACT_STRIP_REFERENCES)
+
+# Running headers are only told apart from text when there are enough pages
+MIN_PAGES_FOR_HEADERS = 4
+
+# Headings in the first half of a document are more likely part of a table
+# of contents than the start of the bibliography
+SECTIONS_MIN_POSITION = 0.5
+
+# Headings are short, longer lines matching the patterns are usually just text
+MAX_HEADING_LENGTH = 80
+
+# Roman numerals up to 399, front matter rarely goes further
+ROMAN_NUMERAL = r"(?=[ivxlc])c{0,3}(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})"
+
+PAGE_NUMBER = re.compile(rf"^\s*(page\s+)?(\d+|{ROMAN_NUMERAL})(\s*(/|of)\s*\d+)?\s*$", re.IGNORECASE)
+
+REFERENCES_HEADING = re.compile(
+    r"^\s*(\d+\.?\s*)?(references|bibliography|works cited|literature cited)\s*$", re.IGNORECASE
+)
+
+APPENDIX_HEADING = re.compile(r"^\s*(appendix|appendices)\b", re.IGNORECASE)
+
+# Start of any other section, ends a stripped one: "Chapter 3", "4 Results",
+# "4.2 Setup". Numbered references have periods after the author names
+SECTION_HEADING = re.compile(
+    r"^\s*((?i:chapter|part|section)\s+(\d+|[ivxlcIVXLC]+)\b|\d+(\.\d+)*\.?\s+[A-Z][^.]*$|(?i:appendix|appendices)\b)"
+)
+
+# "exam-\nple" -> "example", hyphens before an upper case letter are real ones
+HYPHENATED_LINE_BREAK = re.compile(r"(\w)-\n[ \t]*([a-z])")
+
+SPACES = re.compile(r"[ \t ]+")
+SPACES_AROUND_LINE_BREAKS = re.compile(r" ?\n ?")
+BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def _normalized(line: str) -> str:
+    """Page numbers inside running headers differ between pages"""
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+
+def _edge_indices(lines: list[str]) -> set[int]:
+    content = [i for i, line in enumerate(lines) if line.strip()]
+    return set(content[:COMPACT_EDGE_LINES] + content[-COMPACT_EDGE_LINES:])
+
+
+def _is_heading(line: str, pattern: re.Pattern) -> bool:
+    return len(line.strip()) <= MAX_HEADING_LENGTH and pattern.match(line) is not None
+
+
+def dehyphenate(text: str) -> str:
+    return HYPHENATED_LINE_BREAK.sub(r"\1\2", text)
+
+
+def normalize_whitespace(text: str) -> str:
+    text = SPACES.sub(" ", text)
+    text = SPACES_AROUND_LINE_BREAKS.sub("\n", text)
+    return BLANK_LINES.sub("\n\n", text).strip()
+
+
+class Compactor:
+    """Removes what costs tokens without carrying ideas from pages of a
+    single document: running headers and footers, page numbers, hyphenated
+    line breaks, extra whitespace and optionally references and appendices
+
+    Every page is `observe`d first to find lines repeating at page edges,
+    then pages go through `compact` in order, as a stripped section carries
+    over to the following pages. Parts of a document can be observed by
+    separate compactors, which are `merge`d before compacting
+    """
+
+    def __init__(self, page_count: int):
+        self.page_count = page_count
+        self.edge_lines: Counter[str] = Counter()
+        self.pages_observed = 0
+        self.repeated: set[str] | None = None
+        self.skipping = False
+
+    def observe(self, page: str):
+        lines = page.splitlines()
+        self.edge_lines.update({_normalized(lines[i]) for i in _edge_indices(lines)})
+        self.pages_observed += 1
+
+    def merge(self, other: "Compactor"):
+        """Adds pages observed by a compactor of another part of the document"""
+        self.edge_lines.update(other.edge_lines)
+        self.pages_observed += other.pages_observed
+
+    def _repeated_lines(self) -> set[str]:
+        if self.pages_observed < MIN_PAGES_FOR_HEADERS:
+            return set()
+        min_count = COMPACT_REPEATED_LINE_SHARE * self.pages_observed
+        return {line for line, count in self.edge_lines.items() if count >= min_count}
+
+    def _strip_edges(self, lines: list[str]) -> list[str]:
+        if self.repeated is None:
+            self.repeated = self._repeated_lines()
+        edges = _edge_indices(lines)
+        return [
+            line for i, line in enumerate(lines)
+            if i not in edges or not (_normalized(line) in self.repeated or PAGE_NUMBER.match(line))
+        ]
+
+    def _is_stripped_heading(self, line: str) -> bool:
+        return (COMPACT_STRIP_REFERENCES and _is_heading(line, REFERENCES_HEADING)) or (
+            COMPACT_STRIP_APPENDICES and _is_heading(line, APPENDIX_HEADING)
+        )
+
+    def _strip_sections(self, lines: list[str], page_number: int) -> list[str]:
+        """Drops stripped sections up to the heading of the next section, books
+        have references at the end of every chapter
+        """
+        may_start = page_number >= SECTIONS_MIN_POSITION * self.page_count
+        kept = []
+        for line in lines:
+            if self.skipping and _is_heading(line, SECTION_HEADING) and not self._is_stripped_heading(line):
+                self.skipping = False
+            elif may_start and not self.skipping and self._is_stripped_heading(line):
+                self.skipping = True
+            if not self.skipping:
+                kept.append(line)
+        return kept
+
+    def compact(self, page: str, page_number: int) -> str:
+        """Compacted text of the page
+
+        Args:
+        page (str): Page text as extracted
+        page_number (int): Position of the page in the document, from 0
+        """
+        lines = self._strip_edges(page.splitlines())
+        lines = self._strip_sections(lines, page_number)
+        return normalize_whitespace(dehyphenate("\n".join(lines)))
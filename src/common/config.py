@@ -6,6 +6,11 @@ PDF_PAPERS_FOLDER = "resources/papers"
 # Original PDFs
 PDF_PAPERS_RAW_FOLDER = "resources/papers_raw"
 
+# How PDFs from raw folder are placed into the flat one: "auto" (reflink,
+# then hardlink), "reflink", "hardlink", "symlink" or "copy". Every mode falls
+# back to copying when the filesystem doesn't support it
+FLATTEN_LINK_MODE = "auto"
+
 # Json file that should contain list of objects with fields title (paper title)
 # and id - a reference key
 JSON_REFERENCE_KEY_FILE = "Thesis.json"
@@ -13,9 +18,16 @@ JSON_REFERENCE_KEY_FILE = "Thesis.json"
 # Folder to export raw text from PDFs
 EXTRACTED_TEXT_FOLDER = "resources/extracted"
 
-# Folder to export token count of texts from PDFs
+# Folder where previous versions kept token count of texts from PDFs. It is
+# only read once to fill in the manifest
 TOKEN_COUNT_FOLDER = "resources/token_count"
 
+# SQLite database with state of every paper in the pipeline
+MANIFEST_FILE = "resources/manifest.sqlite3"
+
+# Content-addressed storage of extracted texts and token counts keyed by PDF hash
+EXTRACTION_CACHE_FOLDER = "resources/extraction_cache"
+
 # Folder for outputting notes out of the paper
 NOTES_OUTPUT_FOLDER = "resources/notes"
 
@@ -24,6 +36,12 @@ NOTES_OUTPUT_FOLDER = "resources/notes"
 # Models used for calculating number of tokens
 TOKENIZER_MODEL = "Kijai/llava-llama-3-8b-text-encoder-tokenizer"
 
+# Revision of TOKENIZER_MODEL, downloaded once into TOKENIZER_FOLDER and
+# loaded from there offline. A branch is resolved to its commit at download,
+# which is printed and should be set here, so every machine counts the same
+TOKENIZER_REVISION = "main"
+TOKENIZER_FOLDER = "resources/tokenizer"
+
 ################### API ##################################
 
 # Key used to call open router
@@ -35,9 +53,224 @@ OPENROUTER_URL = "https://openrouter.ai/api/v1"
 # API has maximum input token limit
 MAX_API_TOKENS_ALLOWED = 10e5
 
-# Limit concurrent requests to open router
+# Models notes are generated with, in order of preference. A paper goes to the
+# first model whose context window fits it, the next fitting one is used for
+# hedged requests
+NOTES_MODELS = ["google/gemini-2.0-flash-001", "openai/gpt-4o"]
+
+# Room left in the context window for the model output
+NOTES_OUTPUT_TOKENS_RESERVE = 16_000
+
+# Send a duplicate request to the next model when the first one produces no
+# output within HEDGE_LATENCY_QUANTILE of time to first output seen so far.
+# The slower of the two gets cancelled
+HEDGE_REQUESTS = True
+HEDGE_LATENCY_QUANTILE = 0.95
+
+# Until this many requests finished, requests are hedged after HEDGE_INITIAL_DEADLINE seconds
+HEDGE_MIN_SAMPLES = 20
+HEDGE_INITIAL_DEADLINE = 120
+
+# Papers exceeding MAX_API_TOKENS_ALLOWED are split into section-aware chunks,
+# processed concurrently and merged, instead of being offered for removal
+CHUNK_LONG_PAPERS = True
+
+# Maximal size of a single chunk of a long paper
+CHUNK_MAX_TOKENS = 200_000
+
+# Papers up to PACK_MAX_TOKENS_PER_PAPER tokens are bin-packed into shared
+# requests of at most PACK_MAX_TOKENS tokens and PACK_MAX_PAPERS papers, so
+# short papers don't each pay for the whole prompt and a round trip
+PACK_SMALL_PAPERS = True
+PACK_MAX_TOKENS_PER_PAPER = 8_000
+PACK_MAX_TOKENS = 40_000
+PACK_MAX_PAPERS = 8
+
+# Initial limit of concurrent requests to open router. It is adjusted at
+# runtime: halved on 429/5xx responses and slowly grown back on successes
 MAX_CONCURRENT_REQUESTS = 10
 
+# Bounds of adaptive concurrency limit
+MIN_CONCURRENT_REQUESTS = 1
+MAX_CONCURRENT_REQUESTS_LIMIT = 30
+
+# Provider budgets, None means unlimited
+REQUESTS_PER_MINUTE = None
+TOKENS_PER_MINUTE = None
+
+# How many times a request rejected with 429 or 5xx is retried
+RATE_LIMIT_MAX_RETRIES = 5
+
+# Pause in seconds after 429/5xx without Retry-After header, doubled on each retry
+RATE_LIMIT_DEFAULT_BACKOFF = 10
+
+# A paper whose notes fail with a transient error (timeout, dropped connection,
+# empty answer, 429/5xx after all the retries above) is tried again this many
+# times in total. Pauses start at NOTES_RETRY_BACKOFF seconds, double on each
+# attempt and are randomized by half. Papers failing all of them are recorded
+# in the manifest and can be retried with --retry-failed
+NOTES_MAX_ATTEMPTS = 3
+NOTES_RETRY_BACKOFF = 30
+
+# Mark the end of static prompt prefix with `cache_control`, required by some
+# providers (Anthropic, Gemini) to enable prompt caching
+PROMPT_CACHE_BREAKPOINT = True
+
+# Model outputs are cached on disk, so re-runs don't pay for the same completion
+RESPONSE_CACHE_FOLDER = "resources/response_cache"
+
+# Cache entries not used for this long are removed
+RESPONSE_CACHE_MAX_AGE_DAYS = 90
+
+# Least recently used entries are removed when cache grows over this size
+RESPONSE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Stream model output and write each note as soon as it is generated
+STREAM_RESPONSES = True
+
+# Use HTTP/2 multiplexing when `h2` package is installed (pip install httpx[http2])
+HTTP2_ENABLED = True
+
+# Connection pool limits of the shared HTTP client
+HTTP_MAX_CONNECTIONS = MAX_CONCURRENT_REQUESTS_LIMIT
+HTTP_MAX_KEEPALIVE_CONNECTIONS = MAX_CONCURRENT_REQUESTS_LIMIT
+
+# Seconds an idle connection is kept alive
+HTTP_KEEPALIVE_EXPIRY = 60
+
+# Timeouts in seconds. Read timeout is large as paper notes take minutes to generate
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 600
+HTTP_WRITE_TIMEOUT = 60
+HTTP_POOL_TIMEOUT = None
+
+
+################### Extraction  ##################################
+
+# Number of processes used for PDF extraction, None means all cores
+EXTRACTION_JOBS = None
+
+# Number of threads used for hashing PDFs
+HASH_JOBS = 8
+
+# Big books are split into page ranges of this size and extracted in parallel
+PAGES_PER_EXTRACTION_CHUNK = 200
+
+# Pages encoded by the tokenizer in a single batch
+TOKENIZE_BATCH_PAGES = 64
+
+# Tokens of a paper are estimated from its length, and only counted exactly
+# when the estimate is close to a token limit (MAX_API_TOKENS_ALLOWED,
+# PACK_MAX_TOKENS_PER_PAPER, context windows). The chars per token ratio is
+# calibrated on the last TOKEN_CALIBRATION_SAMPLES exactly counted papers,
+# every paper is counted until there are TOKEN_ESTIMATE_MIN_SAMPLES of them.
+# Close means within the larger of TOKEN_ESTIMATE_MARGIN and the observed error
+ESTIMATE_TOKENS = True
+TOKEN_ESTIMATE_MARGIN = 0.1
+TOKEN_ESTIMATE_MIN_SAMPLES = 20
+TOKEN_CALIBRATION_SAMPLES = 500
+TOKEN_CALIBRATION_FILE = "resources/token_calibration.json"
+
+# Extracted text is compacted before its tokens are counted and it is stored:
+# running headers/footers and page numbers are removed, words hyphenated at
+# line ends are joined and whitespace is normalized. Changes of COMPACT_*
+# settings make cached texts stale, their papers are extracted again
+COMPACT_TEXT = True
+
+# A line among the first/last COMPACT_EDGE_LINES lines of a page is a running
+# header/footer if it repeats, digits aside, on this share of pages
+COMPACT_EDGE_LINES = 3
+COMPACT_REPEATED_LINE_SHARE = 0.5
+
+# Drop the references section, and appendices, from the second half of a
+# document. Appendices after references are kept unless stripped too
+COMPACT_STRIP_REFERENCES = True
+COMPACT_STRIP_APPENDICES = False
+
+
+################### Pipeline  ##################################
+
+# Extracted papers waiting to be picked up by note generation
+PIPELINE_QUEUE_SIZE = 10
+
+# Papers being generated or waiting for a request slot at the same time,
+# extraction pauses when it is reached
+PIPELINE_MAX_PENDING_PAPERS = 40
+
+
+################### Deduplication  ##################################
+
+# Notes of a paper are compared with notes of all the other papers as soon as
+# they are written. Candidates come from LSH over MinHash signatures of word
+# shingles, so a note is compared with a handful of others, not the vault
+DEDUP_NOTES = True
+
+# "link" adds both notes to the "Similar notes" section of each other,
+# "merge" removes the newer note, adds its paper to the references of the
+# older one and points links of the newer paper there
+DEDUP_ACTION = "link"
+
+# Share of shared shingles (Jaccard similarity) from which notes are duplicates
+DEDUP_THRESHOLD = 0.8
+
+# Words in a shingle
+DEDUP_SHINGLE_WORDS = 3
+
+# Signature length and the number of LSH bands it is split into. Notes become
+# candidates at roughly (1 / bands) ** (bands / permutations) similarity, which
+# has to stay below DEDUP_THRESHOLD. Changing them requires `dedup --rebuild`
+DEDUP_PERMUTATIONS = 128
+DEDUP_BANDS = 16
+
+
+################### Search  ##################################
+
+# Notes of a paper are added to the local search index (`search` stage) as
+# soon as they are written
+SEARCH_INDEX = True
+
+# Memory-mapped arrays of the index
+SEARCH_INDEX_FOLDER = "resources/search_index"
+
+# Words are hashed into 2 ** SEARCH_HASH_BITS terms. Changing it requires
+# `search --rebuild`
+SEARCH_HASH_BITS = 20
+
+# Postings of newly indexed notes are appended unsorted and scanned whole by
+# every query, once there are more of them they get merged into the sorted part
+SEARCH_DELTA_MAX_POSTINGS = 100_000
+
+# Results returned by `search` unless -k is given
+SEARCH_TOP_K = 10
+
+
+################### Watch  ##################################
+
+# Changes are collected for this many seconds after the last one before a
+# batch is processed, so a PDF still being copied isn't picked up half written
+WATCH_DEBOUNCE_SECONDS = 2
+
+# Folders are rescanned this often where inotify isn't available
+WATCH_POLL_SECONDS = 5
+
+
+################### Metrics  ##################################
+
+# JSON report of the last run: stage timers, request latencies, retries,
+# tokens and cost. None disables it
+METRICS_REPORT_FILE = "resources/metrics.json"
+
+# Same metrics in Prometheus text format for node_exporter textfile collector,
+# e.g. "/var/lib/node_exporter/textfile/the_thing.prom". None disables it
+METRICS_PROMETHEUS_FILE = None
+
+
+################### Reference keys  ##################################
+
+# Number of PDF titles sharing the rarest words with a Zotero item that get
+# fuzzy-scored against it
+REFERENCE_MATCH_SHORTLIST_SIZE = 25
+
 
 ################### Other  ##################################
 
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+
+from common.config import (DEDUP_ACTION, DEDUP_BANDS, DEDUP_PERMUTATIONS, DEDUP_SHINGLE_WORDS,
+                           DEDUP_THRESHOLD, NOTES_OUTPUT_FOLDER)
+from common.links import note_body, rewrite_links
+from common.manifest import Manifest
+
+# Shingles are hashed to 32 bits, permuted as (a * x + b) mod p
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# Permutations must be the same in every run, signatures are kept in the manifest
+PERMUTATION_SEED = 1
+
+WORD = re.compile(r"\w+")
+
+SIMILAR_HEADING = "## Similar notes"
+REFERENCES_SECTION = "## References"
+
+
+def shingle_hashes(text: str, words_in_shingle: int = DEDUP_SHINGLE_WORDS) -> set[int]:
+    words = WORD.findall(text.lower())
+    if len(words) <= words_in_shingle:
+        shingles = [" ".join(words)] if words else []
+    else:
+        shingles = [" ".join(words[i: i + words_in_shingle]) for i in range(len(words) - words_in_shingle + 1)]
+    return {zlib.crc32(s.encode()) for s in shingles}
+
+
+class MinHasher:
+    """MinHash signatures of notes and their LSH band buckets
+
+    Share of equal positions in two signatures estimates the Jaccard
+    similarity of shingle sets of the notes. Signatures are split into
+    `bands`, notes with an equal band land in the same bucket
+
+    Args:
+    permutations (int): Signature length
+    bands (int): Number of bands, has to divide `permutations`
+    """
+
+    def __init__(self, permutations: int = DEDUP_PERMUTATIONS, bands: int = DEDUP_BANDS):
+        if permutations % bands != 0:
+            raise ValueError(f"{bands} bands don't divide signature of {permutations}")
+        rng = np.random.default_rng(PERMUTATION_SEED)
+        self.a = rng.integers(1, MAX_HASH, size=permutations, dtype=np.uint64)
+        self.b = rng.integers(0, MAX_HASH, size=permutations, dtype=np.uint64)
+        self.bands = bands
+
+    def signature(self, text: str) -> np.ndarray | None:
+        """None for a note without words"""
+        hashes = shingle_hashes(text)
+        if len(hashes) == 0:
+            return None
+        x = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+        # Both factors are below 2**32, so nothing overflows 64 bits
+        permuted = (np.outer(x, self.a) + self.b) % MERSENNE_PRIME
+        return (permuted & MAX_HASH).min(axis=0).astype(np.uint32)
+
+    def buckets(self, signature: np.ndarray) -> list[int]:
+        return [
+            int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8).digest(), "little", signed=True)
+            for band in signature.reshape(self.bands, -1)
+        ]
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+def add_to_section(text: str, heading: str, line: str) -> str:
+    """Adds a line to the end of a section, the section is added to the end of
+    the note if it's missing. A line already there isn't added again
+    """
+    start = text.find("\n" + heading + "\n")
+    if start == -1:
+        return text.rstrip() + f"\n\n{heading}\n\n{line}"
+    end = text.find("\n## ", start + 1)
+    if line in text[start:end if end != -1 else len(text)].splitlines():
+        return text
+    if end == -1:
+        return text.rstrip() + "\n" + line
+    return text[:end].rstrip() + "\n" + line + "\n" + text[end:]
+
+
+def _note_path(notes_folder: str, reference_key: str, file_name: str) -> str:
+    return os.path.join(notes_folder, reference_key, file_name + ".md")
+
+
+def _edit_note(path: str, edit):
+    if not os.path.isfile(path):
+        return
+    with open(path, "r") as f:
+        text = f.read()
+    with open(path, "w") as f:
+        f.write(edit(text))
+
+
+def _cross_link(manifest: Manifest, notes_folder: str, note: tuple[str, str], duplicate: tuple[str, str]):
+    for (key, file_name), (_, other) in [(note, duplicate), (duplicate, note)]:
+        _edit_note(
+            _note_path(notes_folder, key, file_name),
+            lambda text: add_to_section(text, SIMILAR_HEADING, f"- [[{other}]]"),
+        )
+        manifest.add_links(file_name, [other])
+
+
+def _merge(manifest: Manifest, notes_folder: str, note: tuple[str, str], duplicate: tuple[str, str]):
+    """Keeps the older note, the newer one only adds its paper to references"""
+    reference_key, file_name = note
+    kept_key, kept = duplicate
+    _edit_note(
+        _note_path(notes_folder, kept_key, kept),
+        lambda text: add_to_section(text, REFERENCES_SECTION, f"- [[{reference_key}]]"),
+    )
+    path = _note_path(notes_folder, reference_key, file_name)
+    if os.path.isfile(path):
+        os.remove(path)
+    manifest.forget_note(reference_key, file_name)
+    for source_key, source in manifest.redirect_links(file_name, kept):
+        _edit_note(
+            _note_path(notes_folder, source_key, source),
+            lambda text: rewrite_links(text, {file_name.lower(): kept}),
+        )
+
+
+def deduplicate(
+    manifest: Manifest, reference_key: str, hasher: MinHasher | None = None, notes_folder: str = NOTES_OUTPUT_FOLDER
+) -> list[tuple[str, str, str, float]]:
+    """Finds notes of other papers nearly the same as notes of the paper and
+    links or merges them, see DEDUP_ACTION. Only the paper's own notes are
+    read, others are only known by their signatures
+
+    Returns file name of every duplicate note, reference key and file name
+    of the note it duplicates and their estimated similarity
+    """
+    hasher = hasher or MinHasher()
+    duplicates = []
+    signatures = []
+    for file_name in manifest.note_files(reference_key):
+        path = _note_path(notes_folder, reference_key, file_name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "r") as f:
+            signature = hasher.signature(note_body(f.read()))
+        if signature is None:
+            continue
+        buckets = hasher.buckets(signature)
+
+        best = None
+        for other_key, other, other_signature in manifest.dedup_candidates(reference_key, buckets):
+            s = similarity(signature, np.frombuffer(other_signature, dtype=np.uint32))
+            if s >= DEDUP_THRESHOLD and (best is None or s > best[2]):
+                best = (other_key, other, s)
+
+        if best is None:
+            signatures.append((file_name, signature.tobytes(), buckets))
+            continue
+        other_key, other, s = best
+        duplicates.append((file_name, other_key, other, s))
+        if DEDUP_ACTION == "merge":
+            _merge(manifest, notes_folder, (reference_key, file_name), (other_key, other))
+        else:
+            _cross_link(manifest, notes_folder, (reference_key, file_name), (other_key, other))
+            signatures.append((file_name, signature.tobytes(), buckets))
+
+    manifest.add_signatures(reference_key, signatures)
+    manifest.record_dedup(reference_key)
+    return duplicates
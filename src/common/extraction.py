@@ -0,0 +1,322 @@
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from typing import Iterator
+
+import pymupdf
+
+from common.compaction import Compactor
+from common.config import COMPACT_TEXT, PAGES_PER_EXTRACTION_CHUNK, TOKENIZE_BATCH_PAGES, TOKENIZER_FOLDER
+from common.extraction_cache import PageIndex
+from common.tokenizer import TokenEstimator, count_tokens, load_tokenizer, tokenizer_snapshot
+
+# Papers submitted to the pool ahead of the one being collected, per worker
+JOBS_AHEAD_PER_WORKER = 2
+
+# Tokenizer is loaded once per worker process by `_init_worker`
+_tokenizer = None
+
+
+@dataclass
+class ExtractionJob:
+    pdf_path: str
+    reference_key: str
+    # Where the extracted text gets written
+    text_path: str
+
+
+@dataclass
+class ExtractionResult:
+    reference_key: str
+    text_path: str | None = None
+    token_count: int | None = None
+    pages: PageIndex | None = None
+    # Tokens before compaction
+    raw_token_count: int | None = None
+    # Token counts come from `TokenEstimator`, not the tokenizer
+    estimated: bool = False
+    error: str | None = None
+    # CPU time spent by workers on this PDF
+    seconds: float | None = None
+    # Part of `seconds` spent on counting tokens
+    tokenize_seconds: float | None = None
+
+
+def _init_worker():
+    global _tokenizer
+    # Workers already take all the cores, tokenizer threads would only compete
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    # Snapshot is taken by the parent in `extraction_pool`, workers only read it
+    _tokenizer = load_tokenizer(TOKENIZER_FOLDER)
+
+
+def _page_ranges(pdf_path: str) -> tuple[list[tuple[int, int]], int]:
+    """Splits the document into page ranges so big books get extracted by
+    several workers at once. Small papers end up as a single range. Returns
+    the ranges and the page count
+    """
+    with pymupdf.open(pdf_path) as doc:
+        page_count = doc.page_count
+    if page_count == 0:
+        return [(0, 0)], 0
+    ranges = [
+        (start, min(start + PAGES_PER_EXTRACTION_CHUNK, page_count))
+        for start in range(0, page_count, PAGES_PER_EXTRACTION_CHUNK)
+    ]
+    return ranges, page_count
+
+
+def _part_path(text_path: str, start: int) -> str:
+    return f"{text_path}.{start}.part"
+
+
+@dataclass
+class _RangeResult:
+    # Byte size and length in characters of every page as written to the part
+    page_sizes: list[int]
+    page_chars: list[int]
+    # Characters of the pages before compaction
+    raw_chars: int
+    extract_seconds: float
+    # With COMPACT_TEXT the part holds raw pages, not separated, which are
+    # compacted once pages of all the parts are observed
+    compactor: Compactor | None = None
+
+
+def _write_page(f, result: _RangeResult, i: int, text: str):
+    data = text.encode("utf-8")
+    if i > 0:
+        data = b"\n" + data
+    f.write(data)
+    result.page_sizes.append(len(data))
+    result.page_chars.append(len(text))
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int, page_count: int, part_path: str) -> _RangeResult:
+    """Writes text of pages [start, end) to `part_path` one page at a time,
+    so a worker never holds more than a page. Pages are separated by a
+    newline written in front of every page but the first one of the document
+
+    With COMPACT_TEXT raw pages are written instead, and left for
+    `_compact_parts`, as running headers are only known once all the pages
+    of the document are seen
+    """
+    start_time = time.perf_counter()
+    result = _RangeResult([], [], 0, 0.0, Compactor(page_count) if COMPACT_TEXT else None)
+    with pymupdf.open(pdf_path) as doc, open(part_path, "wb") as f:
+        for i in range(start, end):
+            text = doc[i].get_text("text")
+            result.raw_chars += len(text)
+            if result.compactor is None:
+                _write_page(f, result, i, text)
+                continue
+            result.compactor.observe(text)
+            data = text.encode("utf-8")
+            f.write(data)
+            result.page_sizes.append(len(data))
+            result.page_chars.append(len(text))
+
+    result.extract_seconds = time.perf_counter() - start_time
+    return result
+
+
+def _compact_parts(text_path: str, part_paths: list[str], parts: list[_RangeResult]) -> _RangeResult:
+    """Compacts raw pages of all the parts into the text, in document order,
+    so a section stripped in one part carries over to the following ones.
+    Pages are read back one at a time
+    """
+    start_time = time.perf_counter()
+    compactor = parts[0].compactor
+    for part in parts[1:]:
+        compactor.merge(part.compactor)
+    result = _RangeResult([], [], sum(part.raw_chars for part in parts), 0.0)
+    with open(text_path, "wb") as f:
+        for part_path, part in zip(part_paths, parts):
+            with open(part_path, "rb") as raw:
+                for size in part.page_sizes:
+                    i = len(result.page_sizes)
+                    _write_page(f, result, i, compactor.compact(raw.read(size).decode("utf-8"), i))
+            os.remove(part_path)
+
+    result.extract_seconds = sum(part.extract_seconds for part in parts) + time.perf_counter() - start_time
+    return result
+
+
+def _count_pages(text_path: str, offsets: list[int]) -> tuple[list[int], float]:
+    """Exact token counts of consecutive pages of an extracted text, starting
+    at `offsets[0]`. Pages are read and encoded TOKENIZE_BATCH_PAGES at a time.
+    Returns counts and seconds spent
+    """
+    start_time = time.perf_counter()
+    counts = []
+    with open(text_path, "rb") as f:
+        f.seek(offsets[0])
+        for first in range(0, len(offsets) - 1, TOKENIZE_BATCH_PAGES):
+            bounds = offsets[first: first + TOKENIZE_BATCH_PAGES + 1]
+            texts = [f.read(end - begin).decode("utf-8") for begin, end in zip(bounds, bounds[1:])]
+            counts.extend(count_tokens(_tokenizer, texts))
+    return counts, time.perf_counter() - start_time
+
+
+def _join_parts(text_path: str, part_paths: list[str]):
+    """Concatenates part files on disk, a single part is just renamed"""
+    if len(part_paths) == 1:
+        os.replace(part_paths[0], text_path)
+        return
+    with open(text_path, "wb") as f:
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, f)
+            os.remove(part_path)
+
+
+def _remove_parts(paths: list[str]):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _special_tokens_count() -> int:
+    return _tokenizer.num_special_tokens_to_add()
+
+
+def extraction_pool(n_jobs: int | None = None) -> ProcessPoolExecutor:
+    """Process pool with a tokenizer loaded in every worker. It can be kept
+    around and passed to `extract_all` so workers stay warm between batches
+    """
+    # Downloaded once here, not by every worker into the same folder at once
+    tokenizer_snapshot()
+    return ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count() or 1, initializer=_init_worker)
+
+
+def extract_all(
+    jobs: list[ExtractionJob],
+    n_jobs: int | None = None,
+    executor: ProcessPoolExecutor | None = None,
+    estimator: TokenEstimator | None = None,
+) -> Iterator[ExtractionResult]:
+    """Extracts text and counts tokens for all the given PDFs in a process pool
+
+    Text is compacted and streamed to `ExtractionJob.text_path` page by page
+    and never held in memory whole, neither by workers nor here. Tokens are
+    counted afterwards, in batches of pages spread over the workers. Results
+    are yielded in the same order as `jobs`. A failure of a single PDF is
+    reported through `ExtractionResult.error` and never stops the batch
+
+    Args:
+    jobs (list[ExtractionJob]): PDFs to extract
+    n_jobs (int | None): Number of worker processes, all cores if None
+    executor (ProcessPoolExecutor | None): Pool of `extraction_pool` to use
+        instead of starting a new one, it should have `n_jobs` workers
+    estimator (TokenEstimator | None): Estimates tokens of papers it doesn't
+        need exact counts for, all the papers are counted exactly if None
+    """
+    if len(jobs) == 0:
+        return
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    if executor is not None:
+        yield from _extract_in(executor, jobs, n_jobs, estimator)
+        return
+    with extraction_pool(n_jobs) as executor:
+        yield from _extract_in(executor, jobs, n_jobs, estimator)
+
+
+def _page_tokens(
+    executor: ProcessPoolExecutor, text_path: str, offsets: list[int], page_chars: list[int], estimator: TokenEstimator | None
+) -> tuple[list[int], bool, float]:
+    """Token count of every page, whether it is estimated and seconds spent counting"""
+    chars = sum(page_chars)
+    if estimator is not None and not estimator.needs_exact(chars):
+        return [estimator.estimate(c) for c in page_chars], True, 0.0
+
+    futures = [
+        executor.submit(_count_pages, text_path, offsets[start: start + PAGES_PER_EXTRACTION_CHUNK + 1])
+        for start in range(0, len(page_chars), PAGES_PER_EXTRACTION_CHUNK)
+    ]
+    counted = [f.result() for f in futures]
+    page_tokens = [tokens for counts, _ in counted for tokens in counts]
+    if estimator is not None and chars > 0:
+        estimator.record(chars, sum(page_tokens))
+    return page_tokens, False, sum(seconds for _, seconds in counted)
+
+
+def _extract_in(
+    executor: ProcessPoolExecutor, jobs: list[ExtractionJob], n_jobs: int, estimator: TokenEstimator | None
+) -> Iterator[ExtractionResult]:
+    special_tokens = executor.submit(_special_tokens_count).result()
+
+    def submit(job: ExtractionJob) -> tuple[ExtractionJob, list[tuple[str, Future]] | Exception]:
+        try:
+            ranges, page_count = _page_ranges(job.pdf_path)
+        except Exception as e:
+            return job, e
+        futures = []
+        for start, end in ranges:
+            part_path = _part_path(job.text_path, start)
+            futures.append((
+                part_path,
+                executor.submit(_extract_page_range, job.pdf_path, start, end, page_count, part_path),
+            ))
+        return job, futures
+
+    # Keep a window of jobs submitted ahead so workers are never idle,
+    # while a slow consumer pauses extraction instead of piling results
+    # up in memory. Results are collected in submission order to keep
+    # progress output ordered
+    submitted: deque[tuple[ExtractionJob, list[tuple[str, Future]] | Exception]] = deque()
+    remaining = iter(jobs)
+    for job in islice(remaining, n_jobs * JOBS_AHEAD_PER_WORKER):
+        submitted.append(submit(job))
+
+    while len(submitted) > 0:
+        job, futures = submitted.popleft()
+        next_job = next(remaining, None)
+        if next_job is not None:
+            submitted.append(submit(next_job))
+
+        if isinstance(futures, Exception):
+            yield ExtractionResult(job.reference_key, error=str(futures))
+            continue
+        part_paths = [part_path for part_path, _ in futures]
+        try:
+            parts = [f.result() for _, f in futures]
+            if parts[0].compactor is None:
+                _join_parts(job.text_path, part_paths)
+                text = _RangeResult(
+                    [size for part in parts for size in part.page_sizes],
+                    [chars for part in parts for chars in part.page_chars],
+                    sum(part.raw_chars for part in parts),
+                    sum(part.extract_seconds for part in parts),
+                )
+            else:
+                text = executor.submit(_compact_parts, job.text_path, part_paths, parts).result()
+            offsets = [0]
+            for size in text.page_sizes:
+                offsets.append(offsets[-1] + size)
+            page_tokens, estimated, tokenize_seconds = _page_tokens(
+                executor, job.text_path, offsets, text.page_chars, estimator
+            )
+        except Exception as e:
+            _remove_parts([*part_paths, job.text_path])
+            yield ExtractionResult(job.reference_key, error=str(e))
+            continue
+
+        # Tokens removed by compaction are estimated from the removed characters
+        tokens = sum(page_tokens)
+        chars = sum(text.page_chars)
+        raw_tokens = round(tokens * text.raw_chars / chars) if chars > 0 else tokens
+        yield ExtractionResult(
+            job.reference_key,
+            job.text_path,
+            tokens + special_tokens,
+            PageIndex(offsets, page_tokens),
+            raw_tokens + special_tokens,
+            estimated,
+            seconds=text.extract_seconds + tokenize_seconds,
+            tokenize_seconds=tokenize_seconds,
+        )
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from common.config import (COMPACT_EDGE_LINES, COMPACT_REPEATED_LINE_SHARE, COMPACT_STRIP_APPENDICES,
+                           COMPACT_STRIP_REFERENCES, COMPACT_TEXT, EXTRACTION_CACHE_FOLDER, HASH_JOBS,
+                           TOKENIZER_MODEL, TOKENIZER_REVISION)
+from common.tokenizer import snapshot_revision
+
+INDEX_FILE_NAME = "index.json"
+
+
+def file_hash(path: str) -> str:
+    """Streaming sha256 of file contents, never loads whole file into memory"""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def hash_files(paths: list[str]) -> dict[str, str]:
+    """Hashes all the files in parallel. hashlib releases GIL on big buffers so
+    threads are enough here
+    """
+    with ThreadPoolExecutor(max_workers=HASH_JOBS) as executor:
+        return dict(zip(paths, executor.map(file_hash, paths)))
+
+
+def _link_or_copy(source: str, destination: str):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy(source, destination)
+
+
+def extraction_settings() -> dict:
+    """Settings the extracted text and its token count depend on"""
+    revision = TOKENIZER_REVISION
+    snapshot = snapshot_revision()
+    if snapshot is not None and snapshot[0] == TOKENIZER_REVISION:
+        revision = snapshot[1]
+    return {
+        "compact_text": COMPACT_TEXT,
+        "compact_edge_lines": COMPACT_EDGE_LINES,
+        "compact_repeated_line_share": COMPACT_REPEATED_LINE_SHARE,
+        "compact_strip_references": COMPACT_STRIP_REFERENCES,
+        "compact_strip_appendices": COMPACT_STRIP_APPENDICES,
+        "tokenizer_model": TOKENIZER_MODEL,
+        "tokenizer_revision": revision,
+    }
+
+
+@dataclass
+class PageIndex:
+    """Where every page starts in an extracted text and its token count"""
+    # Byte offsets of page starts, the last one is the end of the text
+    offsets: list[int]
+    tokens: list[int]
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+
+class ExtractionCache:
+    """Content-addressed storage of extracted texts and token counts
+
+    Layout of `EXTRACTION_CACHE_FOLDER`:
+    - <pdf hash>.txt   - extracted text
+    - <pdf hash>.token - token count, json like {"tokens": 123}, with
+                         "raw_tokens" before compaction, "estimated" if the
+                         count is not exact, "page_offsets" and
+                         "page_tokens" of `PageIndex` and "settings" of
+                         `extraction_settings` it was made with
+    - index.json       - mapping of reference key to the hash of its PDF
+
+    Entries made with other settings are stale, they are not hits and get
+    replaced by the next `put` of the same PDF
+    """
+
+    def __init__(self, folder: str = EXTRACTION_CACHE_FOLDER, settings: dict | None = None):
+        self.folder = folder
+        self.settings = extraction_settings() if settings is None else settings
+        os.makedirs(folder, exist_ok=True)
+        self.index: dict[str, str] = {}
+        index_path = os.path.join(folder, INDEX_FILE_NAME)
+        if os.path.isfile(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+
+    def _path(self, pdf_hash: str, extension: str) -> str:
+        return os.path.join(self.folder, pdf_hash + extension)
+
+    def _exists(self, pdf_hash: str) -> bool:
+        return os.path.isfile(self._path(pdf_hash, ".txt")) and os.path.isfile(
+            self._path(pdf_hash, ".token")
+        )
+
+    def has(self, pdf_hash: str) -> bool:
+        return self._exists(pdf_hash) and self._info(pdf_hash).get("settings") == self.settings
+
+    def is_stale(self, pdf_hash: str) -> bool:
+        """Whether the PDF was extracted with settings other than the current ones"""
+        return self._exists(pdf_hash) and not self.has(pdf_hash)
+
+    def is_up_to_date(self, reference_key: str, pdf_hash: str) -> bool:
+        return self.index.get(reference_key) == pdf_hash and self.has(pdf_hash)
+
+    def staging_path(self, reference_key: str, pdf_hash: str) -> str:
+        """Where extraction writes the text before it is `put`, on the same
+        filesystem as the cache so putting it is just a rename
+        """
+        return self._path(pdf_hash, f".{reference_key}.tmp")
+
+    def put(
+        self,
+        reference_key: str,
+        pdf_hash: str,
+        text_path: str,
+        token_count: int,
+        pages: PageIndex | None = None,
+        raw_token_count: int | None = None,
+        estimated: bool = False,
+    ):
+        """Moves text extracted to `text_path` into the cache"""
+        os.replace(text_path, self._path(pdf_hash, ".txt"))
+        info: dict = {"tokens": token_count, "settings": self.settings}
+        if raw_token_count is not None:
+            info["raw_tokens"] = raw_token_count
+        if estimated:
+            info["estimated"] = True
+        if pages is not None:
+            info["page_offsets"] = pages.offsets
+            info["page_tokens"] = pages.tokens
+        with open(self._path(pdf_hash, ".token"), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        self.index[reference_key] = pdf_hash
+
+    def _info(self, pdf_hash: str) -> dict:
+        with open(self._path(pdf_hash, ".token"), "r") as f:
+            return json.load(f)
+
+    def token_count(self, pdf_hash: str) -> int:
+        return int(self._info(pdf_hash)["tokens"])
+
+    def raw_token_count(self, pdf_hash: str) -> int:
+        """Token count before compaction"""
+        info = self._info(pdf_hash)
+        return int(info.get("raw_tokens", info["tokens"]))
+
+    def is_estimated(self, pdf_hash: str) -> bool:
+        """Whether the token count came from `TokenEstimator`"""
+        return bool(self._info(pdf_hash).get("estimated", False))
+
+    def materialize(self, reference_key: str, pdf_hash: str, txt_path: str):
+        """Puts cached text of `pdf_hash` to the given location"""
+        _link_or_copy(self._path(pdf_hash, ".txt"), txt_path)
+        self.index[reference_key] = pdf_hash
+
+    def save(self):
+        index_path = os.path.join(self.folder, INDEX_FILE_NAME)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, index_path)
@@ -0,0 +1,204 @@
+import json
+import os
+import shutil
+import sys
+from collections import Counter, defaultdict
+from enum import Enum
+
+from common.config import MAX_CHARS_IN_FILE_NAME
+from common.extraction_cache import hash_files
+
+
+class LinkMode(Enum):
+    # Reflink, then hardlink, then copy
+    AUTO = "auto"
+    # Copy-on-write clone, shares data blocks until either file changes (btrfs, XFS)
+    REFLINK = "reflink"
+    # Second name of the same file, only within one filesystem
+    HARDLINK = "hardlink"
+    # Breaks if the raw folder gets moved
+    SYMLINK = "symlink"
+    COPY = "copy"
+
+
+# ioctl cloning whole file on Linux, from <linux/fs.h>
+FICLONE = 0x40049409
+
+# Flat name of every source file, relative to the source folder, kept in the
+# destination folder so names never move between files
+INDEX_FILE_NAME = ".flatten.json"
+
+
+def _reflink(source: str, destination: str):
+    if not sys.platform.startswith("linux"):
+        raise OSError("Reflinks are only supported on Linux")
+    import fcntl
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, destination)
+
+
+def _symlink(source: str, destination: str):
+    os.symlink(os.path.abspath(source), destination)
+
+
+LINKERS = {
+    LinkMode.REFLINK: _reflink,
+    LinkMode.HARDLINK: os.link,
+    LinkMode.SYMLINK: _symlink,
+    # Keeps modification time, so the copy is recognized as up to date later
+    LinkMode.COPY: shutil.copy2,
+}
+
+FALLBACKS = {
+    LinkMode.AUTO: [LinkMode.REFLINK, LinkMode.HARDLINK, LinkMode.COPY],
+    LinkMode.REFLINK: [LinkMode.REFLINK, LinkMode.COPY],
+    LinkMode.HARDLINK: [LinkMode.HARDLINK, LinkMode.COPY],
+    LinkMode.SYMLINK: [LinkMode.SYMLINK, LinkMode.COPY],
+    LinkMode.COPY: [LinkMode.COPY],
+}
+
+
+def link_file(source: str, destination: str, mode: LinkMode = LinkMode.AUTO) -> LinkMode:
+    """Places `source` at `destination` without copying data where the
+    filesystem allows it, falling back to a copy. Existing destination is
+    replaced atomically. Returns the way the file got placed
+    """
+    tmp_path = destination + ".tmp"
+    attempts = FALLBACKS[mode]
+    for attempt in attempts:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            LINKERS[attempt](source, tmp_path)
+        except OSError:
+            if attempt == attempts[-1]:
+                raise
+            continue
+        os.replace(tmp_path, destination)
+        return attempt
+    raise RuntimeError("unreachable")
+
+
+def is_up_to_date(source: str, destination: str) -> bool:
+    """Whether `destination` was placed from the current version of `source`"""
+    if not os.path.lexists(destination):
+        return False
+    if os.path.islink(destination):
+        return os.path.realpath(destination) == os.path.realpath(source)
+    source_stat = os.stat(source)
+    destination_stat = os.stat(destination)
+    if os.path.samestat(source_stat, destination_stat):
+        return True
+    return (
+        source_stat.st_size == destination_stat.st_size
+        and source_stat.st_mtime_ns == destination_stat.st_mtime_ns
+    )
+
+
+def find_duplicates(paths: list[str]) -> dict[str, str]:
+    """Maps every file having the same contents as an earlier one in `paths`
+    to that earlier file. Only files sharing their size with another file get
+    hashed
+    """
+    by_size: dict[int, list[str]] = defaultdict(list)
+    for path in paths:
+        by_size[os.path.getsize(path)].append(path)
+    candidates = [path for group in by_size.values() if len(group) > 1 for path in group]
+    hashes = hash_files(candidates)
+
+    first_with_hash: dict[str, str] = {}
+    duplicates = {}
+    for path in paths:
+        if path not in hashes:
+            continue
+        original = first_with_hash.setdefault(hashes[path], path)
+        if original != path:
+            duplicates[path] = original
+    return duplicates
+
+
+def flat_names(paths: list[str], previous: dict[str, str]) -> dict[str, str]:
+    """File name in the flat folder of every path. Paths keep names they got
+    before, a new path whose name is already taken gets " (2)", " (3)"...
+    suffix. Names are compared case-insensitively, so they don't clash on
+    macOS and Windows either
+    """
+    names = {path: previous[path] for path in paths if path in previous}
+    taken = {name.lower() for name in names.values()}
+    for path in paths:
+        if path in names:
+            continue
+        base, extension = os.path.splitext(os.path.basename(path))
+        name = base + extension
+        n = 1
+        while name.lower() in taken:
+            n += 1
+            suffix = f" ({n})"
+            name = base[: MAX_CHARS_IN_FILE_NAME - len(suffix)] + suffix + extension
+        taken.add(name.lower())
+        names[path] = name
+    return names
+
+
+def flatten_folder(source_folder: str, destination_folder: str, mode: LinkMode = LinkMode.AUTO) -> list[str]:
+    """
+    Recursively flattens the source folder by linking all files to the destination folder.
+    Returns names of files placed by this call, new or changed ones
+
+    Files with identical contents are placed only once. Files with the same
+    name from different subfolders are all kept under collision-safe names,
+    which are remembered, so adding a new file never renames already
+    flattened ones. Files whose source changed are replaced
+
+    Args:
+    source_folder (str): Path to the folder to be flattened
+    destination_folder (str): Path to the folder where files will be linked
+    mode (LinkMode): How files get placed, falls back to copying if not possible
+    """
+    os.makedirs(destination_folder, exist_ok=True)
+
+    index_path = os.path.join(destination_folder, INDEX_FILE_NAME)
+    previous = {}
+    if os.path.isfile(index_path):
+        with open(index_path, "r") as f:
+            previous = {os.path.join(source_folder, p): name for p, name in json.load(f).items()}
+
+    sources = sorted(
+        os.path.join(root, f) for root, _, files in os.walk(source_folder) for f in files
+    )
+
+    duplicates = find_duplicates(sources)
+    for duplicate, original in duplicates.items():
+        print(f"Skipping duplicate of {original}: {duplicate}")
+
+    names = flat_names([path for path in sources if path not in duplicates], previous)
+
+    placed: Counter[LinkMode] = Counter()
+    placed_names = []
+    up_to_date = 0
+    for source_path, name in names.items():
+        destination_path = os.path.join(destination_folder, name)
+        if is_up_to_date(source_path, destination_path):
+            up_to_date += 1
+            continue
+        if name != os.path.basename(source_path):
+            print(f"Name is taken, placing as {name}: {source_path}")
+        placed[link_file(source_path, destination_path, mode)] += 1
+        placed_names.append(name)
+
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {os.path.relpath(path, source_folder): name for path, name in names.items()},
+            f, indent=4, sort_keys=True,
+        )
+    os.replace(tmp_path, index_path)
+
+    ways = ", ".join(f"{count} as {way.value}" for way, count in placed.items())
+    print(
+        f"Placed {sum(placed.values())} files{f' ({ways})' if ways else ''}, "
+        f"{up_to_date} already up to date, {len(duplicates)} duplicates skipped"
+    )
+    return placed_names
@@ -0,0 +1,78 @@
+import os
+import re
+
+# Characters Obsidian doesn't allow in file names or that break [[links]]
+INVALID_FILE_NAME_CHARACTERS = re.compile(r'[\\/:*?"<>|#^\[\]]')
+
+# Leaves room for the suffix of a colliding name below the 255 bytes most
+# filesystems allow
+MAX_FILE_NAME_LENGTH = 150
+
+# [[target]], [[target#heading]], [[target|alias]] and [[target#heading|alias]]
+WIKILINK = re.compile(r"\[\[([^\[\]|#^]+)([#^][^\[\]|]*)?(\|[^\[\]]*)?\]\]")
+
+# Section with the link to the paper, added to every note by `format_note`
+REFERENCES_HEADING = "\n## References"
+
+
+def note_file_name(title: str) -> str:
+    """File name (without extension) a note with the title would get if no
+    other note had it
+    """
+    name = " ".join(INVALID_FILE_NAME_CHARACTERS.sub(" ", title).split())
+    name = name[:MAX_FILE_NAME_LENGTH].strip().rstrip(".")
+    return name or "Untitled"
+
+
+def colliding_names(file_name: str, reference_key: str):
+    """Names tried one by one when `file_name` is taken by another note"""
+    yield f"{file_name} ({reference_key})"
+    n = 2
+    while True:
+        yield f"{file_name} ({reference_key} {n})"
+        n += 1
+
+
+def note_links(text: str) -> list[str]:
+    """Distinct targets of all the [[links]] in the text, in order"""
+    targets = [m.group(1).strip() for m in WIKILINK.finditer(text)]
+    return list(dict.fromkeys(t for t in targets if t))
+
+
+def rewrite_links(text: str, renamed: dict[str, str]) -> str:
+    """Points links to notes stored under another name than their title
+
+    Args:
+    text (str): Note text
+    renamed (dict[str, str]): Lowercased title to file name of the note
+    """
+    if len(renamed) == 0:
+        return text
+
+    def rewrite(match: re.Match) -> str:
+        target = match.group(1).strip()
+        file_name = renamed.get(target.lower())
+        if file_name is None:
+            return match.group(0)
+        alias = match.group(3) or "|" + target
+        if alias[1:] == file_name:
+            alias = ""
+        return f"[[{file_name}{match.group(2) or ''}{alias}]]"
+
+    return WIKILINK.sub(rewrite, text)
+
+
+def note_body(text: str) -> str:
+    """Text the model wrote, without the sections added afterwards"""
+    return text.split(REFERENCES_HEADING, 1)[0]
+
+
+def read_note(path: str) -> tuple[str, list[str]]:
+    """Title and link targets of a note written before the index existed.
+    The link to the paper is left out
+    """
+    with open(path, "r") as f:
+        text = f.read()
+    first_line = text.split("\n", 1)[0]
+    title = first_line[2:] if first_line.startswith("# ") else os.path.splitext(os.path.basename(path))[0]
+    return title, note_links(note_body(text))
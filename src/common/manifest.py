@@ -0,0 +1,617 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from enum import Enum
+
+from common.config import MANIFEST_FILE
+from common.links import colliding_names, read_note
+
+
+class Status(Enum):
+    PENDING = "pending"
+    IN_PROGRESS = "in_progress"
+    DONE = "done"
+    FAILED = "failed"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    reference_key TEXT PRIMARY KEY,
+    pdf_name TEXT,
+    pdf_hash TEXT,
+    extraction_status TEXT NOT NULL DEFAULT 'pending',
+    token_count INTEGER,
+    raw_token_count INTEGER,
+    extraction_seconds REAL,
+    extracted_at REAL,
+    notes_status TEXT NOT NULL DEFAULT 'pending',
+    notes_started_at REAL,
+    notes_finished_at REAL,
+    notes_seconds REAL,
+    note_count INTEGER,
+    notes_attempts INTEGER,
+    deduped_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS papers_extraction_status ON papers (extraction_status);
+CREATE INDEX IF NOT EXISTS papers_notes_status ON papers (notes_status);
+CREATE TABLE IF NOT EXISTS notes (
+    reference_key TEXT NOT NULL,
+    file_name TEXT NOT NULL COLLATE NOCASE,
+    title TEXT NOT NULL,
+    PRIMARY KEY (reference_key, file_name)
+);
+CREATE INDEX IF NOT EXISTS notes_file_name ON notes (file_name);
+CREATE TABLE IF NOT EXISTS links (
+    source TEXT NOT NULL COLLATE NOCASE,
+    target TEXT NOT NULL COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS links_source ON links (source);
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+CREATE TABLE IF NOT EXISTS note_signatures (
+    reference_key TEXT NOT NULL,
+    file_name TEXT NOT NULL COLLATE NOCASE,
+    signature BLOB NOT NULL,
+    PRIMARY KEY (reference_key, file_name)
+);
+CREATE TABLE IF NOT EXISTS note_bands (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    reference_key TEXT NOT NULL,
+    file_name TEXT NOT NULL COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS note_bands_bucket ON note_bands (band, bucket);
+CREATE INDEX IF NOT EXISTS note_bands_paper ON note_bands (reference_key);
+CREATE TABLE IF NOT EXISTS search_docs (
+    doc_id INTEGER PRIMARY KEY,
+    reference_key TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    -- 1 for notes still there, 0 for removed ones whose postings are still
+    -- counted in document frequencies of the search index, -1 once they aren't
+    alive INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS search_docs_paper ON search_docs (reference_key);
+"""
+
+# Values bound in a single query stay below the limit of old SQLite versions
+MAX_QUERY_PARAMETERS = 900
+
+# Columns added after the first version, with their types, added to
+# manifests created before them
+ADDED_COLUMNS = {
+    "raw_token_count": "INTEGER",
+    "notes_attempts": "INTEGER",
+    "deduped_at": "REAL",
+}
+
+
+class Manifest:
+    """State of every paper in the pipeline kept in a single SQLite file
+
+    Every update is a separate transaction, so after a crash the manifest
+    tells exactly which stage every paper reached. The connection is shared
+    between threads (extraction runs in a thread next to note generation),
+    so all the access goes through a lock
+    """
+
+    def __init__(self, path: str = MANIFEST_FILE):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+            columns = {r["name"] for r in self.connection.execute("PRAGMA table_info(papers)")}
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE papers ADD COLUMN {column} {column_type}")
+
+    def close(self):
+        self.connection.close()
+
+    def _execute(self, query: str, parameters: tuple = ()) -> list[sqlite3.Row]:
+        with self.lock, self.connection:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def _execute_many(self, query: str, parameters: list[tuple]):
+        with self.lock, self.connection:
+            self.connection.executemany(query, parameters)
+
+    def is_empty(self) -> bool:
+        return len(self._execute("SELECT 1 FROM papers LIMIT 1")) == 0
+
+    ################ Resolve ##############################################
+
+    def record_resolution(self, reference_key_map: dict[str, str]):
+        """Stores PDF names of reference keys"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO papers (reference_key, pdf_name) VALUES (?, ?)
+                ON CONFLICT (reference_key) DO UPDATE SET pdf_name = excluded.pdf_name
+                """,
+                [(key, pdf) for pdf, key in reference_key_map.items()],
+            )
+
+    def remove(self, reference_key: str):
+        self._execute("DELETE FROM papers WHERE reference_key = ?", (reference_key,))
+        self.forget_notes(reference_key)
+
+    ################ Extraction ###########################################
+
+    def is_extracted(self, reference_key: str, pdf_hash: str) -> bool:
+        rows = self._execute(
+            "SELECT 1 FROM papers WHERE reference_key = ? AND pdf_hash = ? AND extraction_status = ?",
+            (reference_key, pdf_hash, Status.DONE.value),
+        )
+        return len(rows) > 0
+
+    def record_extraction(
+        self,
+        reference_key: str,
+        pdf_hash: str,
+        token_count: int,
+        seconds: float | None = None,
+        raw_token_count: int | None = None,
+    ):
+        """Marks paper as extracted. Notes of a changed PDF have to be generated again"""
+        self._execute(
+            """
+            INSERT INTO papers (reference_key, pdf_hash, extraction_status, token_count, raw_token_count, extraction_seconds, extracted_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (reference_key) DO UPDATE SET
+                notes_status = CASE WHEN papers.pdf_hash IS excluded.pdf_hash OR papers.pdf_hash IS NULL
+                               THEN papers.notes_status ELSE 'pending' END,
+                pdf_hash = excluded.pdf_hash,
+                extraction_status = excluded.extraction_status,
+                token_count = excluded.token_count,
+                raw_token_count = excluded.raw_token_count,
+                extraction_seconds = excluded.extraction_seconds,
+                extracted_at = excluded.extracted_at,
+                error = NULL
+            """,
+            (reference_key, pdf_hash, Status.DONE.value, token_count, raw_token_count, seconds, time.time()),
+        )
+
+    def record_extraction_failure(self, reference_key: str, error: str):
+        self._execute(
+            """
+            INSERT INTO papers (reference_key, extraction_status, error) VALUES (?, ?, ?)
+            ON CONFLICT (reference_key) DO UPDATE SET
+                extraction_status = excluded.extraction_status, error = excluded.error
+            """,
+            (reference_key, Status.FAILED.value, error),
+        )
+
+    def token_count(self, reference_key: str) -> int:
+        rows = self._execute(
+            "SELECT token_count FROM papers WHERE reference_key = ?", (reference_key,)
+        )
+        if len(rows) == 0 or rows[0]["token_count"] is None:
+            raise KeyError(f"No token count for {reference_key}, extract it first")
+        return rows[0]["token_count"]
+
+    def extracted_keys(self) -> list[str]:
+        """Reference keys of all extracted papers, largest first"""
+        rows = self._execute(
+            "SELECT reference_key FROM papers WHERE extraction_status = ? ORDER BY token_count DESC",
+            (Status.DONE.value,),
+        )
+        return [r["reference_key"] for r in rows]
+
+    def oversized(self, max_tokens: float) -> list[tuple[str, int]]:
+        rows = self._execute(
+            "SELECT reference_key, token_count FROM papers WHERE extraction_status = ? AND token_count > ?",
+            (Status.DONE.value, max_tokens),
+        )
+        return [(r["reference_key"], r["token_count"]) for r in rows]
+
+    ################ Notes ################################################
+
+    def notes_status(self, reference_key: str) -> Status:
+        rows = self._execute(
+            "SELECT notes_status FROM papers WHERE reference_key = ?", (reference_key,)
+        )
+        if len(rows) == 0:
+            return Status.PENDING
+        return Status(rows[0]["notes_status"])
+
+    def note_count(self, reference_key: str) -> int:
+        rows = self._execute(
+            "SELECT note_count FROM papers WHERE reference_key = ?", (reference_key,)
+        )
+        if len(rows) == 0 or rows[0]["note_count"] is None:
+            return 0
+        return rows[0]["note_count"]
+
+    def record_notes_started(self, reference_key: str):
+        self._execute(
+            "UPDATE papers SET notes_status = ?, notes_started_at = ?, error = NULL WHERE reference_key = ?",
+            (Status.IN_PROGRESS.value, time.time(), reference_key),
+        )
+
+    def record_notes_done(self, reference_key: str, note_count: int, seconds: float):
+        self._execute(
+            """
+            UPDATE papers SET notes_status = ?, notes_finished_at = ?, notes_seconds = ?, note_count = ?
+            WHERE reference_key = ?
+            """,
+            (Status.DONE.value, time.time(), seconds, note_count, reference_key),
+        )
+
+    def record_notes_failure(self, reference_key: str, error: str, attempts: int = 1):
+        """Puts the paper on the dead-letter list, see `failed_notes`"""
+        self._execute(
+            "UPDATE papers SET notes_status = ?, error = ?, notes_attempts = ? WHERE reference_key = ?",
+            (Status.FAILED.value, error, attempts, reference_key),
+        )
+
+    def failed_notes(self) -> list[tuple[str, str, int]]:
+        """Reference key, last error and number of attempts of every paper
+        whose notes failed
+        """
+        rows = self._execute(
+            "SELECT reference_key, error, notes_attempts FROM papers WHERE notes_status = ? ORDER BY reference_key",
+            (Status.FAILED.value,),
+        )
+        return [(r["reference_key"], r["error"], r["notes_attempts"] or 1) for r in rows]
+
+    ################ Note index ###########################################
+
+    # Every note file and the targets of its [[links]]. Notes are added one by
+    # one as they are written, so keeping the index costs nothing per paper
+    # beyond its own notes. Names compare case-insensitively, as links do
+
+    def has_note_index(self) -> bool:
+        return len(self._execute("SELECT 1 FROM notes LIMIT 1")) > 0
+
+    def add_note(self, reference_key: str, title: str, file_name: str, links: list[str]) -> str:
+        """Indexes a note, returns the file name it has to be written under.
+        A name taken by a note of another paper, or by another note of the
+        same paper, gets the reference key appended
+        """
+        def is_taken(name: str) -> bool:
+            return self.connection.execute(
+                "SELECT 1 FROM notes WHERE file_name = ? LIMIT 1", (name,)
+            ).fetchone() is not None
+
+        with self.lock, self.connection:
+            if is_taken(file_name):
+                file_name = next(n for n in colliding_names(file_name, reference_key) if not is_taken(n))
+            self.connection.execute(
+                "INSERT INTO notes (reference_key, file_name, title) VALUES (?, ?, ?)",
+                (reference_key, file_name, title),
+            )
+            self.connection.executemany(
+                "INSERT INTO links (source, target) VALUES (?, ?)", [(file_name, t) for t in links]
+            )
+        return file_name
+
+    def renamed_notes(self, reference_key: str) -> dict[str, str]:
+        """Lowercased title to file name of the notes of the paper stored
+        under another name than their title
+        """
+        rows = self._execute(
+            "SELECT title, file_name FROM notes WHERE reference_key = ? AND file_name != title COLLATE BINARY",
+            (reference_key,),
+        )
+        return {r["title"].lower(): r["file_name"] for r in rows}
+
+    def retarget_links(self, reference_key: str, title: str, file_name: str) -> list[str]:
+        """Points links of the paper's notes to `title` to the note stored as
+        `file_name`, returns names of the notes that have to be rewritten
+        """
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                """
+                SELECT DISTINCT source FROM links WHERE target = ?
+                AND source IN (SELECT file_name FROM notes WHERE reference_key = ?) AND source != ?
+                """,
+                (title, reference_key, file_name),
+            ).fetchall()
+            sources = [r["source"] for r in rows]
+            self.connection.executemany(
+                "UPDATE links SET target = ? WHERE source = ? AND target = ?",
+                [(file_name, source, title) for source in sources],
+            )
+        return sources
+
+    def forget_notes(self, reference_key: str):
+        """Removes notes of the paper from the index, before they are written again"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM links WHERE source IN (SELECT file_name FROM notes WHERE reference_key = ?)",
+                (reference_key,),
+            )
+            self.connection.execute("DELETE FROM notes WHERE reference_key = ?", (reference_key,))
+            self.connection.execute("DELETE FROM note_signatures WHERE reference_key = ?", (reference_key,))
+            self.connection.execute("DELETE FROM note_bands WHERE reference_key = ?", (reference_key,))
+            self.connection.execute("UPDATE papers SET deduped_at = NULL WHERE reference_key = ?", (reference_key,))
+            self.connection.execute("UPDATE search_docs SET alive = 0 WHERE reference_key = ?", (reference_key,))
+
+    def forget_note(self, reference_key: str, file_name: str):
+        """Removes a single note, with the links from it, from the index"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM links WHERE source = ?", (file_name,))
+            for table in ["notes", "note_signatures", "note_bands"]:
+                self.connection.execute(
+                    f"DELETE FROM {table} WHERE reference_key = ? AND file_name = ?", (reference_key, file_name)
+                )
+            self.connection.execute(
+                "UPDATE search_docs SET alive = 0 WHERE reference_key = ? AND file_name = ?", (reference_key, file_name)
+            )
+
+    def note_files(self, reference_key: str) -> list[str]:
+        rows = self._execute(
+            "SELECT file_name FROM notes WHERE reference_key = ? ORDER BY file_name", (reference_key,)
+        )
+        return [r["file_name"] for r in rows]
+
+    def add_links(self, source: str, targets: list[str]):
+        self._execute_many(
+            """
+            INSERT INTO links (source, target) SELECT ?1, ?2
+            WHERE NOT EXISTS (SELECT 1 FROM links WHERE source = ?1 AND target = ?2)
+            """,
+            [(source, t) for t in targets],
+        )
+
+    def redirect_links(self, file_name: str, target: str) -> list[tuple[str, str]]:
+        """Points all the links to `file_name` to `target`, returns reference
+        key and file name of every note that has to be rewritten
+        """
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                """
+                SELECT DISTINCT n.reference_key, n.file_name FROM links l
+                JOIN notes n ON n.file_name = l.source WHERE l.target = ?
+                """,
+                (file_name,),
+            ).fetchall()
+            self.connection.execute("UPDATE links SET target = ? WHERE target = ?", (target, file_name))
+        return [(r["reference_key"], r["file_name"]) for r in rows]
+
+    def broken_links(self) -> list[tuple[str, str, str]]:
+        """Reference key, note and target of every link pointing neither to a
+        note nor to a paper
+        """
+        rows = self._execute(
+            """
+            SELECT n.reference_key, l.source, l.target FROM links l
+            JOIN notes n ON n.file_name = l.source
+            WHERE NOT EXISTS (SELECT 1 FROM notes t WHERE t.file_name = l.target)
+            AND NOT EXISTS (SELECT 1 FROM papers p WHERE p.reference_key = l.target COLLATE NOCASE)
+            ORDER BY n.reference_key, l.source
+            """
+        )
+        return [(r["reference_key"], r["source"], r["target"]) for r in rows]
+
+    def orphan_notes(self) -> list[tuple[str, str]]:
+        """Reference key and file name of every note no other note links to"""
+        rows = self._execute(
+            """
+            SELECT reference_key, file_name FROM notes n
+            WHERE NOT EXISTS (SELECT 1 FROM links l WHERE l.target = n.file_name AND l.source != n.file_name)
+            ORDER BY reference_key, file_name
+            """
+        )
+        return [(r["reference_key"], r["file_name"]) for r in rows]
+
+    def link_summary(self) -> tuple[int, int]:
+        """Number of indexed notes and links"""
+        notes = self._execute("SELECT COUNT(*) AS count FROM notes")[0]["count"]
+        links = self._execute("SELECT COUNT(*) AS count FROM links")[0]["count"]
+        return notes, links
+
+    ################ Deduplication ########################################
+
+    # MinHash signature of every note and the LSH bucket of each of its bands.
+    # Notes sharing a bucket in any band are candidate duplicates
+
+    def add_signatures(self, reference_key: str, signatures: list[tuple[str, bytes, list[int]]]):
+        """Stores file name, signature and band buckets of notes of the paper"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO note_signatures (reference_key, file_name, signature) VALUES (?, ?, ?)",
+                [(reference_key, file_name, signature) for file_name, signature, _ in signatures],
+            )
+            self.connection.executemany(
+                "INSERT INTO note_bands (band, bucket, reference_key, file_name) VALUES (?, ?, ?, ?)",
+                [
+                    (band, bucket, reference_key, file_name)
+                    for file_name, _, buckets in signatures
+                    for band, bucket in enumerate(buckets)
+                ],
+            )
+
+    def dedup_candidates(self, reference_key: str, buckets: list[int]) -> list[tuple[str, str, bytes]]:
+        """Reference key, file name and signature of notes of other papers
+        sharing a bucket in any band
+        """
+        bands = ", ".join(["(?, ?)"] * len(buckets))
+        rows = self._execute(
+            f"""
+            WITH query (band, bucket) AS (VALUES {bands})
+            SELECT s.reference_key, s.file_name, s.signature FROM note_signatures s
+            JOIN (
+                SELECT DISTINCT b.reference_key, b.file_name FROM query q
+                JOIN note_bands b ON b.band = q.band AND b.bucket = q.bucket
+                WHERE b.reference_key != ?
+            ) c ON c.reference_key = s.reference_key AND c.file_name = s.file_name
+            """,
+            tuple(v for band, bucket in enumerate(buckets) for v in (band, bucket)) + (reference_key,),
+        )
+        return [(r["reference_key"], r["file_name"], r["signature"]) for r in rows]
+
+    def record_dedup(self, reference_key: str):
+        self._execute("UPDATE papers SET deduped_at = ? WHERE reference_key = ?", (time.time(), reference_key))
+
+    def undeduped_keys(self) -> list[str]:
+        """Papers with notes not compared with the other papers yet, in the order notes were made"""
+        rows = self._execute(
+            "SELECT reference_key FROM papers WHERE notes_status = ? AND deduped_at IS NULL ORDER BY notes_finished_at",
+            (Status.DONE.value,),
+        )
+        return [r["reference_key"] for r in rows]
+
+    def reset_dedup(self):
+        """Drops all the signatures, so every paper is compared again"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM note_signatures")
+            self.connection.execute("DELETE FROM note_bands")
+            self.connection.execute("UPDATE papers SET deduped_at = NULL")
+
+    ################ Search ###############################################
+
+    # Every note in the search index under its id. Removed notes stay as dead
+    # ids, their postings are dropped from the index when it gets compacted
+
+    def note_keys(self) -> list[str]:
+        """Papers with indexed notes"""
+        return [r["reference_key"] for r in self._execute("SELECT DISTINCT reference_key FROM notes")]
+
+    def add_search_docs(self, reference_key: str, file_names: list[str]) -> list[int]:
+        """Ids of the notes added to the search index"""
+        with self.lock, self.connection:
+            return [
+                self.connection.execute(
+                    "INSERT INTO search_docs (reference_key, file_name) VALUES (?, ?)", (reference_key, file_name)
+                ).lastrowid
+                for file_name in file_names
+            ]
+
+    def forget_search_docs(self, reference_key: str) -> list[int]:
+        """Removes notes of the paper, returns ids of those still counted in
+        document frequencies, which the caller stops counting
+        """
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT doc_id FROM search_docs WHERE reference_key = ? AND alive >= 0", (reference_key,)
+            ).fetchall()
+            self.connection.execute("UPDATE search_docs SET alive = -1 WHERE reference_key = ?", (reference_key,))
+        return [r["doc_id"] for r in rows]
+
+    def discount_search_docs(self):
+        """Removed notes stop being counted once compaction drops their postings"""
+        self._execute("UPDATE search_docs SET alive = -1 WHERE alive = 0")
+
+    def search_doc_counts(self) -> tuple[int, int]:
+        """Largest note id and number of notes. Notes are counted in the note
+        index, counting ids still there would scan the whole table
+        """
+        last = self._execute("SELECT MAX(doc_id) AS last FROM search_docs")[0]["last"]
+        notes = self._execute("SELECT COUNT(*) AS count FROM notes")[0]["count"]
+        return last or 0, notes
+
+    def alive_search_docs(self) -> list[int]:
+        return [r["doc_id"] for r in self._execute("SELECT doc_id FROM search_docs WHERE alive = 1")]
+
+    def search_docs(self, doc_ids: list[int]) -> dict[int, tuple[str, str]]:
+        """Reference key and file name of the notes with the ids that are still there"""
+        notes = {}
+        for start in range(0, len(doc_ids), MAX_QUERY_PARAMETERS):
+            batch = doc_ids[start: start + MAX_QUERY_PARAMETERS]
+            rows = self._execute(
+                f"SELECT doc_id, reference_key, file_name FROM search_docs WHERE alive = 1 AND doc_id IN ({', '.join(['?'] * len(batch))})",
+                tuple(batch),
+            )
+            notes.update({r["doc_id"]: (r["reference_key"], r["file_name"]) for r in rows})
+        return notes
+
+    def reset_search(self):
+        self._execute("DELETE FROM search_docs")
+
+    ################ Status ###############################################
+
+    def summary(self) -> dict[str, dict[str, int]]:
+        """Number of papers in every status of every stage"""
+        result = {}
+        for column in ["extraction_status", "notes_status"]:
+            rows = self._execute(
+                f"SELECT {column} AS status, COUNT(*) AS count FROM papers GROUP BY {column}"
+            )
+            result[column] = {r["status"]: r["count"] for r in rows}
+        return result
+
+    def compaction_savings(self) -> tuple[int, int]:
+        """Tokens of all the extracted papers before compaction and tokens saved by it"""
+        rows = self._execute(
+            """
+            SELECT SUM(raw_token_count) AS raw, SUM(raw_token_count - token_count) AS saved
+            FROM papers WHERE extraction_status = ? AND raw_token_count IS NOT NULL
+            """,
+            (Status.DONE.value,),
+        )
+        return rows[0]["raw"] or 0, rows[0]["saved"] or 0
+
+    def failures(self) -> list[tuple[str, str]]:
+        rows = self._execute(
+            "SELECT reference_key, error FROM papers WHERE extraction_status = ? OR notes_status = ?",
+            (Status.FAILED.value, Status.FAILED.value),
+        )
+        return [(r["reference_key"], r["error"]) for r in rows]
+
+    ################ Migration ############################################
+
+    def import_notes(self, notes_folder: str):
+        """Fills empty note index from notes written before it existed. Names
+        are taken as they are, even where they collide
+        """
+        if not os.path.isdir(notes_folder):
+            return
+        notes = []
+        links = []
+        for reference_key in os.listdir(notes_folder):
+            path_for_notes = os.path.join(notes_folder, reference_key)
+            if not os.path.isdir(path_for_notes):
+                continue
+            for f in os.listdir(path_for_notes):
+                file_name, extension = os.path.splitext(f)
+                if extension != ".md":
+                    continue
+                title, targets = read_note(os.path.join(path_for_notes, f))
+                notes.append((reference_key, file_name, title))
+                links += [(file_name, t) for t in targets]
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO notes (reference_key, file_name, title) VALUES (?, ?, ?)", notes
+            )
+            self.connection.executemany("INSERT INTO links (source, target) VALUES (?, ?)", links)
+
+    def import_folders(self, extracted_folder: str, token_folder: str, notes_folder: str):
+        """Fills empty manifest from folders of previous versions, where state
+        was only kept as .txt, .token files and notes folders
+        """
+        if not os.path.isdir(extracted_folder) or not os.path.isdir(token_folder):
+            return
+        rows = []
+        for f in os.listdir(token_folder):
+            reference_key, extension = os.path.splitext(f)
+            if extension != ".token":
+                continue
+            if not os.path.isfile(os.path.join(extracted_folder, reference_key + ".txt")):
+                continue
+            with open(os.path.join(token_folder, f), "r") as token_file:
+                token_count = int(json.load(token_file)["tokens"])
+
+            path_for_notes = os.path.join(notes_folder, reference_key)
+            note_count = 0
+            if os.path.isdir(path_for_notes):
+                note_count = len([n for n in os.listdir(path_for_notes) if n.endswith(".md")])
+            notes_status = Status.DONE if note_count > 0 else Status.PENDING
+            rows.append((reference_key, Status.DONE.value, token_count, notes_status.value, note_count or None))
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT OR IGNORE INTO papers (reference_key, extraction_status, token_count, notes_status, note_count)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
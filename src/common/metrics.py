@@ -0,0 +1,199 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Iterator
+
+from common.config import METRICS_PROMETHEUS_FILE, METRICS_REPORT_FILE
+
+# Upper bounds in seconds of request latency histogram buckets
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+
+PROMETHEUS_PREFIX = "the_thing"
+
+
+@dataclass
+class Timer:
+    """Total time spent in a stage and how many items it processed"""
+    seconds: float = 0.0
+    count: int = 0
+
+
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...] = LATENCY_BUCKETS
+    # Observations falling into each bucket, the last one is +Inf
+    counts: list[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+    count: int = 0
+    sum: float = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the `q` quantile"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Counters of a single run, shared by all the stages
+
+    Stage timers accumulate time per processed item (paper, request, note),
+    so the report shows which of pymupdf, the tokenizer or the provider the
+    run is bound by. Extraction runs in a thread next to note generation, so
+    all updates go through a lock
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.stages: dict[str, Timer] = {}
+        self.request_latency = Histogram()
+        self.first_token_latency = Histogram()
+        self.counters: dict[str, int] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.concurrency_limit: float | None = None
+        self.usage: dict[str, float] = {}
+
+    ################ Recording ############################################
+
+    def observe(self, stage: str, seconds: float, count: int = 1):
+        with self.lock:
+            timer = self.stages.setdefault(stage, Timer())
+            timer.seconds += seconds
+            timer.count += count
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe_request(self, seconds: float, first_token_seconds: float | None = None):
+        with self.lock:
+            self.request_latency.observe(seconds)
+            if first_token_seconds is not None:
+                self.first_token_latency.observe(first_token_seconds)
+
+    def increment(self, counter: str, by: int = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + by
+
+    def request_started(self, concurrency_limit: float):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.concurrency_limit = concurrency_limit
+
+    def request_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def record_usage(self, usage):
+        """Adds up token usage and cost of a finished client"""
+        with self.lock:
+            for name, value in asdict(usage).items():
+                self.usage[name] = self.usage.get(name, 0) + value
+
+    def is_empty(self) -> bool:
+        return len(self.stages) == 0 and self.request_latency.count == 0
+
+    ################ Export ###############################################
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "started_at": self.started_at,
+                "seconds": time.time() - self.started_at,
+                "stages": {name: asdict(timer) for name, timer in self.stages.items()},
+                "requests": {
+                    "count": self.request_latency.count,
+                    "seconds": self.request_latency.sum,
+                    "p50_seconds": self.request_latency.quantile(0.5),
+                    "p95_seconds": self.request_latency.quantile(0.95),
+                    "p95_first_token_seconds": self.first_token_latency.quantile(0.95),
+                    "histogram": dict(zip([*map(str, LATENCY_BUCKETS), "+Inf"], self.request_latency.counts)),
+                    "max_in_flight": self.max_in_flight,
+                    "final_concurrency_limit": self.concurrency_limit,
+                },
+                "counters": dict(self.counters),
+                "usage": dict(self.usage),
+            }
+
+    def prometheus(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        p = PROMETHEUS_PREFIX
+        lines = []
+        with self.lock:
+            lines.append(f"# HELP {p}_stage_seconds_total Time spent in a stage")
+            lines.append(f"# TYPE {p}_stage_seconds_total counter")
+            for name, timer in self.stages.items():
+                lines.append(f'{p}_stage_seconds_total{{stage="{name}"}} {timer.seconds}')
+            lines.append(f"# HELP {p}_stage_items_total Items processed by a stage")
+            lines.append(f"# TYPE {p}_stage_items_total counter")
+            for name, timer in self.stages.items():
+                lines.append(f'{p}_stage_items_total{{stage="{name}"}} {timer.count}')
+
+            for metric, histogram in [
+                ("request_seconds", self.request_latency),
+                ("first_token_seconds", self.first_token_latency),
+            ]:
+                lines.append(f"# TYPE {p}_{metric} histogram")
+                cumulative = 0
+                for bound, count in zip([*map(str, histogram.buckets), "+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{p}_{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{p}_{metric}_sum {histogram.sum}")
+                lines.append(f"{p}_{metric}_count {histogram.count}")
+
+            lines.append(f"# TYPE {p}_events_total counter")
+            for name, value in self.counters.items():
+                lines.append(f'{p}_events_total{{event="{name}"}} {value}')
+            lines.append(f"# TYPE {p}_max_in_flight_requests gauge")
+            lines.append(f"{p}_max_in_flight_requests {self.max_in_flight}")
+            lines.append(f"# TYPE {p}_usage_total counter")
+            for name, value in self.usage.items():
+                lines.append(f'{p}_usage_total{{kind="{name}"}} {value}')
+            lines.append(f"# TYPE {p}_last_run_timestamp_seconds gauge")
+            lines.append(f"{p}_last_run_timestamp_seconds {self.started_at}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, report_path: str | None = METRICS_REPORT_FILE, prometheus_path: str | None = METRICS_PROMETHEUS_FILE):
+        if report_path:
+            _write_atomically(report_path, json.dumps(self.report(), indent=4))
+        if prometheus_path:
+            # Textfile collector may read the file at any moment
+            _write_atomically(prometheus_path, self.prometheus())
+
+
+def _write_atomically(path: str, content: str):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# Metrics of the current run
+metrics = Metrics()
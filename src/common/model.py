@@ -1,11 +1,23 @@
-from dataclasses import dataclass
+import hashlib
+import importlib.util
+import json
+import os
+import time
+from dataclasses import dataclass, fields
 from enum import Enum
+from typing import AsyncIterator
 
 import httpx
 import requests
 from dataclasses_json import dataclass_json
 
-from common.config import OPENROUTER_API_KEY, OPENROUTER_URL
+from common.config import (HTTP2_ENABLED, HTTP_CONNECT_TIMEOUT, HTTP_KEEPALIVE_EXPIRY,
+                           HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                           HTTP_POOL_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_WRITE_TIMEOUT,
+                           OPENROUTER_API_KEY, OPENROUTER_URL, RESPONSE_CACHE_FOLDER,
+                           RESPONSE_CACHE_MAX_AGE_DAYS, RESPONSE_CACHE_MAX_BYTES)
+from common.metrics import metrics
+from common.prompts import PROMPT_VERSION
 
 
 class Model(Enum):
@@ -16,6 +28,16 @@ class Model(Enum):
     DeepSeekR1 = "deepseek/deepseek-r1"
 
 
+# Maximal input plus output tokens of every model
+CONTEXT_WINDOWS = {
+    Model.OpenAI_4o: 128_000,
+    Model.OpenAI_o1: 128_000,
+    Model.GeminiFlash: 1_048_576,
+    Model.GeminiFlashThinking: 1_048_576,
+    Model.DeepSeekR1: 163_840,
+}
+
+
 class Role(Enum):
     SYSTEM = "system"
     USER = "user"
@@ -27,6 +49,9 @@ class Role(Enum):
 class Message:
     role: Role
     content: str
+    # Marks the end of static prompt prefix for providers which need explicit
+    # prompt caching breakpoints
+    cache_breakpoint: bool = False
 
 
 @dataclass_json
@@ -34,25 +59,298 @@ class Message:
 class Request:
     model: Model
     messages: list[Message]
+    stream: bool = False
+
+    def to_body(self) -> str:
+        """JSON body of /chat/completions request"""
+        messages = []
+        for m in self.messages:
+            content: str | list[dict] = m.content
+            if m.cache_breakpoint:
+                content = [{"type": "text", "text": m.content, "cache_control": {"type": "ephemeral"}}]
+            messages.append({"role": m.role.value, "content": content})
+        return json.dumps({
+            "model": self.model.value,
+            "messages": messages,
+            "stream": self.stream,
+            # Asks open router to report cached prompt tokens
+            "usage": {"include": True},
+        })
+
+
+@dataclass
+class Usage:
+    """Tokens reported by the provider over all the requests of a client"""
+    requests: int = 0
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # In credits, reported by open router when usage accounting is on
+    cost: float = 0.0
+
+    def add(self, usage: dict | None):
+        if not usage:
+            return
+        self.requests += 1
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.completion_tokens += usage.get("completion_tokens") or 0
+        details = usage.get("prompt_tokens_details") or {}
+        self.cached_prompt_tokens += details.get("cached_tokens") or 0
+        self.cost += usage.get("cost") or 0
+
+    def since(self, earlier: "Usage") -> "Usage":
+        """Usage added after `earlier` was copied from this one"""
+        return Usage(**{f.name: getattr(self, f.name) - getattr(earlier, f.name) for f in fields(Usage)})
+
+    def __str__(self) -> str:
+        cached_share = self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0
+        return (
+            f"{self.requests} requests, {self.prompt_tokens} prompt tokens "
+            f"({self.cached_prompt_tokens} cached, {cached_share:.0%}), "
+            f"{self.completion_tokens} completion tokens, cost {self.cost:.4f}"
+        )
+
+
+def _normalize(content: str) -> str:
+    return "\n".join(line.rstrip() for line in content.strip().splitlines())
+
+
+class ResponseCache:
+    """On-disk cache of model outputs
+
+    Key is a hash of model, prompt version and normalized non-system
+    messages. System prompt is covered by PROMPT_VERSION, which has to be
+    bumped whenever prompts change. Entries are evicted when not used for
+    RESPONSE_CACHE_MAX_AGE_DAYS or, least recently used first, when the cache
+    grows over RESPONSE_CACHE_MAX_BYTES
+
+    Args:
+    read (bool): Return cached responses, False means every request goes to the API
+    write (bool): Store new responses
+    """
+
+    def __init__(self, folder: str = RESPONSE_CACHE_FOLDER, read: bool = True, write: bool = True):
+        self.folder = folder
+        self.read = read
+        self.write = write
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+        self.evict()
+
+    def key(self, request: Request) -> str:
+        payload = {
+            "model": request.model.value,
+            "prompt_version": PROMPT_VERSION,
+            "messages": [
+                (m.role.value, _normalize(m.content))
+                for m in request.messages
+                if m.role != Role.SYSTEM
+            ],
+        }
+        return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".json")
+
+    def has(self, request: Request) -> bool:
+        """Whether `get` would return a stored response, without counting it"""
+        return self.read and os.path.isfile(self._path(self.key(request)))
+
+    def get(self, request: Request) -> dict | None:
+        """Returns stored {"content": ..., "usage": ...} of the request"""
+        if not self.read:
+            return None
+        path = self._path(self.key(request))
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        # Access time drives LRU eviction
+        os.utime(path)
+        self.hits += 1
+        return entry
 
+    def put(self, request: Request, content: str, usage: dict | None = None):
+        if not self.write:
+            return
+        path = self._path(self.key(request))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"content": content, "usage": usage}, f)
+        os.replace(tmp_path, path)
 
-async def call(request: Request):
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    def evict(self):
+        entries = []
+        oldest_allowed = time.time() - RESPONSE_CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            stat = os.stat(path)
+            if stat.st_mtime < oldest_allowed:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{OPENROUTER_URL}/chat/completions",
-            headers=headers,
-            data=request.to_json(),
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= RESPONSE_CACHE_MAX_BYTES:
+                break
+            os.remove(path)
+            total_size -= size
+
+
+class Client:
+    """Long-lived connection pool to open router shared by all the requests
+
+    Usage:
+        async with Client() as client:
+            await call(request, client)
+    """
+
+    def __init__(self, cache: ResponseCache | None = None):
+        self._client: httpx.AsyncClient | None = None
+        self.cache = cache
+        self.usage = Usage()
+
+    async def __aenter__(self) -> "Client":
+        self._client = httpx.AsyncClient(
+            base_url=OPENROUTER_URL,
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            # HTTP/2 requires optional `h2` package, fall back to HTTP/1.1 keep-alive
+            http2=HTTP2_ENABLED and importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=HTTP_CONNECT_TIMEOUT,
+                read=HTTP_READ_TIMEOUT,
+                write=HTTP_WRITE_TIMEOUT,
+                pool=HTTP_POOL_TIMEOUT,
+            ),
         )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("Client is not opened, use it as `async with Client()`")
+        return self._client
+
+
+class EmptyResponseError(Exception):
+    """Answer of the provider has no content, the same request usually succeeds later"""
+
+
+class IncompleteStreamError(Exception):
+    """Stream ended before the provider sent [DONE], the answer may be cut off"""
+
+
+async def call(request: Request, client: Client):
+    if client.cache is not None:
+        cached = client.cache.get(request)
+        if cached is not None:
+            metrics.increment("response_cache_hits")
+            return {
+                "choices": [{"message": {"content": cached["content"]}}],
+                "usage": cached["usage"],
+                "cached": True,
+            }
+
+    start = time.perf_counter()
+    response = await client.http.post(
+        "/chat/completions",
+        content=request.to_body(),
+    )
+    metrics.observe_request(time.perf_counter() - start)
+    if response.status_code != 200:
+        raise httpx.HTTPStatusError(
+            f"Request failed with status {response.status_code}: {response.text}",
+            request=response.request,
+            response=response,
+        )
+
+    result = response.json()
+    client.usage.add(result.get("usage"))
+    if client.cache is not None:
+        try:
+            client.cache.put(request, result["choices"][0]["message"]["content"], result.get("usage"))
+        except (KeyError, IndexError):
+            pass
+    return result
+
+
+async def stream(request: Request, client: Client) -> AsyncIterator[str]:
+    """Calls the model in server-sent events mode, yielding content chunks as
+    they arrive. A cached response is yielded as a single chunk
+    """
+    if client.cache is not None:
+        cached = client.cache.get(request)
+        if cached is not None:
+            metrics.increment("response_cache_hits")
+            yield cached["content"]
+            return
+
+    request.stream = True
+    received: list[str] = []
+    usage = None
+    completed = False
+    start = time.perf_counter()
+    first_token_seconds = None
+    async with client.http.stream(
+        "POST",
+        "/chat/completions",
+        content=request.to_body(),
+    ) as response:
         if response.status_code != 200:
+            await response.aread()
             raise httpx.HTTPStatusError(
                 f"Request failed with status {response.status_code}: {response.text}",
                 request=response.request,
                 response=response,
             )
 
-        return response.json()
+        async for line in response.aiter_lines():
+            # Lines starting with ":" are keep-alive comments
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                completed = True
+                break
+            event = json.loads(data)
+            if "error" in event:
+                raise httpx.HTTPStatusError(
+                    f"Stream failed: {event['error']}",
+                    request=response.request,
+                    response=response,
+                )
+            usage = event.get("usage") or usage
+            choices = event.get("choices") or []
+            if len(choices) == 0:
+                continue
+            content = choices[0].get("delta", {}).get("content")
+            if content:
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - start
+                received.append(content)
+                yield content
+
+    metrics.observe_request(time.perf_counter() - start, first_token_seconds)
+    client.usage.add(usage)
+    if not completed:
+        raise IncompleteStreamError(f"Stream ended after {len(received)} chunks without [DONE]")
+
+    if client.cache is not None:
+        client.cache.put(request, "".join(received), usage)
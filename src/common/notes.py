@@ -0,0 +1,93 @@
+import re
+
+NOTE_SEPARATOR = "---"
+
+# Raw output of a paper which is still being streamed, lives in its notes folder
+PARTIAL_STREAM_FILE = ".stream.partial"
+
+# Raw output of a single chunk of a long paper waiting for the merge pass
+CHUNK_OUTPUT_PREFIX = ".chunk-"
+
+# Several small papers sent in one request are delimited by these lines, both
+# in the request and in the response, numbered from 1
+PACKED_PAPER_HEADER = "=== PAPER {} ==="
+PACKED_NOTES_HEADER = "=== NOTES {} ==="
+PACKED_NOTES_HEADER_PATTERN = re.compile(r"^\W*=== NOTES (\d+) ===\W*$")
+
+
+class NoteParser:
+    """Incrementally splits model output into notes separated by `---`
+
+    Chunks of any size are fed in, every note is returned as soon as its
+    closing separator arrives, so only the note being generated is kept in
+    memory
+    """
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, chunk: str) -> list[str]:
+        self.buffer += chunk
+        parts = self.buffer.split(NOTE_SEPARATOR)
+        # Last part is either incomplete note or a prefix of the separator
+        self.buffer = parts.pop()
+        return [p.strip() for p in parts]
+
+    def close(self) -> list[str]:
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+
+class PackParser:
+    """Incrementally splits output of a packed request into notes of every
+    paper. Notes of paper `i` follow `PACKED_NOTES_HEADER` line with `i`,
+    anything before the first header is dropped
+
+    Returns pairs of paper index (from 0) and a note
+    """
+
+    def __init__(self, papers: int):
+        self.line_buffer = ""
+        self.current: int | None = None
+        self.parsers = [NoteParser() for _ in range(papers)]
+
+    def _feed_current(self, text: str) -> list[tuple[int, str]]:
+        if self.current is None:
+            return []
+        return [(self.current, note) for note in self.parsers[self.current].feed(text)]
+
+    def _close_current(self) -> list[tuple[int, str]]:
+        if self.current is None:
+            return []
+        return [(self.current, note) for note in self.parsers[self.current].close()]
+
+    def feed(self, chunk: str) -> list[tuple[int, str]]:
+        self.line_buffer += chunk
+        *lines, self.line_buffer = self.line_buffer.split("\n")
+        notes = []
+        for line in lines:
+            header = PACKED_NOTES_HEADER_PATTERN.match(line)
+            if header is None:
+                notes += self._feed_current(line + "\n")
+                continue
+            notes += self._close_current()
+            index = int(header.group(1)) - 1
+            self.current = index if 0 <= index < len(self.parsers) else None
+        return notes
+
+    def close(self) -> list[tuple[int, str]]:
+        notes = self._feed_current(self.line_buffer)
+        self.line_buffer = ""
+        return notes + self._close_current()
+
+
+def split_resumable(partial_content: str) -> tuple[str, str]:
+    """Splits partially streamed output into the part with all complete notes
+    (already written to disk) and the incomplete note after the last separator
+    """
+    last_separator = partial_content.rfind(NOTE_SEPARATOR)
+    if last_separator == -1:
+        return "", partial_content
+    end = last_separator + len(NOTE_SEPARATOR)
+    return partial_content[:end], partial_content[end:]
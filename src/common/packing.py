@@ -0,0 +1,21 @@
+def pack_papers(token_counts: dict[str, int], max_tokens: int, max_papers: int) -> list[list[str]]:
+    """Bin-packs papers into as few requests as possible, first fit
+    decreasing: every paper, largest first, goes into the first pack it fits
+
+    Args:
+    token_counts (dict[str, int]): Token count of every reference key
+    max_tokens (int): Maximal total token count of a pack
+    max_papers (int): Maximal number of papers in a pack
+    """
+    packs: list[list[str]] = []
+    pack_tokens: list[int] = []
+    for reference_key, tokens in sorted(token_counts.items(), key=lambda kv: kv[1], reverse=True):
+        for i in range(len(packs)):
+            if pack_tokens[i] + tokens <= max_tokens and len(packs[i]) < max_papers:
+                packs[i].append(reference_key)
+                pack_tokens[i] += tokens
+                break
+        else:
+            packs.append([reference_key])
+            pack_tokens.append(tokens)
+    return packs
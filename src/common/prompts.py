@@ -1,9 +1,19 @@
-from datetime import datetime
+from datetime import date
+
+from common.notes import PACKED_NOTES_HEADER, PACKED_PAPER_HEADER
+
+# Part of response cache key, bump it whenever any prompt changes
+PROMPT_VERSION = 2
+
+# Prompts are split into static instructions, byte-identical across all the
+# requests of the same kind, and per-paper content. Provider-side prompt
+# caching only works for identical prefixes, so static parts must not contain
+# anything that changes between requests
 
 
 def system_prompt():
-    now = datetime.now().isoformat()
-    return f"""You are an expert researcher in the fields of blockchain and game development. Today is {now}. Follow these instructions when responding:
+    today = date.today().isoformat()
+    return f"""You are an expert researcher in the fields of blockchain and game development. Today is {today}. Follow these instructions when responding:
     ## Instructions
     - The user is a highly experienced analyst, no need to simplify your answers, be as detailed as possible and make sure your response is correct.
     - Mistakes erode my trust, so be accurate and thorough.
@@ -26,10 +36,10 @@ def system_prompt():
     """
 
 
-def idea_separation(paper_contents: str) -> str:
-    return f"""You are given raw text parsed from the PDF file which is either a
+def idea_separation() -> str:
+    return """You are given raw text parsed from the PDF file which is either a
     book or a scientific paper. Your task is to help me to write a thesis, which
-    may include this source as a reference.
+    may include this source as a reference. The text is in the next message.
 
     ## Instructions
 
@@ -58,7 +68,64 @@ def idea_separation(paper_contents: str) -> str:
 
     <deep and full explanation of idea>
     ```
+    """
+
+
+def paper_contents(contents: str, part: int | None = None, parts_total: int | None = None) -> str:
+    part_note = ""
+    if part is not None and parts_total is not None:
+        part_note = f"""The source is too long, so you are given only part {part} of {parts_total} of it.
+    Write notes only for the ideas present in this part, the notes from all the parts will be merged later.
+
+    """
+    return f"""{part_note}## Paper contents
+    {contents}
+    """
+
+
+def packed_idea_separation() -> str:
+    return idea_separation() + f"""
+    ## Several sources
+
+    The next message contains several independent sources instead of one. Each of them starts with a line `{PACKED_PAPER_HEADER.format("<number>")}`.
+
+    1. Process every source separately following the instructions above, never mix ideas of different sources in one note
+    2. Before the notes of each source write a line `{PACKED_NOTES_HEADER.format("<number>")}` with the number of that source, then its notes separated by `---` as usual
+    3. Every source MUST get its own notes section, in the same order as the sources are given
+    """
+
+
+def packed_paper_contents(contents: list[str]) -> str:
+    papers = "\n\n".join(
+        f"{PACKED_PAPER_HEADER.format(i + 1)}\n{c}" for i, c in enumerate(contents)
+    )
+    # Headers have to start their lines, they aren't indented like the prompt templates
+    return "## Papers contents\n" + papers + "\n"
+
+
+def merge_notes() -> str:
+    return """You are given atomic Zettelkasten notes in the next message, which were written for
+    separate parts of a single long book or scientific paper. Because parts were
+    processed independently, some notes describe the same idea and related
+    notes are not linked to each other.
+
+    ## Instructions
+
+    1. Merge notes describing the same idea into a single note, keeping all the unique details and quotes
+    2. Keep notes describing different ideas separate, never drop an idea
+    3. Link related notes using format [[Note title]], each link should be explained
+    4. If several notes are related concepts, create or update a Map Of Content (MOC) note linking all of them, called "MOC - Title of the note". BUT DO NOT CREATE MAP OF CONTENT FOR THE PAPER ITSELF
+    5. Double check that all links point to titles of the notes in your output
+    6. Keep exactly the same format of each note: level 1 heading with the title, gist in a quote block, "## Body" and "## Quote" sections
+    7. Each note should be separated from the others by 3 dashes on a new line `---`. Make sure to include separators before the first and after the last notes as well
+    8. NEVER EVER USE MARKDOWN CODEBLOCKS WHICH ARE SPECIFYIED USING ``` (three backticks symbols)
+    """
+
 
-    ## Paper contents
-    {paper_contents}
+def notes_to_merge(notes: list[str]) -> str:
+    joined_notes = "\n---\n".join(notes)
+    return f"""## Notes
+    ---
+    {joined_notes}
+    ---
     """
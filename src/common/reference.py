@@ -0,0 +1,197 @@
+import json
+import math
+import os
+import re
+from collections import defaultdict
+from functools import cache
+
+from jsonpath_ng import parse
+from rapidfuzz import fuzz, process, utils
+
+from common.config import (JSON_REFERENCE_KEY_FILE, MAX_CHARS_IN_FILE_NAME,
+                           REFERENCE_MATCH_SHORTLIST_SIZE)
+from common.file import sanitize_file_name
+
+# Minimal similarity of generated "Author - Year - Title" name and PDF file name
+PDF_MATCH_THRESHOLD = 90
+
+
+@cache
+def _compiled(expr_str: str):
+    return parse(expr_str)
+
+
+def extract_or(json: dict, expr_str: str, default: str | None = None):
+    res = _compiled(expr_str).find(json)
+    if res and len(res) > 0:
+        return res[0].value
+    return default
+
+
+def _tokens(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def _score_batch(key: str, choices: list[str]) -> list[int]:
+    if len(choices) == 0:
+        return []
+    # Scores the whole batch in C
+    scores = process.cdist([key], choices, scorer=fuzz.token_set_ratio, processor=utils.default_process)[0]
+    return [round(s) for s in scores]
+
+
+class FuzzyIndex:
+    """Inverted token index over strings for fuzzy lookups
+
+    Instead of comparing a key to every value, only values sharing the rarest
+    tokens with the key get scored. Candidates are ranked by summed IDF of
+    shared tokens and the best `shortlist_size` of them are scored with
+    `token_set_ratio`
+    """
+
+    def __init__(self, values: list[str], shortlist_size: int = REFERENCE_MATCH_SHORTLIST_SIZE):
+        self.values = values
+        self.shortlist_size = shortlist_size
+        self.postings: dict[str, list[int]] = defaultdict(list)
+        for i, value in enumerate(values):
+            for token in _tokens(value):
+                self.postings[token].append(i)
+        self.idf = {
+            token: math.log(1 + len(values) / len(ids))
+            for token, ids in self.postings.items()
+        }
+
+    def shortlist(self, key: str) -> list[int]:
+        weights: dict[int, float] = defaultdict(float)
+        for token in _tokens(key):
+            for i in self.postings.get(token, []):
+                weights[i] += self.idf[token]
+        ranked = sorted(weights.items(), key=lambda x: x[1], reverse=True)
+        return [i for i, _ in ranked[: self.shortlist_size]]
+
+    def scores(self, key: str) -> list[tuple[int, int]]:
+        """Returns (score, value index) pairs of shortlisted values"""
+        candidates = self.shortlist(key)
+        batch = _score_batch(key, [self.values[i] for i in candidates])
+        return list(zip(batch, candidates))
+
+
+def expected_pdf_name(item: dict) -> str:
+    """Builds PDF file name the way Zotero names exported files:
+    "Author [and Author2 | et al.] - Year - Title"
+    """
+    author_surname_part = extract_or(item, "$.author[0].literal")
+    author_surname_part = extract_or(item, "$.author[0].family", author_surname_part)
+
+    et_al_part = None
+    maybe_authors = extract_or(item, "$.author", None)
+    if maybe_authors and len(maybe_authors) == 2:
+        et_al_part = extract_or(item, "$.author[1].literal")
+        et_al_part = extract_or(item, "$.author[1].family", et_al_part)
+        if et_al_part:
+            et_al_part = f"and {et_al_part}"
+    elif maybe_authors and len(maybe_authors) > 2:
+        et_al_part = "et al."
+
+    full_author_part: str = ""
+    if author_surname_part:
+        full_author_part = author_surname_part
+        if et_al_part:
+            full_author_part += " " + et_al_part
+        full_author_part += " - "
+
+    maybe_issued = extract_or(item, "$.issued.date-parts[0][0]")
+    year_part: str = ""
+    if maybe_issued:
+        year_part = f"{maybe_issued} - "
+
+    maybe_paper_title = extract_or(item, "$.title")
+    title_part: str = ""
+    if maybe_paper_title:
+        title_part = maybe_paper_title
+    else:
+        print("ERROR | Not paper title!!!")
+
+    full_pdf_paper_name: str = full_author_part + year_part + title_part
+
+    return sanitize_file_name(full_pdf_paper_name[:MAX_CHARS_IN_FILE_NAME])
+
+
+def reference_key_map_generator(items: list[dict[str, str]], pdf_titles: list[str]) -> dict[str, str]:
+    """Maps PDF titles to reference keys
+
+    Every Zotero item is scored only against PDFs shortlisted by the index.
+    Then pairs are assigned greedily from the best score down, so a PDF is
+    never claimed by two items and an item never gets two PDFs
+    """
+    index = FuzzyIndex(pdf_titles)
+
+    candidate_pairs: list[tuple[int, int, str]] = []
+    for item in items:
+        maybe_reference_key = extract_or(item, "$.id")
+        if not maybe_reference_key:
+            print("ERROR | Not found reference key!!!")
+            continue
+        name = expected_pdf_name(item)
+        for score, pdf_index in index.scores(name):
+            if score >= PDF_MATCH_THRESHOLD:
+                candidate_pairs.append((score, pdf_index, maybe_reference_key))
+
+    candidate_pairs.sort(key=lambda x: x[0], reverse=True)
+
+    mapping = {}
+    assigned_keys = set()
+    for _, pdf_index, reference_key in candidate_pairs:
+        pdf_title = pdf_titles[pdf_index]
+        if pdf_title in mapping or reference_key in assigned_keys:
+            continue
+        mapping[pdf_title] = reference_key
+        assigned_keys.add(reference_key)
+
+    return mapping
+
+
+class ReferenceResolver:
+    """Keeps reference keys of PDFs between calls, for the watch mode
+
+    The Zotero export is read again only when its modification time or size
+    changes. Only PDFs without a reference key are matched, and only against
+    items no other PDF has claimed, so a new PDF doesn't rematch the library
+    """
+
+    def __init__(self, path: str = JSON_REFERENCE_KEY_FILE):
+        self.path = path
+        self.version: tuple[int, int] | None = None
+        self.items: list[dict[str, str]] = []
+        self.mapping: dict[str, str] = {}
+
+    def reload(self) -> bool:
+        """Reads the export if it changed, returns whether it did"""
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == self.version:
+            return False
+        with open(self.path) as f:
+            self.items = json.load(f)
+        self.version = version
+        # Keys removed from the library free their PDFs for matching again
+        keys = {extract_or(item, "$.id") for item in self.items}
+        self.mapping = {pdf: key for pdf, key in self.mapping.items() if key in keys}
+        return True
+
+    def resolve(self, pdf_titles: list[str]) -> tuple[dict[str, str], list[str]]:
+        """Returns reference keys of PDFs matched by this call and PDFs still
+        without a reference key
+        """
+        self.reload()
+        present = set(pdf_titles)
+        self.mapping = {pdf: key for pdf, key in self.mapping.items() if pdf in present}
+        unmapped = [pdf for pdf in pdf_titles if pdf not in self.mapping]
+        if len(unmapped) == 0:
+            return {}, []
+
+        assigned = set(self.mapping.values())
+        items = [item for item in self.items if extract_or(item, "$.id") not in assigned]
+        new_mapping = reference_key_map_generator(items, unmapped)
+        self.mapping.update(new_mapping)
+        return new_mapping, [pdf for pdf in unmapped if pdf not in new_mapping]
@@ -0,0 +1,190 @@
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Callable
+
+from common.config import (HEDGE_INITIAL_DEADLINE, HEDGE_LATENCY_QUANTILE, HEDGE_MIN_SAMPLES,
+                           HEDGE_REQUESTS, NOTES_MODELS, NOTES_OUTPUT_TOKENS_RESERVE,
+                           STREAM_RESPONSES)
+from common.metrics import metrics
+from common.model import CONTEXT_WINDOWS, Client, EmptyResponseError, Model, Request, call, stream
+from common.scheduler import RequestScheduler
+
+# Latencies kept per model for the hedging deadline
+LATENCY_WINDOW = 200
+
+
+async def _whole(request: Request, client: Client) -> AsyncIterator[str]:
+    """Output of a non-streamed request as a single chunk"""
+    result = await call(request, client)
+    try:
+        yield result["choices"][0]["message"]["content"]
+    except (KeyError, IndexError):
+        print(result)
+        raise EmptyResponseError("No content field found in API answer")
+
+
+async def _first_chunk(generator: AsyncIterator[str]) -> str | None:
+    """None if the output is empty"""
+    try:
+        return await anext(generator)
+    except StopAsyncIteration:
+        return None
+
+
+class Router:
+    """Picks models for a request and hedges slow ones
+
+    Candidates are models of NOTES_MODELS, in order of preference, whose
+    context window fits the input. The request goes to the first one. If it
+    produces no output within the HEDGE_LATENCY_QUANTILE of time to first
+    output seen so far, the same request is sent to the next candidate as
+    well. Whichever starts answering first wins, the other one is cancelled.
+    Racing on the first output and not on the whole answer lets the winner
+    stream notes to disk right away. A hedge is a request of its own, it
+    waits for a slot of the scheduler like any other
+    """
+
+    def __init__(self, models: list[str] = NOTES_MODELS, hedge: bool = HEDGE_REQUESTS):
+        self.models = [Model(m) for m in models]
+        self.hedge = hedge
+        self.latencies: dict[Model, deque[float]] = {
+            m: deque(maxlen=LATENCY_WINDOW) for m in self.models
+        }
+
+    def candidates(self, input_tokens: int) -> list[Model]:
+        needed = input_tokens + NOTES_OUTPUT_TOKENS_RESERVE
+        fitting = [m for m in self.models if CONTEXT_WINDOWS[m] >= needed]
+        if len(fitting) == 0:
+            raise ValueError(f"No model of NOTES_MODELS fits {input_tokens} tokens")
+        return fitting
+
+    def deadline(self, model: Model) -> float:
+        latencies = sorted(self.latencies[model])
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_INITIAL_DEADLINE
+        return latencies[int(HEDGE_LATENCY_QUANTILE * (len(latencies) - 1))]
+
+    async def stream(
+        self,
+        build: Callable[[Model], Request],
+        input_tokens: int,
+        client: Client,
+        scheduler: RequestScheduler | None = None,
+    ) -> AsyncIterator[str]:
+        """Streams output of the winning model
+
+        Args:
+        build (Callable[[Model], Request]): Builds the request for a given model
+        input_tokens (int): Size of the input, decides which models fit
+        scheduler (RequestScheduler | None): Admits hedges, the first
+            request is expected to be admitted by the caller
+        """
+        models = self.candidates(input_tokens)
+        if not self.hedge:
+            models = models[:1]
+
+        attempts: dict[asyncio.Task, tuple[Model, AsyncIterator[str]]] = {}
+        # When every attempt got sent and got its first output
+        started: dict[Model, float] = {}
+        answered: dict[Model, float] = {}
+        # Answers served by the response cache say nothing about latency
+        cached: set[Model] = set()
+        # Hedges holding a slot of the scheduler
+        admitted: set[Model] = set()
+
+        async def first_chunk(model: Model, generator: AsyncIterator[str], hedge: bool) -> str | None:
+            if hedge and scheduler is not None:
+                await scheduler.acquire(input_tokens)
+                admitted.add(model)
+            started[model] = time.perf_counter()
+            chunk = await _first_chunk(generator)
+            answered[model] = time.perf_counter()
+            return chunk
+
+        def launch(model: Model) -> float:
+            request = build(model)
+            if client.cache is not None and client.cache.has(request):
+                cached.add(model)
+            generator = (stream if STREAM_RESPONSES else _whole)(request, client)
+            attempts[asyncio.create_task(first_chunk(model, generator, len(attempts) > 0))] = (model, generator)
+            # The next hedge goes out once this attempt is late
+            return time.perf_counter() + self.deadline(model)
+
+        def record(model: Model, task: asyncio.Task):
+            """Time to first output of a provider, an attempt cancelled before
+            its first output counts with the time it waited so far
+            """
+            if model in cached or model not in started:
+                return
+            if task.done() and (task.cancelled() or task.exception() is not None):
+                return
+            self.latencies[model].append(answered.get(model, time.perf_counter()) - started[model])
+
+        async def close(model: Model, generator: AsyncIterator[str]):
+            await generator.aclose()
+            if model in admitted:
+                admitted.discard(model)
+                await scheduler.release()
+
+        hedge_at = launch(models[0])
+        pending = set(attempts)
+        winner = None
+        error: BaseException | None = None
+        try:
+            while winner is None and len(pending) > 0:
+                timeout = None
+                if len(attempts) < len(models):
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if len(done) == 0:
+                    metrics.increment("hedged_requests")
+                    hedge_at = launch(models[len(attempts)])
+                    pending = {t for t in attempts if not t.done()}
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    # First failure is reported if the other attempt fails too
+                    error = error or task.exception()
+            if winner is None:
+                raise error
+        finally:
+            for task, (model, generator) in attempts.items():
+                if task is not winner:
+                    # Only winners would otherwise be measured, and they are the fast ones
+                    record(model, task)
+                    task.cancel()
+                    try:
+                        await task
+                    except (asyncio.CancelledError, Exception):
+                        pass
+                    await close(model, generator)
+
+        model, generator = attempts[winner]
+        record(model, winner)
+        if model != models[0]:
+            metrics.increment("hedges_won")
+
+        try:
+            first = winner.result()
+            if first is None:
+                return
+            yield first
+            async for chunk in generator:
+                yield chunk
+        finally:
+            await close(model, generator)
+
+    async def generate(
+        self,
+        build: Callable[[Model], Request],
+        input_tokens: int,
+        client: Client,
+        scheduler: RequestScheduler | None = None,
+    ) -> str:
+        """Returns the whole output of the winning model"""
+        return "".join([chunk async for chunk in self.stream(build, input_tokens, client, scheduler)])
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+
+from common.config import (MAX_CONCURRENT_REQUESTS, MAX_CONCURRENT_REQUESTS_LIMIT,
+                           MIN_CONCURRENT_REQUESTS, RATE_LIMIT_DEFAULT_BACKOFF,
+                           RATE_LIMIT_MAX_RETRIES, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+from common.metrics import metrics
+from common.model import EmptyResponseError, IncompleteStreamError
+
+T = TypeVar("T")
+
+WINDOW_SECONDS = 60
+
+
+def is_backpressure(error: httpx.HTTPStatusError) -> bool:
+    status = error.response.status_code
+    return status == 429 or status >= 500
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether the same request may succeed if sent again later. Errors in
+    the middle of a stream come with status 200
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return is_backpressure(error) or error.response.status_code in (200, 408)
+    return isinstance(error, (
+        httpx.TransportError, json.JSONDecodeError, EmptyResponseError, IncompleteStreamError, TimeoutError
+    ))
+
+
+def retry_after_seconds(error: httpx.HTTPStatusError) -> float | None:
+    value = error.response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """Admits requests within requests-per-minute and tokens-per-minute budgets
+    and an adaptive concurrency limit
+
+    Concurrency follows AIMD: every successful request grows the limit by
+    1/limit (so roughly by one per "round" of requests), a 429/5xx halves it
+    and pauses all the new requests for `Retry-After` seconds. Requests
+    already in flight when the limit was halved were sent under the old one,
+    so their 429s only extend the pause
+    """
+
+    def __init__(
+        self,
+        initial_concurrency: int = MAX_CONCURRENT_REQUESTS,
+        min_concurrency: int = MIN_CONCURRENT_REQUESTS,
+        max_concurrency: int = MAX_CONCURRENT_REQUESTS_LIMIT,
+        requests_per_minute: int | None = REQUESTS_PER_MINUTE,
+        tokens_per_minute: int | None = TOKENS_PER_MINUTE,
+    ):
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        # Number of times the limit was halved
+        self.generation = 0
+        # (start time, tokens) of requests started within the last minute
+        self.window: deque[tuple[float, int]] = deque()
+        self.window_tokens = 0
+        self.condition = asyncio.Condition()
+
+    def _expire(self, now: float):
+        while len(self.window) > 0 and self.window[0][0] <= now - WINDOW_SECONDS:
+            _, tokens = self.window.popleft()
+            self.window_tokens -= tokens
+
+    def _wait_time(self, now: float, tokens: int) -> float | None:
+        """Seconds to wait before the request may start, 0 if it may start now
+        and None if it has to wait for another request to finish
+        """
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        if len(self.window) == 0:
+            # Request bigger than the whole budget still has to go through
+            return 0
+        window_end = self.window[0][0] + WINDOW_SECONDS - now
+        if self.requests_per_minute and len(self.window) >= self.requests_per_minute:
+            return window_end
+        if self.tokens_per_minute and self.window_tokens + tokens > self.tokens_per_minute:
+            return window_end
+        return 0
+
+    async def acquire(self, tokens: int) -> int:
+        """Waits until the request may start, returns the generation it started in"""
+        async with self.condition:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._wait_time(now, tokens)
+                if wait == 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=wait)
+                except TimeoutError:
+                    pass
+            self.in_flight += 1
+            metrics.request_started(self.limit)
+            self.window.append((now, tokens))
+            self.window_tokens += tokens
+            return self.generation
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            metrics.request_finished()
+            self.condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def on_backpressure(self, pause_seconds: float, generation: int):
+        """Handles 429/5xx of a request started in the given generation"""
+        if generation == self.generation:
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self.generation += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + pause_seconds)
+
+    async def run(self, tokens: int, request: Callable[[], Awaitable[T]]) -> T:
+        """Runs `request` once admitted, retrying it after 429 and 5xx responses"""
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            generation = await self.acquire(tokens)
+            try:
+                result = await request()
+            except httpx.HTTPStatusError as e:
+                metrics.increment(f"responses_{e.response.status_code}")
+                if not is_backpressure(e) or attempt == RATE_LIMIT_MAX_RETRIES:
+                    raise
+                metrics.increment("retries")
+                pause = retry_after_seconds(e)
+                if pause is None:
+                    pause = RATE_LIMIT_DEFAULT_BACKOFF * 2**attempt
+                self.on_backpressure(pause, generation)
+                print(
+                    f"WARNING | Got {e.response.status_code}, concurrency limit is "
+                    f"{int(self.limit)}, retrying in {pause:.0f}s"
+                )
+                continue
+            finally:
+                await self.release()
+            self.on_success()
+            return result
+        raise RuntimeError("unreachable")
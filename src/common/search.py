@@ -0,0 +1,250 @@
+import os
+import re
+import shutil
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from common.config import (NOTES_OUTPUT_FOLDER, SEARCH_DELTA_MAX_POSTINGS, SEARCH_HASH_BITS,
+                           SEARCH_INDEX_FOLDER, SEARCH_TOP_K)
+from common.links import note_body
+from common.manifest import Manifest
+
+WORD = re.compile(r"\w+")
+
+# Postings appended since the last compaction
+DELTA_FILE_NAME = "delta.bin"
+DELTA_RECORD = np.dtype([("term", "<u4"), ("doc", "<i4"), ("weight", "<f4")])
+
+# Postings sorted by term: postings of terms[i] are docs/weights[offsets[i]:offsets[i + 1]]
+MAIN_FOLDER_NAME = "main"
+MAIN_ARRAYS = ["terms", "offsets", "docs", "weights"]
+
+# Written last into a new main part, a part without it was interrupted
+COMPLETE_FILE_NAME = ".complete"
+
+# Ranked candidates looked up at once, removed notes among them are skipped
+CANDIDATES_PER_RESULT = 4
+
+
+def term_weights(text: str, hash_bits: int = SEARCH_HASH_BITS) -> tuple[np.ndarray, np.ndarray]:
+    """Hashed terms of the text and their log-scaled frequencies, normalized
+    to unit length
+    """
+    mask = (1 << hash_bits) - 1
+    counts = Counter(zlib.crc32(w.encode()) & mask for w in WORD.findall(text.lower()))
+    if len(counts) == 0:
+        return np.zeros(0, np.uint32), np.zeros(0, np.float32)
+    terms = np.fromiter(counts.keys(), dtype=np.uint32, count=len(counts))
+    weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    return terms, (weights / np.linalg.norm(weights)).astype(np.float32)
+
+
+def _save(path: str, array: np.ndarray | None):
+    """Replaces the file as a whole, so readers never map a truncated one.
+    None leaves the file empty
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if array is not None:
+            np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class SearchIndex:
+    """Hashed TF-IDF index of notes kept as memory-mapped NumPy arrays
+
+    Postings (note and weight of a term) live in two parts. The main part is
+    sorted by term, so a query only reads postings of its own terms. Notes
+    indexed since are appended to an unsorted delta, which queries scan
+    whole, and which is merged into the main part once it outgrows
+    SEARCH_DELTA_MAX_POSTINGS. Note weights don't depend on the other notes,
+    IDF comes from document frequencies of terms at query time, so adding
+    notes never reweights the indexed ones
+
+    Ids of notes are kept in the manifest. Reindexing a paper marks its old
+    ids dead and stops counting them in document frequencies, their postings
+    are dropped by the next compaction, which also counts document
+    frequencies again from the postings left
+
+    Args:
+    manifest (Manifest): Manifest with the note index
+    folder (str): Where the arrays are stored
+    notes_folder (str): Where notes are read from
+    """
+
+    def __init__(
+        self, manifest: Manifest, folder: str = SEARCH_INDEX_FOLDER, notes_folder: str = NOTES_OUTPUT_FOLDER
+    ):
+        self.manifest = manifest
+        self.folder = folder
+        self.notes_folder = notes_folder
+        self.main_folder = os.path.join(folder, MAIN_FOLDER_NAME)
+        self.delta_path = os.path.join(folder, DELTA_FILE_NAME)
+        self.df_path = os.path.join(folder, "df.npy")
+
+    def _main(self) -> dict[str, np.ndarray] | None:
+        new_folder = self.main_folder + ".new"
+        if not os.path.isdir(self.main_folder) and os.path.isfile(os.path.join(new_folder, COMPLETE_FILE_NAME)):
+            # Compaction was interrupted between swapping the parts
+            os.replace(new_folder, self.main_folder)
+        if not os.path.isfile(os.path.join(self.main_folder, COMPLETE_FILE_NAME)):
+            return None
+        return {name: np.load(os.path.join(self.main_folder, name + ".npy"), mmap_mode="r") for name in MAIN_ARRAYS}
+
+    def _delta(self) -> np.ndarray:
+        size = os.path.getsize(self.delta_path) if os.path.isfile(self.delta_path) else 0
+        # A record still being appended by another process is left out
+        count = size // DELTA_RECORD.itemsize
+        if count == 0:
+            return np.zeros(0, DELTA_RECORD)
+        return np.memmap(self.delta_path, dtype=DELTA_RECORD, mode="r", shape=(count,))
+
+    def _document_frequencies(self, mode: str = "r") -> np.ndarray | None:
+        """None if nothing was indexed yet"""
+        if not os.path.isfile(self.df_path):
+            return None
+        return np.load(self.df_path, mmap_mode=mode)
+
+    def _discount(self, doc_ids: list[int]):
+        """Stops counting postings of removed notes in document frequencies"""
+        df = self._document_frequencies("r+")
+        if df is None or len(doc_ids) == 0:
+            return
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        delta = self._delta()
+        terms = [delta["term"][np.isin(delta["doc"], doc_ids)]]
+        main = self._main()
+        if main is not None:
+            positions = np.flatnonzero(np.isin(main["docs"], doc_ids))
+            terms.append(main["terms"][np.searchsorted(main["offsets"], positions, side="right") - 1])
+        np.subtract.at(df, np.concatenate(terms), 1)
+        df.flush()
+
+    def update(self, reference_key: str, compact: bool = True):
+        """Indexes notes of the paper, replacing whatever of it was indexed before"""
+        self._discount(self.manifest.forget_search_docs(reference_key))
+        notes = []
+        for file_name in self.manifest.note_files(reference_key):
+            path = os.path.join(self.notes_folder, reference_key, file_name + ".md")
+            if not os.path.isfile(path):
+                continue
+            with open(path, "r") as f:
+                terms, weights = term_weights(note_body(f.read()))
+            if len(terms) > 0:
+                notes.append((file_name, terms, weights))
+        if len(notes) == 0:
+            return
+
+        os.makedirs(self.folder, exist_ok=True)
+        doc_ids = self.manifest.add_search_docs(reference_key, [file_name for file_name, _, _ in notes])
+        records = np.zeros(sum(len(terms) for _, terms, _ in notes), DELTA_RECORD)
+        records["term"] = np.concatenate([terms for _, terms, _ in notes])
+        records["doc"] = np.repeat(doc_ids, [len(terms) for _, terms, _ in notes])
+        records["weight"] = np.concatenate([weights for _, _, weights in notes])
+        with open(self.delta_path, "ab") as f:
+            f.write(records.tobytes())
+
+        if not os.path.isfile(self.df_path):
+            _save(self.df_path, np.zeros(1 << SEARCH_HASH_BITS, np.int32))
+        df = self._document_frequencies("r+")
+        # Terms are distinct within a note
+        np.add.at(df, records["term"], 1)
+        df.flush()
+
+        if compact and os.path.getsize(self.delta_path) // DELTA_RECORD.itemsize > SEARCH_DELTA_MAX_POSTINGS:
+            self.compact()
+
+    def compact(self):
+        """Merges the delta into the main part, dropping postings of removed notes"""
+        main = self._main()
+        delta = self._delta()
+        terms, docs, weights = [delta["term"]], [delta["doc"]], [delta["weight"]]
+        if main is not None:
+            terms.append(np.repeat(main["terms"], np.diff(main["offsets"])))
+            docs.append(main["docs"])
+            weights.append(main["weights"])
+        terms, docs, weights = np.concatenate(terms), np.concatenate(docs), np.concatenate(weights)
+
+        alive = np.isin(docs, np.asarray(self.manifest.alive_search_docs(), dtype=np.int32))
+        terms, docs, weights = terms[alive], docs[alive], weights[alive]
+        order = np.lexsort((docs, terms))
+        terms, docs, weights = terms[order], docs[order], weights[order]
+        # Postings of an interrupted compaction may be both in delta and main
+        distinct = np.ones(len(terms), dtype=bool)
+        distinct[1:] = (terms[1:] != terms[:-1]) | (docs[1:] != docs[:-1])
+        terms, docs, weights = terms[distinct], docs[distinct], weights[distinct]
+        unique_terms, starts = np.unique(terms, return_index=True)
+
+        new_folder = self.main_folder + ".new"
+        shutil.rmtree(new_folder, ignore_errors=True)
+        os.makedirs(new_folder)
+        _save(os.path.join(new_folder, "terms.npy"), unique_terms)
+        _save(os.path.join(new_folder, "offsets.npy"), np.append(starts, len(terms)).astype(np.int64))
+        _save(os.path.join(new_folder, "docs.npy"), docs)
+        _save(os.path.join(new_folder, "weights.npy"), weights)
+        open(os.path.join(new_folder, COMPLETE_FILE_NAME), "w").close()
+
+        old_folder = self.main_folder + ".old"
+        if os.path.isdir(self.main_folder):
+            os.replace(self.main_folder, old_folder)
+        os.replace(new_folder, self.main_folder)
+        shutil.rmtree(old_folder, ignore_errors=True)
+        _save(self.delta_path, None)
+        _save(self.df_path, np.bincount(terms, minlength=1 << SEARCH_HASH_BITS).astype(np.int32))
+        self.manifest.discount_search_docs()
+
+    def rebuild(self):
+        """Indexes all the notes from scratch"""
+        self.manifest.reset_search()
+        shutil.rmtree(self.folder, ignore_errors=True)
+        for reference_key in self.manifest.note_keys():
+            self.update(reference_key, compact=False)
+        if os.path.isfile(self.delta_path):
+            self.compact()
+
+    def search(self, query: str, k: int = SEARCH_TOP_K) -> list[tuple[float, str, str]]:
+        """Score, reference key and file name of `k` notes best matching the query"""
+        query_terms, query_weights = term_weights(query)
+        last_id, alive_count = self.manifest.search_doc_counts()
+        if len(query_terms) == 0 or alive_count == 0:
+            return []
+
+        df = self._document_frequencies()
+        frequencies = df[query_terms] if df is not None else np.zeros(len(query_terms), np.int32)
+        query_weights = query_weights * (np.log((alive_count + 1) / (frequencies + 1)) + 1)
+        scores = np.zeros(last_id + 1, np.float32)
+
+        main = self._main()
+        if main is not None:
+            positions = np.searchsorted(main["terms"], query_terms)
+            for term, position, weight in zip(query_terms, positions, query_weights):
+                if position < len(main["terms"]) and main["terms"][position] == term:
+                    start, end = main["offsets"][position], main["offsets"][position + 1]
+                    scores[main["docs"][start:end]] += weight * main["weights"][start:end]
+
+        delta = self._delta()
+        if len(delta) > 0:
+            order = np.argsort(query_terms)
+            sorted_terms = query_terms[order]
+            positions = np.minimum(np.searchsorted(sorted_terms, delta["term"]), len(sorted_terms) - 1)
+            matched = sorted_terms[positions] == delta["term"]
+            np.add.at(
+                scores,
+                delta["doc"][matched],
+                query_weights[order][positions[matched]] * delta["weight"][matched],
+            )
+
+        candidates = np.flatnonzero(scores > 0)
+        limit = k * CANDIDATES_PER_RESULT
+        while True:
+            top = candidates
+            if len(candidates) > limit:
+                top = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            notes = self.manifest.search_docs([int(i) for i in top])
+            results = [(float(scores[i]), *notes[i]) for i in top if i in notes]
+            if len(results) >= k or len(top) == len(candidates):
+                return results[:k]
+            limit *= CANDIDATES_PER_RESULT
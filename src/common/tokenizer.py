@@ -0,0 +1,144 @@
+import json
+import os
+import re
+from collections import deque
+
+from common.config import (TOKEN_CALIBRATION_FILE, TOKEN_CALIBRATION_SAMPLES, TOKEN_ESTIMATE_MARGIN,
+                           TOKEN_ESTIMATE_MIN_SAMPLES, TOKENIZER_FOLDER, TOKENIZER_MODEL,
+                           TOKENIZER_REVISION)
+
+# Files of the hub repository needed to load the tokenizer, model weights are skipped
+TOKENIZER_FILES = ["tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", "*.model"]
+
+# Revision the local snapshot was taken for and the commit it resolved to
+REVISION_FILE_NAME = ".revision"
+
+COMMIT_HASH = re.compile(r"^[0-9a-f]{40}$")
+
+# Share of estimates the margin must cover
+ESTIMATE_ERROR_QUANTILE = 0.95
+
+
+def snapshot_revision() -> tuple[str, str] | None:
+    """TOKENIZER_REVISION the local snapshot was taken for and its commit,
+    None if there is no snapshot yet
+    """
+    revision_path = os.path.join(TOKENIZER_FOLDER, REVISION_FILE_NAME)
+    if not os.path.isfile(revision_path):
+        return None
+    with open(revision_path, "r") as f:
+        lines = f.read().split()
+    if len(lines) == 0:
+        return None
+    # Snapshots taken before commits were recorded only have the revision
+    return lines[0], lines[-1]
+
+
+def tokenizer_snapshot() -> str:
+    """Local folder with the tokenizer of TOKENIZER_MODEL at TOKENIZER_REVISION.
+    It is downloaded only the first time and whenever the revision changes. A
+    branch is resolved to its commit once, the snapshot never follows it
+    """
+    snapshot = snapshot_revision()
+    if snapshot is not None and snapshot[0] == TOKENIZER_REVISION:
+        return TOKENIZER_FOLDER
+
+    from huggingface_hub import HfApi, snapshot_download
+
+    commit = HfApi().model_info(TOKENIZER_MODEL, revision=TOKENIZER_REVISION).sha
+    if not COMMIT_HASH.match(TOKENIZER_REVISION):
+        print(f"WARNING | TOKENIZER_REVISION {TOKENIZER_REVISION} is a branch, set it to {commit} to pin it")
+    print(f"Downloading tokenizer {TOKENIZER_MODEL}@{commit} to {TOKENIZER_FOLDER}")
+    snapshot_download(
+        TOKENIZER_MODEL,
+        revision=commit,
+        local_dir=TOKENIZER_FOLDER,
+        allow_patterns=TOKENIZER_FILES,
+    )
+    with open(os.path.join(TOKENIZER_FOLDER, REVISION_FILE_NAME), "w") as f:
+        f.write(f"{TOKENIZER_REVISION}\n{commit}\n")
+    return TOKENIZER_FOLDER
+
+
+def load_tokenizer(folder: str | None = None):
+    """Tokenizer of TOKENIZER_MODEL, loaded from `folder` which must already
+    hold the snapshot if given, from `tokenizer_snapshot` otherwise
+    """
+    # transformers pulls in torch, which takes seconds to import, so only
+    # stages that actually count tokens pay for it
+    from transformers import AutoTokenizer
+
+    # Never touches the hub, so counts can't change under a running library
+    return AutoTokenizer.from_pretrained(folder or tokenizer_snapshot(), local_files_only=True, use_fast=True)
+
+
+def count_tokens(tokenizer, texts: list[str]) -> list[int]:
+    """Token counts without special tokens of all the texts, encoded as a
+    single batch by the Rust tokenizer where available
+    """
+    if len(texts) == 0:
+        return []
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return [len(e.ids) for e in backend.encode_batch(texts, add_special_tokens=False)]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+class TokenEstimator:
+    """Chars per token ratio learned from exactly counted papers
+
+    Most decisions made on token counts only need to know on which side of a
+    threshold a paper is. Exact counting is skipped for papers whose estimate
+    is farther from every threshold than the estimation error. The ratio and
+    the error come from the last TOKEN_CALIBRATION_SAMPLES exactly counted
+    papers, until TOKEN_ESTIMATE_MIN_SAMPLES of them are seen every paper is
+    counted exactly
+
+    Args:
+    thresholds (list[float]): Token counts decisions are made at
+    path (str): Where samples are kept between runs
+    """
+
+    def __init__(self, thresholds: list[float], path: str = TOKEN_CALIBRATION_FILE):
+        self.thresholds = thresholds
+        self.path = path
+        self.samples: deque[tuple[int, int]] = deque(maxlen=TOKEN_CALIBRATION_SAMPLES)
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.samples.extend((chars, tokens) for chars, tokens in json.load(f)["samples"])
+        self._fit()
+
+    def _fit(self):
+        samples = [(chars, tokens) for chars, tokens in self.samples if tokens > 0]
+        self.ratio = None
+        self.margin = TOKEN_ESTIMATE_MARGIN
+        if len(samples) < TOKEN_ESTIMATE_MIN_SAMPLES:
+            return
+        self.ratio = sum(chars for chars, _ in samples) / sum(tokens for _, tokens in samples)
+        errors = sorted(abs(chars / self.ratio - tokens) / tokens for chars, tokens in samples)
+        self.margin = max(TOKEN_ESTIMATE_MARGIN, errors[int(ESTIMATE_ERROR_QUANTILE * (len(errors) - 1))])
+
+    def estimate(self, chars: int) -> int:
+        if self.ratio is None:
+            raise ValueError("Estimator is not calibrated yet")
+        return round(chars / self.ratio)
+
+    def needs_exact(self, chars: int) -> bool:
+        return self.ratio is None or self.is_near(self.estimate(chars))
+
+    def is_near(self, tokens: int) -> bool:
+        """Whether an estimate of `tokens` may be on the other side of a threshold"""
+        return any(abs(tokens - t) <= self.margin * t for t in self.thresholds)
+
+    def record(self, chars: int, tokens: int):
+        self.samples.append((chars, tokens))
+        self._fit()
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"ratio": self.ratio, "margin": self.margin, "samples": list(self.samples)}, f)
+        os.replace(tmp_path, self.path)
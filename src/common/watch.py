@@ -0,0 +1,230 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+from typing import AsyncIterator
+
+from common.config import WATCH_DEBOUNCE_SECONDS, WATCH_POLL_SECONDS
+
+# Flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+)
+
+# struct inotify_event: wd, mask, cookie, len, then `len` bytes of name
+EVENT_HEADER = struct.Struct("iIII")
+
+# A single read returns as many queued events as fit
+READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    """Minimal inotify binding over libc, Linux only
+
+    Folders are watched recursively, subfolders created later are added as
+    they appear. A single file is watched through its parent folder, so it
+    is noticed even when an editor replaces it by renaming a new one over it
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or libc_name is None:
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watched folder of every watch descriptor
+        self.folders: dict[int, str] = {}
+
+    def add_folder(self, folder: str):
+        """Watches the folder and all its subfolders"""
+        for root, _, _ in os.walk(folder):
+            self.add_watch(root)
+
+    def add_watch(self, folder: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOENT:
+                # Removed before it got watched
+                return
+            raise OSError(error, f"inotify_add_watch failed for {folder}")
+        self.folders[wd] = folder
+
+    def read(self) -> list[str]:
+        """Paths touched by events queued so far. An empty path means the
+        queue overflowed and some events were lost
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset: offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                paths.append("")
+                continue
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_DELETE_SELF:
+                del self.folders[wd]
+                continue
+            path = os.path.join(folder, os.fsdecode(name))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may land in the new folder before it is watched
+                self.add_folder(path)
+                for root, _, files in os.walk(path):
+                    paths.extend(os.path.join(root, f) for f in files)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def snapshot(folders: list[str], files: list[str]) -> dict[str, tuple[int, int]]:
+    """Size and modification time of every watched file"""
+    paths = [
+        os.path.join(root, f)
+        for folder in folders
+        for root, _, folder_files in os.walk(folder)
+        for f in folder_files
+    ]
+    paths += [f for f in files if os.path.isfile(f)]
+
+    state = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        state[path] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+
+class Watcher:
+    """Reports changes of files in `folders` (recursively) and of single
+    `files`. Uses inotify where available and polls otherwise
+
+    Args:
+    folders (list[str]): Folders to watch, they must exist
+    files (list[str]): Single files to watch, they may appear later
+    debounce (float): Seconds without changes before a batch is reported
+    poll_interval (float): Seconds between rescans when polling
+    """
+
+    def __init__(
+        self,
+        folders: list[str],
+        files: list[str],
+        debounce: float = WATCH_DEBOUNCE_SECONDS,
+        poll_interval: float = WATCH_POLL_SECONDS,
+    ):
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.files = [os.path.abspath(f) for f in files]
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+
+    def _is_watched(self, path: str) -> bool:
+        return path == "" or path in self.files or any(
+            path == folder or path.startswith(folder + os.sep) for folder in self.folders
+        )
+
+    async def changes(self) -> AsyncIterator[set[str]]:
+        """Yields sets of changed paths, forever. A set containing an empty
+        path means changes could have been missed and everything should be
+        rescanned
+        """
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            print(f"WARNING | {e}, polling every {self.poll_interval}s instead")
+            async for changed in self._poll():
+                yield changed
+            return
+
+        try:
+            async for changed in self._inotify(inotify):
+                yield changed
+        finally:
+            inotify.close()
+
+    async def _inotify(self, inotify: Inotify) -> AsyncIterator[set[str]]:
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        for folder in self.folders:
+            inotify.add_folder(folder)
+        for folder in {os.path.dirname(f) for f in self.files}:
+            if folder not in inotify.folders.values():
+                inotify.add_watch(folder)
+
+        pending: set[str] = set()
+
+        def drain():
+            # The reader fires as long as events are queued, so they are read
+            # right away, also while a batch is being processed
+            pending.update(p for p in inotify.read() if self._is_watched(p))
+            ready.set()
+
+        loop.add_reader(inotify.fd, drain)
+        try:
+            while True:
+                await ready.wait()
+                # Keep collecting until no event came for `debounce` seconds
+                while ready.is_set():
+                    ready.clear()
+                    try:
+                        await asyncio.wait_for(ready.wait(), self.debounce)
+                    except asyncio.TimeoutError:
+                        break
+                if len(pending) > 0:
+                    changed = set(pending)
+                    pending.clear()
+                    yield changed
+        finally:
+            loop.remove_reader(inotify.fd)
+
+    async def _poll(self) -> AsyncIterator[set[str]]:
+        previous = await asyncio.to_thread(snapshot, self.folders, self.files)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            current = await asyncio.to_thread(snapshot, self.folders, self.files)
+            changed = {
+                path for path in previous.keys() | current.keys()
+                if previous.get(path) != current.get(path)
+            }
+            previous = current
+            if len(changed) == 0:
+                continue
+            # A file still being written shows up as changed once more
+            await asyncio.sleep(self.debounce)
+            previous = await asyncio.to_thread(snapshot, self.folders, self.files)
+            changed.update(
+                path for path in previous.keys() | current.keys()
+                if previous.get(path) != current.get(path)
+            )
+            yield changed
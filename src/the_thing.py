@@ -1,25 +1,41 @@
 import argparse
-from jsonpath_ng import jsonpath, parse
 import asyncio
 import json
 import os
+import random
 import re
 import shutil
 import time
 from enum import Enum
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-
-import pymupdf
-from fuzzywuzzy import fuzz
-from transformers import AutoTokenizer
+from typing import Any, Callable, Iterator
 
 from common import prompts
-from common.file import sanitize_file_name
-from common.config import (EXTRACTED_TEXT_FOLDER, JSON_REFERENCE_KEY_FILE,
-                           MAX_API_TOKENS_ALLOWED, MAX_CHARS_IN_FILE_NAME, MAX_CONCURRENT_REQUESTS,
-                           NOTES_OUTPUT_FOLDER, PDF_PAPERS_FOLDER, PDF_PAPERS_RAW_FOLDER,
-                           TOKEN_COUNT_FOLDER, TOKENIZER_MODEL)
-from common.model import Message, Model, Request, Role, call
+from common.assembly import assemble
+from common.chunking import split_into_chunks
+from common.config import (CHUNK_LONG_PAPERS, CHUNK_MAX_TOKENS, DEDUP_ACTION, DEDUP_NOTES,
+                           ESTIMATE_TOKENS, EXTRACTED_TEXT_FOLDER, EXTRACTION_JOBS, FLATTEN_LINK_MODE, JSON_REFERENCE_KEY_FILE,
+                           MAX_API_TOKENS_ALLOWED, METRICS_REPORT_FILE, NOTES_MAX_ATTEMPTS,
+                           NOTES_MODELS, NOTES_OUTPUT_FOLDER, NOTES_OUTPUT_TOKENS_RESERVE,
+                           NOTES_RETRY_BACKOFF, PACK_MAX_PAPERS, PACK_MAX_TOKENS,
+                           PACK_MAX_TOKENS_PER_PAPER, PACK_SMALL_PAPERS,
+                           PDF_PAPERS_FOLDER, PDF_PAPERS_RAW_FOLDER,
+                           PIPELINE_MAX_PENDING_PAPERS, PIPELINE_QUEUE_SIZE, SEARCH_INDEX,
+                           SEARCH_TOP_K, STREAM_RESPONSES, TOKEN_COUNT_FOLDER)
+from common.dedup import MinHasher, deduplicate
+from common.model import (CONTEXT_WINDOWS, Client, EmptyResponseError, Message, Model, Request,
+                          ResponseCache, Role, Usage)
+from common.flatten import LinkMode, flatten_folder
+from common.manifest import Manifest, Status
+from common.links import note_file_name, note_links, rewrite_links
+from common.metrics import metrics
+from common.notes import (CHUNK_OUTPUT_PREFIX, PARTIAL_STREAM_FILE, NoteParser, PackParser,
+                          split_resumable)
+from common.packing import pack_papers
+from common.routing import Router
+from common.scheduler import RequestScheduler, is_transient
+from common.search import SearchIndex
 
 
 class FileType(Enum):
@@ -30,35 +46,6 @@ class FileType(Enum):
     FOLDER = ""
 
 
-def convert_to_txt(filename: str):
-    file_path = os.path.join(PDF_PAPERS_FOLDER, filename + FileType.PDF.value)
-    with pymupdf.open(file_path) as doc:
-        return "\n".join(page.get_text("text") for page in doc)
-
-def flatten_folder(source_folder, destination_folder):
-    """
-    Recursively flattens the source folder by moving all files to the destination folder.
-
-    Args:
-    source_folder (str): Path to the folder to be flattened
-    destination_folder (str): Path to the folder where files will be moved
-    """
-    os.makedirs(destination_folder, exist_ok = True)
-
-    existing_files = filenames_in_folder(destination_folder, None)
-
-    for root, dirs, files in os.walk(source_folder):
-        for file in files:
-            if Path(file).stem in existing_files:
-                print(f"Skipping, already copied before: {file}")
-                continue
-            source_path = os.path.join(root, file)
-            base, extension = os.path.splitext(file)
-            counter = 1
-            destination_path = os.path.join(destination_folder, file)
-            shutil.copy(source_path, destination_path)
-
-
 def filenames_in_folder(folder: str, filetype: FileType | None) -> list[str]:
     """Returns filenames without extensions of all files in the given folder
     If `filetype` is None returns all files, if not - only specific extension
@@ -123,207 +110,549 @@ def format_note(title_and_body: str, paper_note: str) -> str:
 - [[{paper_note}]]"""
 
 
-def find_reference_key(paper_title: str, json_map: list[dict[str, str]]) -> str | None:
-    title_match: str = ""
-    match_percentage: int = 0
+def write_note(note: str, path_for_notes: str, reference_key: str, manifest: Manifest) -> bool:
+    """Writes a single note and adds it to the note index, returns False if
+    text doesn't look like a note. A note whose title is taken by another
+    note is written under a different name, and links of the paper's notes
+    to it are pointed there
+    """
+    note = clean_from_code_blocks(note).strip()
+    lines = note.splitlines()
+    if len(lines) == 0 or not lines[0].startswith("# "):
+        return False
+    title = lines[0].replace("# ", "")
+    with metrics.timer("index"):
+        note = rewrite_links(note, manifest.renamed_notes(reference_key))
+        file_name = manifest.add_note(reference_key, title, note_file_name(title), note_links(note))
+    note_path = os.path.join(path_for_notes, file_name + FileType.MARKDOWN.value)
+    formatted_note_content = format_note(note, reference_key)
+    with metrics.timer("write"), open(note_path, "w") as f:
+        f.write(formatted_note_content)
+    if file_name != title:
+        # Notes written before it could only link to its title
+        with metrics.timer("index"):
+            for source in manifest.retarget_links(reference_key, title, file_name):
+                rewrite_note_links(os.path.join(path_for_notes, source + FileType.MARKDOWN.value), title, file_name)
+    return True
+
+
+def rewrite_note_links(note_path: str, title: str, file_name: str):
+    if not os.path.exists(note_path):
+        return
+    with open(note_path, "r") as f:
+        content = f.read()
+    with open(note_path, "w") as f:
+        f.write(rewrite_links(content, {title.lower(): file_name}))
 
-    for elements in json_map:
-        maybeId = elements.get("id")
-        maybeTitle = elements.get("title")
-        if maybeTitle and maybeId:
-            p = fuzz.token_set_ratio(maybeTitle, paper_title)
-            if p > match_percentage:
-                match_percentage = p
-                title_match = maybeId
 
-    if match_percentage < 80:
-        return None
-    return title_match
+def read_text(reference_key: str) -> str:
+    txt_file_location = os.path.join(
+        EXTRACTED_TEXT_FOLDER, reference_key + FileType.TXT.value
+    )
+    with open(txt_file_location, "r") as f:
+        return f.read()
+
+
+def open_manifest() -> Manifest:
+    manifest = Manifest()
+    if manifest.is_empty():
+        # State of previous versions lived only in folders
+        manifest.import_folders(EXTRACTED_TEXT_FOLDER, TOKEN_COUNT_FOLDER, NOTES_OUTPUT_FOLDER)
+    if not manifest.has_note_index():
+        # Notes written before the index existed
+        manifest.import_notes(NOTES_OUTPUT_FOLDER)
+    return manifest
+
+
+@dataclass
+class NotesContext:
+    """Everything note generation of a single paper shares with the others"""
+    scheduler: RequestScheduler
+    client: Client
+    manifest: Manifest
+    router: Router = field(default_factory=Router)
+    # Papers exceeding MAX_API_TOKENS_ALLOWED are chunked only if it is given
+    tokenizer: Any = None
+    # Papers whose notes failed all the attempts since the last report
+    failed: list[str] = field(default_factory=list)
+    # Notes of one paper at a time are deduplicated and indexed, as merging
+    # edits notes of other papers and the search index has a single writer
+    index_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+def notes_request(instructions: str, content: str) -> Callable[[Model], Request]:
+    """Builder of the request for whichever model the router picks"""
+    return lambda model: assemble(model, instructions, content)
+
+
+async def single_request_notes(reference_key, txt_content, token_count, path_for_notes, context: NotesContext) -> int:
+    build = notes_request(prompts.idea_separation(), prompts.paper_contents(txt_content))
+    partial_path = os.path.join(path_for_notes, PARTIAL_STREAM_FILE)
+
+    parser = NoteParser()
+    notes_written = 0
+
+    if STREAM_RESPONSES:
+        # Output streamed so far is kept on disk, so an interrupted paper
+        # continues from its last complete note instead of starting over
+        if os.path.exists(partial_path):
+            with open(partial_path, "r") as f:
+                partial_content = f.read()
+            _, incomplete_note = split_resumable(partial_content)
+            parser.feed(incomplete_note)
+            if partial_content:
+                build_fresh = build
+
+                def build(model: Model) -> Request:
+                    request = build_fresh(model)
+                    request.messages.append(Message(Role.ASSISTANT, partial_content))
+                    return request
+
+                print(f"Resuming {reference_key}")
+
+        with open(partial_path, "a") as partial_file:
+            async for chunk in context.router.stream(build, token_count, context.client, context.scheduler):
+                with metrics.timer("parse"):
+                    notes = parser.feed(chunk)
+                for note in notes:
+                    notes_written += write_note(note, path_for_notes, reference_key, context.manifest)
+                partial_file.write(chunk)
+                partial_file.flush()
+    else:
+        try:
+            content = await context.router.generate(build, token_count, context.client, context.scheduler)
+        except Exception:
+            print(f"Got key for the API call for file: {reference_key}")
+            raise
+        with metrics.timer("parse"):
+            notes = parser.feed(content)
+        for note in notes:
+            notes_written += write_note(note, path_for_notes, reference_key, context.manifest)
+
+    for note in parser.close():
+        notes_written += write_note(note, path_for_notes, reference_key, context.manifest)
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    return notes_written
+
+
+async def chunked_notes(reference_key, txt_content, token_count, path_for_notes, context: NotesContext) -> int:
+    """Map-reduce for papers exceeding MAX_API_TOKENS_ALLOWED
+
+    Notes are generated for every chunk concurrently, then a single merge
+    request deduplicates and links them. Output of each finished chunk is
+    kept in the notes folder until the merge is done, so an interrupted paper
+    only redoes the missing chunks
+    """
+    chunks = split_into_chunks(txt_content, context.tokenizer, CHUNK_MAX_TOKENS)
+    print(f"Split {reference_key} into {len(chunks)} chunks")
+
+    async def notes_for_chunk(i: int, chunk: str) -> str:
+        chunk_path = os.path.join(path_for_notes, f"{CHUNK_OUTPUT_PREFIX}{i}")
+        if os.path.exists(chunk_path):
+            with open(chunk_path, "r") as f:
+                return f.read()
+        build = notes_request(
+            prompts.idea_separation(), prompts.paper_contents(chunk, i + 1, len(chunks))
+        )
+        chunk_tokens = token_count * len(chunk) // max(1, len(txt_content))
+        output = await context.scheduler.run(
+            chunk_tokens, lambda: context.router.generate(build, chunk_tokens, context.client, context.scheduler)
+        )
+        with open(chunk_path, "w") as f:
+            f.write(output)
+        return output
+
+    outputs = await asyncio.gather(*[notes_for_chunk(i, c) for i, c in enumerate(chunks)])
+
+    chunk_notes = []
+    for output in outputs:
+        parser = NoteParser()
+        for note in parser.feed(output) + parser.close():
+            note = clean_from_code_blocks(note).strip()
+            if note.startswith("# "):
+                chunk_notes.append(note)
+
+    build_merge = notes_request(prompts.merge_notes(), prompts.notes_to_merge(chunk_notes))
+    merge_tokens = token_count * sum(len(n) for n in chunk_notes) // max(1, len(txt_content))
+    merged = await context.scheduler.run(
+        merge_tokens, lambda: context.router.generate(build_merge, merge_tokens, context.client, context.scheduler)
+    )
 
-def find_most_similar(key: str, values: list[str]) -> str | None:
-    best_match: str = ""
-    match_percentage: int = 0
+    parser = NoteParser()
+    notes_written = 0
+    for note in parser.feed(merged) + parser.close():
+        notes_written += write_note(note, path_for_notes, reference_key, context.manifest)
 
-    for element in values:
-            p = fuzz.token_set_ratio(element, key)
-            if p > match_percentage:
-                match_percentage = p
-                best_match = element
+    if notes_written == 0:
+        print(f"WARNING | Merge produced no notes for {reference_key}, saving unmerged notes")
+        for note in chunk_notes:
+            notes_written += write_note(note, path_for_notes, reference_key, context.manifest)
+
+    for i in range(len(chunks)):
+        chunk_path = os.path.join(path_for_notes, f"{CHUNK_OUTPUT_PREFIX}{i}")
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+    return notes_written
+
+
+async def packed_notes(reference_keys, txt_contents, token_count, context: NotesContext) -> list[int]:
+    """Generates notes of several papers with a single request, returns
+    number of notes written for every paper
+    """
+    build = notes_request(prompts.packed_idea_separation(), prompts.packed_paper_contents(txt_contents))
+    parser = PackParser(len(reference_keys))
+    notes_written = [0] * len(reference_keys)
+
+    def write(parsed_notes: list[tuple[int, str]]):
+        for i, note in parsed_notes:
+            path_for_notes = os.path.join(NOTES_OUTPUT_FOLDER, reference_keys[i])
+            notes_written[i] += write_note(note, path_for_notes, reference_keys[i], context.manifest)
+
+    async for chunk in context.router.stream(build, token_count, context.client, context.scheduler):
+        with metrics.timer("parse"):
+            parsed_notes = parser.feed(chunk)
+        write(parsed_notes)
+    write(parser.close())
+    return notes_written
+
+
+def has_notes(reference_key: str, manifest: Manifest) -> bool:
+    # Deleting notes folder is the way to generate notes of a paper again
+    path_for_notes = os.path.join(NOTES_OUTPUT_FOLDER, reference_key)
+    return (
+        manifest.notes_status(reference_key) == Status.DONE
+        and manifest.note_count(reference_key) > 0
+        and os.path.isdir(path_for_notes)
+    )
 
-    if match_percentage < 90:
-        return None
-    return best_match
 
+def discard_notes(reference_key: str, manifest: Manifest):
+    """Removes notes written by a failed attempt, files and index alike"""
+    path_for_notes = os.path.join(NOTES_OUTPUT_FOLDER, reference_key)
+    for file_name in manifest.note_files(reference_key):
+        note_path = os.path.join(path_for_notes, file_name + FileType.MARKDOWN.value)
+        if os.path.exists(note_path):
+            os.remove(note_path)
+    manifest.forget_notes(reference_key)
 
-def extract_or(json: dict, expr_str: str, default: str | None = None):
-        res = parse(expr_str).find(json)
-        if res and len(res) > 0:
-            return res[0].value
-        return default
 
+def is_packable(reference_key: str, manifest: Manifest) -> bool:
+    return (
+        PACK_SMALL_PAPERS
+        and manifest.token_count(reference_key) <= PACK_MAX_TOKENS_PER_PAPER
+        and not has_notes(reference_key, manifest)
+    )
 
-def reference_key_map_generator(items: list[dict[str, str]], pdf_titles: list[str]) -> dict[str, str]:
 
-    mapping = {}
-    for item in items:
-        author_surname_part = extract_or(item, "$.author[0].literal")
-        author_surname_part = extract_or(item, "$.author[0].family", author_surname_part)
+async def notes_for_pack(iteration, reference_keys, total_count, context: NotesContext):
+    """Generates notes of several small papers with a single request. Papers
+    which got no notes out of it are processed one by one
+    """
+    if len(reference_keys) == 1:
+        await notes_for_paper(iteration, reference_keys[0], total_count, context)
+        return
 
-        et_al_part = None
-        maybe_authors = extract_or(item, "$.author", None)
-        if maybe_authors and len(maybe_authors) == 2:
-            et_al_part = extract_or(item, "$.author[1].literal")
-            et_al_part = extract_or(item, "$.author[1].family", et_al_part)
-            if et_al_part:
-                et_al_part = f"and {et_al_part}"
-        elif maybe_authors and len(maybe_authors) > 2:
-            et_al_part = "et al."
+    start_time = time.time()
+    for reference_key in reference_keys:
+        os.makedirs(os.path.join(NOTES_OUTPUT_FOLDER, reference_key), exist_ok=True)
+        context.manifest.record_notes_started(reference_key)
+        context.manifest.forget_notes(reference_key)
 
-        full_author_part: str = ""
-        if author_surname_part:
-            full_author_part = author_surname_part
-            if et_al_part:
-                full_author_part += " " + et_al_part
-            full_author_part += " - "
+    try:
+        token_count = sum(context.manifest.token_count(k) for k in reference_keys)
 
-        maybe_issued = extract_or(item, "$.issued.date-parts[0][0]")
-        year_part: str = ""
-        if maybe_issued:
-            year_part = f"{maybe_issued} - "
+        async def request() -> list[int]:
+            logProgress(
+                iteration,
+                total_count,
+                f"Started separating into ideas {len(reference_keys)} packed papers: {', '.join(reference_keys)}",
+            )
+            return await packed_notes(
+                reference_keys, [read_text(k) for k in reference_keys], token_count, context
+            )
 
-        maybe_paper_title = extract_or(item, "$.title")
-        title_part: str = ""
-        if maybe_paper_title:
-            title_part = maybe_paper_title
-        else:
-            print("ERROR | Not paper title!!!")
+        notes_written = await context.scheduler.run(token_count, request)
+        if sum(notes_written) == 0:
+            raise EmptyResponseError("Answer has no notes of any packed paper")
+    except Exception as e:
+        # Papers of a failed pack get retried one by one, so one broken paper
+        # can't fail the others
+        metrics.increment("packed_request_failures")
+        print(f"WARNING | Packed request failed, processing its papers alone: {describe_error(e)}")
+        # Packs can't be resumed, notes streamed before the failure would
+        # be left next to the ones written again
+        for reference_key in reference_keys:
+            discard_notes(reference_key, context.manifest)
+        await asyncio.gather(*[
+            notes_for_paper(iteration, k, total_count, context) for k in reference_keys
+        ])
+        return
 
-        full_pdf_paper_name: str = full_author_part + year_part + title_part
+    elapsed_time = time.time() - start_time
+    metrics.increment("packed_requests")
+    missing = []
+    for reference_key, count in zip(reference_keys, notes_written):
+        if count == 0:
+            missing.append(reference_key)
+            continue
+        metrics.observe("notes", elapsed_time)
+        context.manifest.record_notes_done(reference_key, count, elapsed_time)
+        await after_notes(reference_key, context)
+    logProgress(
+        iteration,
+        total_count,
+        f"Processed {sum(notes_written)} notes of {len(reference_keys) - len(missing)} packed papers created in {format_time(elapsed_time)}",
+    )
 
-        full_pdf_paper_name = sanitize_file_name(full_pdf_paper_name[:MAX_CHARS_IN_FILE_NAME])
+    for reference_key in missing:
+        print(f"WARNING | Packed request produced no notes for {reference_key}, processing it alone")
+    await asyncio.gather(*[
+        notes_for_paper(iteration, k, total_count, context) for k in missing
+    ])
 
-        maybe_reference_key = extract_or(item, "$.id")
-        if maybe_reference_key:
-            actual_pdf = find_most_similar(full_pdf_paper_name, pdf_titles)
-            if actual_pdf:
-                mapping[actual_pdf] = maybe_reference_key
-        else:
-            print("ERROR | Not found reference key!!!")
 
-    return mapping
+def describe_error(error: BaseException) -> str:
+    # str() of timeouts and some transport errors is empty
+    return f"{type(error).__name__}: {error}" if str(error) else type(error).__name__
 
 
+def retry_pause(attempt: int) -> float:
+    """Exponential backoff randomized by half, so papers failed by the same
+    outage don't all come back at the same moment
+    """
+    backoff = NOTES_RETRY_BACKOFF * 2 ** (attempt - 1)
+    return random.uniform(backoff / 2, backoff)
 
-async def notes_for_paper(iteration, reference_key, total_count, semaphore):
-    async with semaphore:
-        start_time = time.time()
-        path_for_notes = os.path.join(NOTES_OUTPUT_FOLDER, reference_key)
-        os.makedirs(path_for_notes, exist_ok=True)
 
-        number_of_notes_in_folder = len(
-            filenames_in_folder(path_for_notes, FileType.MARKDOWN)
-        )
-        if number_of_notes_in_folder > 0:
-            logProgress(
-                iteration,
-                total_count,
-                f"Skipped, already has {number_of_notes_in_folder} notes",
-            )
-            return
+async def paper_notes(iteration, reference_key, total_count, path_for_notes, context: NotesContext) -> int:
+    """Single attempt to create notes of a paper, returns number of notes the
+    paper has. An answer without any note is an error, so it gets retried
+    instead of marking the paper done
+    """
+    await paper_answer(iteration, reference_key, total_count, path_for_notes, context)
+    # A resumed stream only writes the notes missing after the interruption
+    note_count = len(context.manifest.note_files(reference_key))
+    if note_count == 0:
+        raise EmptyResponseError(f"Answer has no notes for {reference_key}")
+    return note_count
+
+
+async def paper_answer(iteration, reference_key, total_count, path_for_notes, context: NotesContext) -> int:
+    """Requests notes of a paper, returns number of notes written"""
+    token_count = context.manifest.token_count(reference_key)
+    if context.tokenizer is not None and token_count > MAX_API_TOKENS_ALLOWED:
+        # Chunks are scheduled as separate requests
         logProgress(
             iteration,
             total_count,
-            f"Started separating into ideas {reference_key}",
+            f"Started separating into ideas in chunks {reference_key}",
+        )
+        return await chunked_notes(
+            reference_key, read_text(reference_key), token_count, path_for_notes, context
         )
 
-        txt_file_location = os.path.join(
-            EXTRACTED_TEXT_FOLDER, reference_key + FileType.TXT.value
+    async def request() -> int:
+        logProgress(
+            iteration,
+            total_count,
+            f"Started separating into ideas {reference_key}",
         )
-        with open(txt_file_location, "r") as f:
-            txt_content = f.read()
-
-        request = Request(
-            model=Model.GeminiFlash,
-            messages=[
-                Message(Role.SYSTEM, prompts.system_prompt()),
-                Message(Role.USER, prompts.idea_separation(txt_content)),
-            ],
+        # Text is read only once request is admitted, so papers waiting
+        # for their turn don't hold it in memory
+        return await single_request_notes(
+            reference_key, read_text(reference_key), token_count, path_for_notes, context
         )
-        result = await call(request)
-        try:
-            content = result["choices"][0]["message"]["content"]
-        except KeyError:
-            print(f"Got key for the API call for file: {reference_key}")
-            print(result)
-            raise Exception("No content field found in API answer, should never happen")
 
-        content_cleaned = clean_from_code_blocks(content)
+    return await context.scheduler.run(token_count, request)
 
-        individual_notes = [t.strip() for t in content_cleaned.split("---")]
 
-        for note in individual_notes:
-            lines = note.splitlines()
-            if len(lines) == 0 or not lines[0].startswith("# "):
-                continue
-            title = lines[0].replace("# ", "")
-            note_path = os.path.join(path_for_notes, title + FileType.MARKDOWN.value)
-            formatted_note_content = format_note(note, reference_key)
-            with open(note_path, "w") as f:
-                f.write(formatted_note_content)
+async def notes_for_paper(iteration, reference_key, total_count, context: NotesContext):
+    """Creates notes of a paper, retrying transient failures. Never raises:
+    a paper failing all NOTES_MAX_ATTEMPTS is recorded in the manifest and
+    in `context.failed`, while the other papers go on
+    """
+    start_time = time.time()
+    path_for_notes = os.path.join(NOTES_OUTPUT_FOLDER, reference_key)
 
-        elapsed_time = time.time() - start_time
+    if has_notes(reference_key, context.manifest):
         logProgress(
             iteration,
             total_count,
-            f"Processed {len(individual_notes)} notes created in {format_time(elapsed_time)}",
+            f"Skipped, already has {context.manifest.note_count(reference_key)} notes",
         )
+        return
 
+    os.makedirs(path_for_notes, exist_ok=True)
+    context.manifest.record_notes_started(reference_key)
+    if not os.path.exists(os.path.join(path_for_notes, PARTIAL_STREAM_FILE)):
+        # Notes of an earlier attempt are written again, a resumed stream
+        # only adds the missing ones
+        context.manifest.forget_notes(reference_key)
 
-async def create_notes():
-    os.makedirs(NOTES_OUTPUT_FOLDER, exist_ok=True)
-    txt_files = filenames_in_folder(EXTRACTED_TEXT_FOLDER, FileType.TXT)
+    for attempt in range(1, NOTES_MAX_ATTEMPTS + 1):
+        try:
+            notes_written = await paper_notes(iteration, reference_key, total_count, path_for_notes, context)
+            break
+        except Exception as e:
+            if is_transient(e) and attempt < NOTES_MAX_ATTEMPTS:
+                pause = retry_pause(attempt)
+                metrics.increment("notes_retries")
+                logProgress(
+                    iteration,
+                    total_count,
+                    f"WARNING | Attempt {attempt} failed for {reference_key}, retrying in {pause:.0f}s: {describe_error(e)}",
+                )
+                await asyncio.sleep(pause)
+                continue
+            metrics.increment("notes_failures")
+            context.manifest.record_notes_failure(reference_key, describe_error(e), attempt)
+            context.failed.append(reference_key)
+            logProgress(
+                iteration,
+                total_count,
+                f"ERROR | Failed to create notes for {reference_key} after {attempt} attempts: {describe_error(e)}",
+            )
+            return
 
-    inputs = [(i + 1, t, len(txt_files)) for i, t in enumerate(txt_files)]
+    elapsed_time = time.time() - start_time
+    metrics.observe("notes", elapsed_time)
+    context.manifest.record_notes_done(reference_key, notes_written, elapsed_time)
+    await after_notes(reference_key, context)
+    logProgress(
+        iteration,
+        total_count,
+        f"Processed {notes_written} notes created in {format_time(elapsed_time)}",
+    )
 
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    tasks = [notes_for_paper(i, t, l, semaphore) for i, t, l in inputs]
-    await asyncio.gather(*tasks)
+async def after_notes(reference_key: str, context: NotesContext):
+    """Deduplicates and indexes notes the paper just got. They are written
+    and the paper is done by now, so a failure here is only reported and
+    left to the `dedup` and `search --rebuild` stages
+    """
+    try:
+        await dedup_notes(reference_key, context)
+    except Exception as e:
+        metrics.increment("dedup_failures")
+        print(f"ERROR | Failed to deduplicate notes of {reference_key}, run dedup stage later: {describe_error(e)}")
+    try:
+        await index_notes(reference_key, context)
+    except Exception as e:
+        metrics.increment("search_index_failures")
+        print(f"ERROR | Failed to index notes of {reference_key}, run search --rebuild later: {describe_error(e)}")
+
+
+async def dedup_notes(reference_key: str, context: NotesContext):
+    """Compares notes the paper just got with notes of all the other papers,
+    in a thread so requests of other papers go on meanwhile
+    """
+    if not DEDUP_NOTES:
+        return
+    async with context.index_lock:
+        with metrics.timer("dedup"):
+            duplicates = await asyncio.to_thread(deduplicate, context.manifest, reference_key)
+    if len(duplicates) > 0:
+        metrics.increment("duplicate_notes", len(duplicates))
+        action = "merged" if DEDUP_ACTION == "merge" else "linked"
+        print(f"Found {len(duplicates)} notes of {reference_key} duplicating other papers, {action} them")
+
+
+async def index_notes(reference_key: str, context: NotesContext):
+    """Makes notes the paper just got searchable, in a thread as indexing
+    may compact the whole index
+    """
+    if not SEARCH_INDEX:
+        return
+    async with context.index_lock:
+        with metrics.timer("search_index"):
+            await asyncio.to_thread(SearchIndex(context.manifest).update, reference_key)
 
 
-def main():
-    ################ Parsing arguments #############################
-    parser = argparse.ArgumentParser(
-        description="CLI App that creates atomic notes out of scientific pdf papers"
-    )
-    parser.add_argument(
-        "--all",
-        action="store_true",
-        help="Execute everything without asking. WARNING: some files may get deleted",
-    )
+def report_failed_notes(context: NotesContext):
+    """Summary of papers failed since the last report"""
+    if len(context.failed) == 0:
+        return
+    failed = {k: (error, attempts) for k, error, attempts in context.manifest.failed_notes()}
+    print(f"WARNING | Failed to create notes for {len(context.failed)} papers:")
+    for reference_key in context.failed:
+        error, attempts = failed.get(reference_key, ("", 1))
+        print(f"- {reference_key} | {attempts} attempts | {error}")
+    print("Run notes stage with --retry-failed to process only them again")
+    context.failed.clear()
 
-    args = parser.parse_args()
-    ################ Creating all required directories ############################
-    os.makedirs(EXTRACTED_TEXT_FOLDER, exist_ok=True)
-    os.makedirs(TOKEN_COUNT_FOLDER, exist_ok=True)
+
+def response_cache(args) -> ResponseCache | None:
+    if args.no_cache:
+        return None
+    return ResponseCache(read=not args.refresh)
+
+
+def print_client_stats(client: Client, recorded: Usage | None = None):
+    """Prints usage of the client, adding what isn't `recorded` yet to metrics"""
+    metrics.record_usage(client.usage if recorded is None else client.usage.since(recorded))
+    print(f"Usage: {client.usage}")
+    if client.cache is not None:
+        print(f"Response cache: {client.cache.hits} hits, {client.cache.misses} misses")
+
+
+async def create_notes(
+    manifest: Manifest, tokenizer=None, cache: ResponseCache | None = None, only: list[str] | None = None
+):
+    """Generates notes for all the extracted papers, or `only` the given ones.
+    If `tokenizer` is given, papers exceeding MAX_API_TOKENS_ALLOWED are
+    processed in chunks
+    """
     os.makedirs(NOTES_OUTPUT_FOLDER, exist_ok=True)
-    os.makedirs(PDF_PAPERS_FOLDER, exist_ok=True)
 
-    ################ Flattening PDFs directory ############################
+    # Largest papers go first, so they don't end up as the long tail of the run
+    reference_keys = manifest.extracted_keys()
+    if only is not None:
+        reference_keys = [k for k in reference_keys if k in set(only)]
+
+    iterations = {reference_key: i + 1 for i, reference_key in enumerate(reference_keys)}
+    total_count = len(reference_keys)
+
+    packable = {k: manifest.token_count(k) for k in reference_keys if is_packable(k, manifest)}
+    packs = pack_papers(packable, PACK_MAX_TOKENS, PACK_MAX_PAPERS)
+
+    async with Client(cache) as client:
+        context = NotesContext(RequestScheduler(), client, manifest, tokenizer=tokenizer)
+        tasks = [
+            notes_for_paper(iterations[k], k, total_count, context)
+            for k in reference_keys
+            if k not in packable
+        ]
+        tasks += [notes_for_pack(iterations[p[0]], p, total_count, context) for p in packs]
+        await asyncio.gather(*tasks)
+
+    print_client_stats(client)
+    report_failed_notes(context)
+
+
+def stage_flatten(args):
+    os.makedirs(PDF_PAPERS_FOLDER, exist_ok=True)
 
     print(f"Flattening... {PDF_PAPERS_RAW_FOLDER} --> {PDF_PAPERS_FOLDER}")
-    flatten_folder(PDF_PAPERS_RAW_FOLDER, PDF_PAPERS_FOLDER)
+    with metrics.timer("flatten"):
+        flatten_folder(PDF_PAPERS_RAW_FOLDER, PDF_PAPERS_FOLDER, LinkMode(args.link))
     print(f"Flattened successfully")
 
-    ################ Reading Contents of Folders #############################
+
+def stage_resolve(args) -> dict[str, str] | None:
+    """Maps PDF file names to reference keys and saves the mapping to the
+    manifest. Returns None if some PDF has no reference key
+    """
+    from common.reference import reference_key_map_generator
+
+    os.makedirs(EXTRACTED_TEXT_FOLDER, exist_ok=True)
+    os.makedirs(PDF_PAPERS_FOLDER, exist_ok=True)
 
     existing_text_files = filenames_in_folder(EXTRACTED_TEXT_FOLDER, FileType.TXT)
-    existing_token_files = filenames_in_folder(TOKEN_COUNT_FOLDER, FileType.TOKEN)
     pdf_files = filenames_in_folder(PDF_PAPERS_FOLDER, FileType.PDF)
-    pdf_files_len = len(pdf_files)
 
     ################# Checking all reference keys exist #####################
-    with open(JSON_REFERENCE_KEY_FILE) as f:
+    with metrics.timer("resolve"), open(JSON_REFERENCE_KEY_FILE) as f:
         reference_key_file: list[dict[str, str]] = json.load(f)
         reference_key_map = reference_key_map_generator(reference_key_file, pdf_files)
 
@@ -334,7 +663,7 @@ def main():
         )
         for n in no_reference_keys_for:
             print(f"- {n}")
-        return
+        return None
 
     ################ Removing unlinked TXT files #############################
 
@@ -347,116 +676,707 @@ def main():
             print(f"WARNING | No matching PDF for existing txt file: {f}")
 
         if args.all or ask_user("Do you want to remove these files?"):
+            manifest = open_manifest()
             for f in txt_files_with_no_matching_pdfs:
                 path = os.path.join(EXTRACTED_TEXT_FOLDER, f + FileType.TXT.value)
                 os.remove(path)
+                manifest.remove(f)
                 print(f"Removed: {path}")
+            manifest.close()
 
-    ################ Extracting PDF to TXT ##################################
+    manifest = open_manifest()
+    manifest.record_resolution(reference_key_map)
+    manifest.close()
 
-    if not (
-        args.all
-        or ask_user("Step 1: Now we will extract text from PDF files. Proceed?")
-    ):
-        return
+    print(f"Resolved {len(reference_key_map)} reference keys")
+
+    return reference_key_map
+
+
+def token_thresholds() -> list[float]:
+    """Token counts at which a paper gets handled differently, estimates
+    close to them are not good enough
+    """
+    thresholds = [MAX_API_TOKENS_ALLOWED]
+    if PACK_SMALL_PAPERS:
+        thresholds.append(PACK_MAX_TOKENS_PER_PAPER)
+    thresholds += [CONTEXT_WINDOWS[Model(m)] - NOTES_OUTPUT_TOKENS_RESERVE for m in NOTES_MODELS]
+    return thresholds
+
+
+def extraction_results(
+    args, reference_key_map: dict[str, str], manifest: Manifest, executor=None
+) -> Iterator[str]:
+    """Extracts text of all the PDFs in `reference_key_map`, yielding reference
+    keys as soon as their text and token count are on disk. Already extracted
+    and cached papers come first. A warm `executor` of `extraction_pool` is
+    used if given
+    """
+    from common.extraction import ExtractionJob, extract_all
+    from common.extraction_cache import ExtractionCache, hash_files
+    from common.tokenizer import TokenEstimator, tokenizer_snapshot
+
+    os.makedirs(EXTRACTED_TEXT_FOLDER, exist_ok=True)
 
-    print("Initializing tokenizer")
-    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_MODEL)
+    pdf_files_len = len(reference_key_map)
+
+    # Cache entries record the tokenizer commit, which is only known once
+    # the snapshot is taken
+    tokenizer_snapshot()
+    cache = ExtractionCache()
+    pdf_paths = {
+        pdf_filename: os.path.join(PDF_PAPERS_FOLDER, pdf_filename + FileType.PDF.value)
+        for pdf_filename in reference_key_map.keys()
+    }
+    print(f"Hashing {len(pdf_paths)} PDFs")
+    with metrics.timer("hash"):
+        pdf_hashes = hash_files(list(pdf_paths.values()))
+
+    estimator = TokenEstimator(token_thresholds()) if ESTIMATE_TOKENS else None
+
+    def needs_extraction(pdf_hash: str) -> bool:
+        # Text extracted with other compaction or tokenizer settings is out of
+        # date, and estimated counts near a limit may be on its wrong side
+        if cache.is_stale(pdf_hash):
+            return True
+        return cache.has(pdf_hash) and cache.is_estimated(pdf_hash) and (
+            estimator is None or estimator.is_near(cache.token_count(pdf_hash))
+        )
 
+    jobs: list[ExtractionJob] = []
+    job_hashes: dict[str, str] = {}
     for i, (pdf_filename, reference_key) in enumerate(reference_key_map.items()):
         it = i + 1
+        pdf_path = pdf_paths[pdf_filename]
+        pdf_hash = pdf_hashes[pdf_path]
+        txt_path = os.path.join(EXTRACTED_TEXT_FOLDER, reference_key + FileType.TXT.value)
 
-        if (
-            reference_key in existing_text_files
-            and reference_key in existing_token_files
-        ):
+        redo = needs_extraction(pdf_hash)
+        if manifest.is_extracted(reference_key, pdf_hash) and not redo:
             logProgress(
                 it, pdf_files_len, f"Skipping already processed: {reference_key}"
             )
+            yield reference_key
             continue
 
-        text = convert_to_txt(pdf_filename)
+        if cache.has(pdf_hash) and not redo:
+            metrics.increment("extraction_cache_hits")
+            cache.materialize(reference_key, pdf_hash, txt_path)
+            manifest.record_extraction(
+                reference_key, pdf_hash, cache.token_count(pdf_hash),
+                raw_token_count=cache.raw_token_count(pdf_hash),
+            )
+            logProgress(it, pdf_files_len, f"Reused cached extraction: {reference_key}")
+            yield reference_key
+            continue
 
-        # Saving TXT
-        txt_path = os.path.join(
-            EXTRACTED_TEXT_FOLDER, reference_key + FileType.TXT.value
-        )
-        with open(txt_path, "w", encoding="utf-8") as txt_file:
+        jobs.append(ExtractionJob(pdf_path, reference_key, cache.staging_path(reference_key, pdf_hash)))
+        job_hashes[reference_key] = pdf_hash
+
+    failed_extractions = []
+    try:
+        for i, result in enumerate(extract_all(jobs, args.jobs, executor, estimator)):
+            it = i + 1
+            reference_key = result.reference_key
+
+            if result.error is not None:
+                metrics.increment("extraction_failures")
+                failed_extractions.append((reference_key, result.error))
+                manifest.record_extraction_failure(reference_key, result.error)
+                logProgress(it, len(jobs), f"ERROR | Failed to extract {reference_key}: {result.error}")
+                continue
+
+            # Saving TXT, manifest is updated last, so the paper counts as
+            # extracted only once its text is on disk
+            txt_path = os.path.join(
+                EXTRACTED_TEXT_FOLDER, reference_key + FileType.TXT.value
+            )
+            pdf_hash = job_hashes[reference_key]
+            cache.put(
+                reference_key, pdf_hash, result.text_path, result.token_count, result.pages, result.raw_token_count,
+                result.estimated,
+            )
+            cache.materialize(reference_key, pdf_hash, txt_path)
+            manifest.record_extraction(
+                reference_key, pdf_hash, result.token_count, result.seconds, result.raw_token_count
+            )
+            metrics.observe("extract", result.seconds - result.tokenize_seconds)
+            metrics.observe("tokenize", result.tokenize_seconds)
+            tokens_saved = result.raw_token_count - result.token_count
+            metrics.increment("tokens_saved_by_compaction", tokens_saved)
+            metrics.increment("token_counts_estimated" if result.estimated else "token_counts_exact")
+
+            about = "~" if result.estimated else ""
             logProgress(
-                it, pdf_files_len, f"Saved {reference_key}"
+                it,
+                len(jobs),
+                f"Processed {about}{result.token_count} tokens ({tokens_saved} saved by compaction): {reference_key}",
             )
-            txt_file.write(text)
+            yield reference_key
+    finally:
+        cache.save()
+        if estimator is not None:
+            estimator.save()
 
-        token_count = len(tokenizer.encode(text, add_special_tokens=True))
+    if len(failed_extractions) > 0:
+        print(f"WARNING | Failed to extract {len(failed_extractions)} files:")
+        for reference_key, error in failed_extractions:
+            print(f"- {reference_key} | {error}")
 
-        # Saving TOKEN
-        file_path = os.path.join(
-            TOKEN_COUNT_FOLDER, reference_key + FileType.TOKEN.value
-        )
-        with open(file_path, "w", encoding="utf-8") as json_file:
-            json.dump({"tokens": token_count}, json_file, indent=4)
+    print("Extraction complete")
 
-        logProgress(
-            it, pdf_files_len, f"Processed {token_count} tokens: {reference_key}"
-        )
 
-    print("Extraction complete")
+def stage_extract(args, reference_key_map: dict[str, str] | None = None):
+    if reference_key_map is None:
+        reference_key_map = stage_resolve(args)
+        if reference_key_map is None:
+            return
 
-    ################ Checking TOKEN Warnings ##################################
+    manifest = open_manifest()
+    for _ in extraction_results(args, reference_key_map, manifest):
+        pass
+    manifest.close()
+
+
+def remove_redundant_notes(args, reference_keys: list[str]):
+    os.makedirs(NOTES_OUTPUT_FOLDER, exist_ok=True)
+    notes_names = filenames_in_folder(NOTES_OUTPUT_FOLDER, FileType.FOLDER)
+    redundant_notes = set(notes_names).difference(set(reference_keys))
+    if len(redundant_notes) > 0:
+        for f in redundant_notes:
+            print(f"WARNING | Redundunt notes exist in folder: {f}")
+        if args.all or ask_user("Do you want to remove these files?"):
+            manifest = open_manifest()
+            for f in redundant_notes:
+                path = os.path.join(NOTES_OUTPUT_FOLDER, f)
+                shutil.rmtree(path)
+                manifest.forget_notes(f)
+                print(f"Removed: {path}")
+            manifest.close()
+
+
+def retry_failed_notes(args, manifest: Manifest):
+    """Generates notes only of papers failed in earlier runs"""
+    reference_keys = [k for k, _, _ in manifest.failed_notes()]
+    if len(reference_keys) == 0:
+        print("No papers failed to create notes")
+        return
+    print(f"Retrying {len(reference_keys)} papers failed to create notes")
+
+    tokenizer = None
+    if CHUNK_LONG_PAPERS and any(manifest.token_count(k) > MAX_API_TOKENS_ALLOWED for k in reference_keys):
+        from common.tokenizer import load_tokenizer
+
+        print("Initializing tokenizer")
+        tokenizer = load_tokenizer()
 
-    token_files = filenames_in_folder(TOKEN_COUNT_FOLDER, FileType.TOKEN)
+    asyncio.run(create_notes(manifest, tokenizer, response_cache(args), only=reference_keys))
+
+
+def stage_notes(args, ask_to_proceed: bool = False):
+    os.makedirs(EXTRACTED_TEXT_FOLDER, exist_ok=True)
+    os.makedirs(NOTES_OUTPUT_FOLDER, exist_ok=True)
+    manifest = open_manifest()
+
+    if args.retry_failed:
+        retry_failed_notes(args, manifest)
+        manifest.close()
+        return
+
+    ################ Checking TOKEN Warnings ##################################
 
-    token_warnings = []
-    for f in token_files:
-        path = os.path.join(TOKEN_COUNT_FOLDER, f + FileType.TOKEN.value)
-        with open(path, "r") as f:
-            tokens = int(json.loads(f.read())["tokens"])
-            if tokens > MAX_API_TOKENS_ALLOWED:
-                token_warnings.append((f, tokens))
-                print(f)
+    token_warnings = manifest.oversized(MAX_API_TOKENS_ALLOWED)
     if len(token_warnings) > 0:
         print()
         print(f"Following files exceed allowed token amount {MAX_API_TOKENS_ALLOWED}:")
         for file, tokens in token_warnings:
             print(f"- {tokens} | {file}")
 
-        if args.all or ask_user("Do you want to remove these files?"):
+        if CHUNK_LONG_PAPERS:
+            print(f"They will be processed in chunks of {CHUNK_MAX_TOKENS} tokens")
+        elif args.all or ask_user("Do you want to remove these files?"):
             for file, _ in token_warnings:
                 txt_path = os.path.join(
                     EXTRACTED_TEXT_FOLDER, file + FileType.TXT.value
                 )
                 pdf_path = os.path.join(PDF_PAPERS_FOLDER, file + FileType.PDF.value)
-                token_path = os.path.join(
-                    TOKEN_COUNT_FOLDER, file + FileType.TOKEN.value
-                )
-                for p in [txt_path, token_path, pdf_path]:
-                    os.remove(p)
-                    print(f"Removed: {p}")
+                for p in [txt_path, pdf_path]:
+                    if os.path.exists(p):
+                        os.remove(p)
+                        print(f"Removed: {p}")
+                manifest.remove(file)
 
     ################ Checking Redundant Notes ##############################
 
-    notes_names = filenames_in_folder(NOTES_OUTPUT_FOLDER, FileType.FOLDER)
-    redundant_notes = set(notes_names).difference(set(reference_key_map.values()))
-    if len(redundant_notes) > 0:
-        for f in redundant_notes:
-            print(f"WARNING | Redundunt notes exist in folder: {f}")
-        if args.all or ask_user("Do you want to remove these files?"):
-            for f in redundant_notes:
-                path = os.path.join(NOTES_OUTPUT_FOLDER, f)
-                shutil.rmtree(path)
-                print(f"Removed: {path}")
+    remove_redundant_notes(args, manifest.extracted_keys())
 
     ################ Generating Notes ##################################
 
-    if not (
+    if ask_to_proceed and not (
         args.all
         or ask_user(
             "Step 2: Now we will generate atomic notes out of extracted texts. Proceed?"
         )
+    ):
+        manifest.close()
+        return
+
+    tokenizer = None
+    if CHUNK_LONG_PAPERS and len(token_warnings) > 0:
+        from common.tokenizer import load_tokenizer
+
+        print("Initializing tokenizer")
+        tokenizer = load_tokenizer()
+
+    asyncio.run(create_notes(manifest, tokenizer, response_cache(args)))
+    manifest.close()
+
+
+def stage_status(args):
+    manifest = open_manifest()
+    summary = manifest.summary()
+    failures = manifest.failures()
+    oversized = manifest.oversized(MAX_API_TOKENS_ALLOWED)
+    raw_tokens, tokens_saved = manifest.compaction_savings()
+    manifest.close()
+
+    extraction = summary["extraction_status"]
+    notes = summary["notes_status"]
+    print(f"Papers:                   {sum(extraction.values())}")
+    print(f"Extracted:                {extraction.get(Status.DONE.value, 0)}")
+    print(f"Failed to extract:        {extraction.get(Status.FAILED.value, 0)}")
+    print(f"Over token limit:         {len(oversized)}")
+    if raw_tokens > 0:
+        print(f"Saved by compaction:      {tokens_saved} tokens ({100 * tokens_saved / raw_tokens:.1f}%)")
+    print(f"With notes:               {notes.get(Status.DONE.value, 0)}")
+    print(f"Interrupted:              {notes.get(Status.IN_PROGRESS.value, 0)}")
+    print(f"Failed to create notes:   {notes.get(Status.FAILED.value, 0)}")
+    print(f"Waiting for notes:        {notes.get(Status.PENDING.value, 0)}")
+
+    if len(failures) > 0:
+        print()
+        print("Failures:")
+        for reference_key, error in failures:
+            print(f"- {reference_key} | {error}")
+
+
+def stage_dedup(args):
+    manifest = open_manifest()
+    if args.rebuild:
+        manifest.reset_dedup()
+    reference_keys = manifest.undeduped_keys()
+    hasher = MinHasher()
+
+    duplicate_count = 0
+    for i, reference_key in enumerate(reference_keys):
+        duplicates = deduplicate(manifest, reference_key, hasher)
+        duplicate_count += len(duplicates)
+        for file_name, other_key, other, score in duplicates:
+            logProgress(i + 1, len(reference_keys), f"{reference_key}/{file_name} | {other_key}/{other} | {score:.2f}")
+    manifest.close()
+    print(f"Compared notes of {len(reference_keys)} papers, found {duplicate_count} near-duplicate notes")
+
+
+def stage_search(args):
+    manifest = open_manifest()
+    index = SearchIndex(manifest)
+    last_id, _ = manifest.search_doc_counts()
+    if args.rebuild or (last_id == 0 and manifest.has_note_index()):
+        print("Building search index")
+        index.rebuild()
+
+    if len(args.query) > 0:
+        start_time = time.perf_counter()
+        results = index.search(" ".join(args.query), args.k)
+        elapsed_time = time.perf_counter() - start_time
+        for score, reference_key, file_name in results:
+            print(f"{score:.3f} | {reference_key}/{file_name}")
+        print(f"Found {len(results)} notes in {elapsed_time * 1000:.1f}ms")
+    manifest.close()
+
+
+def stage_links(args):
+    manifest = open_manifest()
+    note_count, link_count = manifest.link_summary()
+    broken = manifest.broken_links()
+    orphans = manifest.orphan_notes()
+    manifest.close()
+
+    print(f"Notes:                    {note_count}")
+    print(f"Links:                    {link_count}")
+    print(f"Broken links:             {len(broken)}")
+    print(f"Orphan notes:             {len(orphans)}")
+
+    if len(broken) > 0:
+        print()
+        print("Broken links:")
+        for reference_key, file_name, target in broken:
+            print(f"- {reference_key}/{file_name} | [[{target}]]")
+
+    if len(orphans) > 0:
+        print()
+        print("Orphan notes (no other note links to them):")
+        for reference_key, file_name in orphans:
+            print(f"- {reference_key}/{file_name}")
+
+
+async def notes_pipeline(
+    args, reference_key_map: dict[str, str], context: NotesContext, executor=None
+) -> list[tuple[str, int]]:
+    """Streams extracted papers straight into note generation, returns papers
+    skipped for exceeding MAX_API_TOKENS_ALLOWED
+
+    Extraction runs in a thread feeding a bounded queue. At most
+    PIPELINE_MAX_PENDING_PAPERS papers wait for notes at a time, when the
+    limit is hit the queue fills up and extraction pauses
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[str | None] = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    pending = asyncio.Semaphore(PIPELINE_MAX_PENDING_PAPERS)
+    manifest = context.manifest
+
+    def produce():
+        try:
+            for reference_key in extraction_results(args, reference_key_map, manifest, executor):
+                asyncio.run_coroutine_threadsafe(queue.put(reference_key), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    producer = asyncio.create_task(asyncio.to_thread(produce))
+
+    total_count = len(reference_key_map)
+    skipped_oversized = []
+
+    async def consume(iteration: int, reference_key: str):
+        try:
+            await notes_for_paper(iteration, reference_key, total_count, context)
+        finally:
+            pending.release()
+
+    async def consume_pack(iteration: int, reference_keys: list[str]):
+        try:
+            await notes_for_pack(iteration, reference_keys, total_count, context)
+        finally:
+            for _ in reference_keys:
+                pending.release()
+
+    # Small papers are collected until the pack is full, papers arrive in
+    # extraction order, so packs are filled next fit
+    pack: list[tuple[int, str]] = []
+    pack_tokens = 0
+
+    def dispatch_pack():
+        nonlocal pack, pack_tokens
+        if len(pack) > 0:
+            tasks.append(asyncio.create_task(consume_pack(pack[0][0], [k for _, k in pack])))
+        pack, pack_tokens = [], 0
+
+    tasks = []
+    iteration = 0
+    while True:
+        if pending.locked():
+            # Papers waiting in the pack hold their slots too
+            dispatch_pack()
+        await pending.acquire()
+        reference_key = await queue.get()
+        if reference_key is None:
+            break
+        iteration += 1
+        tokens = manifest.token_count(reference_key)
+        if not CHUNK_LONG_PAPERS and tokens > MAX_API_TOKENS_ALLOWED:
+            skipped_oversized.append((reference_key, tokens))
+            pending.release()
+            continue
+        if is_packable(reference_key, manifest):
+            if pack_tokens + tokens > PACK_MAX_TOKENS or len(pack) == PACK_MAX_PAPERS:
+                dispatch_pack()
+            pack.append((iteration, reference_key))
+            pack_tokens += tokens
+            continue
+        tasks.append(asyncio.create_task(consume(iteration, reference_key)))
+    dispatch_pack()
+
+    await producer
+    await asyncio.gather(*tasks)
+    return skipped_oversized
+
+
+def print_skipped_oversized(skipped_oversized: list[tuple[str, int]]):
+    if len(skipped_oversized) > 0:
+        print(f"WARNING | Skipped files exceeding allowed token amount {MAX_API_TOKENS_ALLOWED}:")
+        for reference_key, tokens in skipped_oversized:
+            print(f"- {tokens} | {reference_key}")
+
+
+async def extract_and_create_notes(args, reference_key_map: dict[str, str], manifest: Manifest):
+    tokenizer = None
+    if CHUNK_LONG_PAPERS:
+        from common.tokenizer import load_tokenizer
+
+        tokenizer = await asyncio.to_thread(load_tokenizer)
+
+    async with Client(response_cache(args)) as client:
+        context = NotesContext(RequestScheduler(), client, manifest, tokenizer=tokenizer)
+        skipped_oversized = await notes_pipeline(args, reference_key_map, context)
+
+    print_client_stats(client)
+    print_skipped_oversized(skipped_oversized)
+    report_failed_notes(context)
+
+
+def run_all(args):
+    if args.retry_failed:
+        stage_notes(args)
+        return
+
+    ################ Planning: all the questions are asked up front ##########
+    stage_flatten(args)
+
+    reference_key_map = stage_resolve(args)
+    if reference_key_map is None:
+        return
+
+    remove_redundant_notes(args, list(reference_key_map.values()))
+
+    if not (
+        args.all
+        or ask_user("Step 1: Now we will extract text from PDF files. Proceed?")
     ):
         return
 
-    asyncio.run(create_notes())
+    generate_notes = args.all or ask_user(
+        "Step 2: Then we will generate atomic notes out of extracted texts. Proceed?"
+    )
+
+    ################ Running: extraction overlaps with generation ##############
+    if generate_notes:
+        os.makedirs(NOTES_OUTPUT_FOLDER, exist_ok=True)
+        manifest = open_manifest()
+        asyncio.run(extract_and_create_notes(args, reference_key_map, manifest))
+        manifest.close()
+    else:
+        stage_extract(args, reference_key_map)
+
+
+def resolve_batch(resolver, placed_names: list[str], reported: set[str]) -> dict[str, str]:
+    """Reference keys of PDFs to process: newly resolved ones and already
+    resolved ones whose file changed. PDFs without a reference key are
+    reported once
+    """
+    pdf_files = filenames_in_folder(PDF_PAPERS_FOLDER, FileType.PDF)
+    with metrics.timer("resolve"):
+        new_mapping, unresolved = resolver.resolve(pdf_files)
+
+    not_reported = [pdf for pdf in unresolved if pdf not in reported]
+    if len(not_reported) > 0:
+        print("WARNING | Not found reference key for, they will be picked up once it is in the export:")
+        for pdf in not_reported:
+            print(f"- {pdf}")
+    reported.clear()
+    reported.update(unresolved)
+
+    batch = dict(new_mapping)
+    for name in placed_names:
+        pdf = Path(name).stem
+        if pdf in resolver.mapping:
+            batch[pdf] = resolver.mapping[pdf]
+    return batch
+
+
+async def watch(args):
+    """Processes new and changed PDFs as they appear in the raw folder
+
+    Tokenizer, extraction workers and HTTP client are started once and kept
+    warm. Every batch of changes goes through all the stages, but only PDFs
+    placed or resolved by it get extracted and sent for notes
+    """
+    from common.extraction import extraction_pool
+    from common.reference import ReferenceResolver
+    from common.watch import Watcher
+
+    for folder in [PDF_PAPERS_RAW_FOLDER, PDF_PAPERS_FOLDER, EXTRACTED_TEXT_FOLDER, NOTES_OUTPUT_FOLDER]:
+        os.makedirs(folder, exist_ok=True)
+
+    tokenizer = None
+    if CHUNK_LONG_PAPERS:
+        from common.tokenizer import load_tokenizer
+
+        print("Initializing tokenizer")
+        tokenizer = await asyncio.to_thread(load_tokenizer)
+
+    resolver = ReferenceResolver()
+    reported: set[str] = set()
+    watcher = Watcher([PDF_PAPERS_RAW_FOLDER], [JSON_REFERENCE_KEY_FILE])
+    manifest = open_manifest()
+    # Usage already in exported metrics
+    recorded = Usage()
+
+    async def process_changes(context: NotesContext, executor):
+        nonlocal recorded
+        with metrics.timer("flatten"):
+            placed_names = await asyncio.to_thread(
+                flatten_folder, PDF_PAPERS_RAW_FOLDER, PDF_PAPERS_FOLDER, LinkMode(args.link)
+            )
+        batch = resolve_batch(resolver, placed_names, reported)
+        if len(batch) == 0:
+            return
+        manifest.record_resolution(batch)
+        print(f"Processing {len(batch)} new or changed PDFs")
+        skipped_oversized = await notes_pipeline(args, batch, context, executor)
+        print_skipped_oversized(skipped_oversized)
+        report_failed_notes(context)
+        metrics.record_usage(context.client.usage.since(recorded))
+        recorded = replace(context.client.usage)
+        metrics.export()
+
+    client = Client(response_cache(args))
+    try:
+        with extraction_pool(args.jobs) as executor:
+            async with client:
+                context = NotesContext(RequestScheduler(), client, manifest, tokenizer=tokenizer)
+                # Everything added while not watching is caught up first
+                await process_changes(context, executor)
+                print(f"Watching {PDF_PAPERS_RAW_FOLDER} and {JSON_REFERENCE_KEY_FILE}, Ctrl+C to stop")
+                async for _ in watcher.changes():
+                    try:
+                        await process_changes(context, executor)
+                    except Exception as e:
+                        # A broken batch must not stop the watch
+                        print(f"ERROR | Failed to process changes: {e}")
+    finally:
+        print_client_stats(client, recorded)
+        manifest.close()
+
+
+def stage_watch(args):
+    try:
+        asyncio.run(watch(args))
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+def shared_arguments(defaults: bool = True) -> tuple[argparse.ArgumentParser, ...]:
+    """Flags of the app shared with its stages. Stages get them without
+    defaults, so they don't override flags given before the stage name
+    """
+
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+
+    common_arguments = argparse.ArgumentParser(add_help=False)
+    common_arguments.add_argument(
+        "--all",
+        action="store_true",
+        default=default(False),
+        help="Execute everything without asking. WARNING: some files may get deleted",
+    )
+    flatten_arguments = argparse.ArgumentParser(add_help=False)
+    flatten_arguments.add_argument(
+        "--link",
+        choices=[m.value for m in LinkMode],
+        default=default(FLATTEN_LINK_MODE),
+        help=f"How PDFs are placed into the flat folder, falls back to copying (default: {FLATTEN_LINK_MODE})",
+    )
+    extract_arguments = argparse.ArgumentParser(add_help=False)
+    extract_arguments.add_argument(
+        "--jobs",
+        type=int,
+        default=default(EXTRACTION_JOBS),
+        help="Number of processes used for PDF extraction (default: all cores)",
+    )
+
+    notes_arguments = argparse.ArgumentParser(add_help=False)
+    notes_arguments.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=default(False),
+        help="Neither read nor store model responses in the response cache",
+    )
+    notes_arguments.add_argument(
+        "--refresh",
+        action="store_true",
+        default=default(False),
+        help="Call the model even if response is cached, and cache the new response",
+    )
+
+    retry_arguments = argparse.ArgumentParser(add_help=False)
+    retry_arguments.add_argument(
+        "--retry-failed",
+        action="store_true",
+        default=default(False),
+        help="Only generate notes of papers that failed in earlier runs",
+    )
+    return common_arguments, flatten_arguments, extract_arguments, notes_arguments, retry_arguments
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="CLI App that creates atomic notes out of scientific pdf papers. Runs all the stages if no stage is given",
+        parents=list(shared_arguments()),
+    )
+    parser.set_defaults(func=run_all)
+    stages = parser.add_subparsers(title="stages")
+    common_arguments, flatten_arguments, extract_arguments, notes_arguments, retry_arguments = shared_arguments(
+        defaults=False
+    )
+
+    stages.add_parser(
+        "flatten", parents=[common_arguments, flatten_arguments], help="Link PDFs from raw folder into a flat one"
+    ).set_defaults(func=stage_flatten)
+    stages.add_parser(
+        "resolve", parents=[common_arguments], help="Match PDFs to Zotero reference keys"
+    ).set_defaults(func=stage_resolve)
+    stages.add_parser(
+        "extract", parents=[common_arguments, extract_arguments], help="Extract text and count tokens of PDFs"
+    ).set_defaults(func=stage_extract)
+    stages.add_parser(
+        "notes", parents=[common_arguments, notes_arguments, retry_arguments], help="Generate notes out of extracted texts"
+    ).set_defaults(func=stage_notes)
+    stages.add_parser(
+        "status", help="Show progress of all the stages"
+    ).set_defaults(func=stage_status)
+    dedup_parser = stages.add_parser(
+        "dedup", help="Find near-duplicate notes across papers and link or merge them"
+    )
+    dedup_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Forget all the signatures and compare notes of every paper again",
+    )
+    dedup_parser.set_defaults(func=stage_dedup)
+    search_parser = stages.add_parser("search", help="Find notes most similar to the query")
+    search_parser.add_argument("query", nargs="*", help="Words to search for")
+    search_parser.add_argument(
+        "-k", type=int, default=SEARCH_TOP_K, help=f"Number of notes to return (default: {SEARCH_TOP_K})"
+    )
+    search_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Index all the notes from scratch",
+    )
+    search_parser.set_defaults(func=stage_search)
+    stages.add_parser(
+        "links", help="Report broken links and notes no other note links to"
+    ).set_defaults(func=stage_links)
+    stages.add_parser(
+        "watch",
+        parents=[flatten_arguments, extract_arguments, notes_arguments],
+        help="Keep running and process PDFs as they are added to the raw folder",
+    ).set_defaults(func=stage_watch)
+
+    return parser
+
+
+def main():
+    ################ Parsing arguments #############################
+    args = build_parser().parse_args()
+    try:
+        args.func(args)
+    finally:
+        if not metrics.is_empty():
+            metrics.export()
+            if METRICS_REPORT_FILE:
+                print(f"Metrics saved to {METRICS_REPORT_FILE}")
 
 
 if __name__ == "__main__":
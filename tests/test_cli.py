@@ -0,0 +1,44 @@
+import pytest
+
+import the_thing
+from common.config import EXTRACTION_JOBS
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--all", "notes"],
+        ["notes", "--all"],
+    ],
+)
+def test_all_before_or_after_stage(argv):
+    args = the_thing.build_parser().parse_args(argv)
+    assert args.all
+    assert args.func is the_thing.stage_notes
+
+
+@pytest.mark.parametrize("argv", [["--jobs", "3", "extract"], ["extract", "--jobs", "3"]])
+def test_jobs_before_or_after_stage(argv):
+    assert the_thing.build_parser().parse_args(argv).jobs == 3
+
+
+@pytest.mark.parametrize("argv", [["--no-cache", "watch"], ["watch", "--no-cache"]])
+def test_no_cache_before_or_after_stage(argv):
+    assert the_thing.build_parser().parse_args(argv).no_cache
+
+
+def test_flags_after_stage_override_flags_before():
+    assert the_thing.build_parser().parse_args(["--jobs", "3", "extract", "--jobs", "5"]).jobs == 5
+
+
+def test_defaults_without_stage():
+    args = the_thing.build_parser().parse_args([])
+    assert args.func is the_thing.run_all
+    assert not args.all and not args.no_cache and not args.refresh and not args.retry_failed
+    assert args.jobs == EXTRACTION_JOBS
+
+
+def test_defaults_of_stage():
+    args = the_thing.build_parser().parse_args(["extract"])
+    assert not args.all
+    assert args.jobs == EXTRACTION_JOBS
@@ -0,0 +1,91 @@
+import pymupdf
+import pytest
+
+from common.compaction import PAGE_NUMBER, SECTION_HEADING
+from common.extraction import _compact_parts, _extract_page_range, _part_path
+
+HEADER = "Journal of Repeated Headers"
+PAGE_COUNT = 12
+REFERENCES_PAGE = 6
+NEXT_CHAPTER_PAGE = 9
+
+
+def page_lines(i: int) -> list[str]:
+    # Digits are normalized away when looking for repeated lines
+    body = [f"Body line {n} of page {'abcdefghijkl'[i]}" for n in "abcdefgh"]
+    if i == REFERENCES_PAGE:
+        lines = ["References", f"[{i}] Smith, A paper"]
+    elif REFERENCES_PAGE < i < NEXT_CHAPTER_PAGE:
+        lines = [f"[{i}] Doe, Another paper"]
+    elif i == NEXT_CHAPTER_PAGE:
+        lines = ["Chapter 3", *body]
+    else:
+        lines = body
+    return [HEADER, *lines, str(i + 1)]
+
+
+@pytest.fixture
+def pdf_path(tmp_path) -> str:
+    path = str(tmp_path / "paper.pdf")
+    with pymupdf.open() as doc:
+        for i in range(PAGE_COUNT):
+            page = doc.new_page()
+            for n, line in enumerate(page_lines(i)):
+                page.insert_text((72, 72 + 20 * n), line)
+        doc.save(path)
+    return path
+
+
+def compacted(pdf_path: str, text_path: str, pages_per_range: int) -> str:
+    ranges = [(start, min(start + pages_per_range, PAGE_COUNT)) for start in range(0, PAGE_COUNT, pages_per_range)]
+    part_paths = [_part_path(text_path, start) for start, _ in ranges]
+    parts = [
+        _extract_page_range(pdf_path, start, end, PAGE_COUNT, part_path)
+        for (start, end), part_path in zip(ranges, part_paths)
+    ]
+    result = _compact_parts(text_path, part_paths, parts)
+    with open(text_path, "r") as f:
+        text = f.read()
+    assert len(result.page_sizes) == PAGE_COUNT
+    assert sum(result.page_sizes) == len(text.encode())
+    return text
+
+
+@pytest.mark.parametrize("pages_per_range", [3, 4, PAGE_COUNT])
+def test_compaction_is_the_same_across_range_boundaries(pdf_path, tmp_path, pages_per_range):
+    text = compacted(pdf_path, str(tmp_path / "paper.txt"), pages_per_range)
+
+    assert text == compacted(pdf_path, str(tmp_path / "whole.txt"), PAGE_COUNT)
+    assert HEADER not in text
+    assert "Body line d of page f" in text
+    # References continue on pages of later ranges
+    assert "References" not in text and "Doe" not in text
+
+
+def test_text_after_references_of_a_chapter_is_kept(pdf_path, tmp_path):
+    text = compacted(pdf_path, str(tmp_path / "paper.txt"), 4)
+
+    assert "Chapter 3" in text
+    for page in "jkl":
+        assert f"Body line a of page {page}" in text
+    assert not any(line.strip().isdigit() for line in text.splitlines())
+
+
+@pytest.mark.parametrize("line", ["12", "iv", "XIV", "page 3 of 10", "cxcix"])
+def test_page_numbers(line):
+    assert PAGE_NUMBER.match(line)
+
+
+@pytest.mark.parametrize("line", ["civil", "ill", "vivid", "lic", "iiii", ""])
+def test_words_of_roman_letters_are_not_page_numbers(line):
+    assert not PAGE_NUMBER.match(line)
+
+
+@pytest.mark.parametrize("line", ["Chapter 3", "CHAPTER IV", "4 Results", "4.2 Experimental setup", "Appendix A"])
+def test_section_headings(line):
+    assert SECTION_HEADING.match(line)
+
+
+@pytest.mark.parametrize("line", ["[7] Doe, Another paper", "1. Smith J, Doe A. A paper. Nature 2020", "2020"])
+def test_references_are_not_section_headings(line):
+    assert not SECTION_HEADING.match(line)
@@ -0,0 +1,63 @@
+import os
+import random
+
+from common.config import DEDUP_THRESHOLD
+from common.dedup import SIMILAR_HEADING, MinHasher, deduplicate, similarity
+from common.manifest import Manifest
+
+WORDS = [f"word{i}" for i in range(500)]
+
+
+def text(seed: int, length: int = 200) -> str:
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def near_duplicate(original: str) -> str:
+    words = original.split()
+    words[len(words) // 2] = "changed"
+    return " ".join(words)
+
+
+def test_near_duplicates_share_a_bucket():
+    hasher = MinHasher()
+    original = hasher.signature(text(1))
+    duplicate = hasher.signature(near_duplicate(text(1)))
+    unrelated = hasher.signature(text(2))
+
+    assert similarity(original, duplicate) >= DEDUP_THRESHOLD
+    assert similarity(original, unrelated) < 0.1
+    assert set(hasher.buckets(original)) & set(hasher.buckets(duplicate))
+    assert not set(hasher.buckets(original)) & set(hasher.buckets(unrelated))
+
+
+def test_note_without_words_has_no_signature():
+    assert MinHasher().signature(" -- ") is None
+
+
+def add_note(manifest: Manifest, folder: str, reference_key: str, title: str, body: str) -> str:
+    file_name = manifest.add_note(reference_key, title, title, [])
+    os.makedirs(os.path.join(folder, reference_key), exist_ok=True)
+    with open(os.path.join(folder, reference_key, file_name + ".md"), "w") as f:
+        f.write(f"# {title}\n\n{body}\n\n## References\n\n- [[{reference_key}]]")
+    return file_name
+
+
+def test_duplicates_across_papers_are_linked(tmp_path):
+    folder = str(tmp_path / "notes")
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    hasher = MinHasher()
+    add_note(manifest, folder, "smith2020", "Original", text(1))
+    add_note(manifest, folder, "smith2020", "Unrelated", text(2))
+    assert deduplicate(manifest, "smith2020", hasher, folder) == []
+
+    add_note(manifest, folder, "doe2021", "Copy", near_duplicate(text(1)))
+    add_note(manifest, folder, "doe2021", "Other", text(3))
+    duplicates = deduplicate(manifest, "doe2021", hasher, folder)
+
+    assert [(file_name, key, other) for file_name, key, other, _ in duplicates] == [("Copy", "smith2020", "Original")]
+    assert duplicates[0][3] >= DEDUP_THRESHOLD
+    with open(os.path.join(folder, "doe2021", "Copy.md")) as f:
+        assert f"{SIMILAR_HEADING}\n\n- [[Original]]" in f.read()
+    with open(os.path.join(folder, "smith2020", "Original.md")) as f:
+        assert f"{SIMILAR_HEADING}\n\n- [[Copy]]" in f.read()
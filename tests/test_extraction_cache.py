@@ -0,0 +1,38 @@
+from common import extraction_cache, tokenizer
+from common.extraction_cache import ExtractionCache, extraction_settings
+
+
+def put(cache: ExtractionCache, tmp_path, reference_key: str, pdf_hash: str, **kwargs):
+    text_path = tmp_path / f"{reference_key}.txt"
+    text_path.write_text("text")
+    cache.put(reference_key, pdf_hash, str(text_path), 100, **kwargs)
+
+
+def test_estimated_counts_are_flagged(tmp_path):
+    cache = ExtractionCache(str(tmp_path / "cache"))
+    put(cache, tmp_path, "smith2020", "a" * 64)
+    put(cache, tmp_path, "doe2021", "b" * 64, estimated=True)
+    assert not cache.is_estimated("a" * 64)
+    assert cache.is_estimated("b" * 64)
+    assert cache.token_count("b" * 64) == 100
+
+
+def test_entries_of_other_settings_are_stale(tmp_path):
+    settings = {"compact_text": True, "tokenizer_model": "model", "tokenizer_revision": "a" * 40}
+    cache = ExtractionCache(str(tmp_path / "cache"), settings)
+    put(cache, tmp_path, "smith2020", "a" * 64)
+    assert cache.has("a" * 64) and not cache.is_stale("a" * 64)
+
+    for changed in ({"compact_text": False}, {"tokenizer_revision": "b" * 40}):
+        other = ExtractionCache(str(tmp_path / "cache"), settings | changed)
+        assert not other.has("a" * 64)
+        assert other.is_stale("a" * 64)
+        assert not other.is_stale("b" * 64)
+
+
+def test_settings_hold_the_commit_of_the_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(tokenizer, "TOKENIZER_FOLDER", str(tmp_path))
+    monkeypatch.setattr(extraction_cache, "TOKENIZER_REVISION", "main")
+    assert extraction_settings()["tokenizer_revision"] == "main"
+    (tmp_path / tokenizer.REVISION_FILE_NAME).write_text("main\n" + "c" * 40 + "\n")
+    assert extraction_settings()["tokenizer_revision"] == "c" * 40
@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from common.model import Client, IncompleteStreamError, Message, Model, Request, ResponseCache, Role, stream
+from common.scheduler import is_transient
+
+
+def sse_client(lines: list[str], cache: ResponseCache | None = None) -> Client:
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content="".join(line + "\n\n" for line in lines).encode())
+
+    client = Client(cache)
+    client._client = httpx.AsyncClient(base_url="http://openrouter", transport=httpx.MockTransport(handler))
+    return client
+
+
+def chunk(content: str) -> str:
+    return "data: " + json.dumps({"choices": [{"delta": {"content": content}}]})
+
+
+def request() -> Request:
+    return Request(Model.GeminiFlash, [Message(Role.USER, "paper")])
+
+
+async def collect(client: Client) -> list[str]:
+    chunks = []
+    try:
+        async for c in stream(request(), client):
+            chunks.append(c)
+    finally:
+        await client.http.aclose()
+    return chunks
+
+
+def test_complete_stream(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    client = sse_client([chunk("# Idea"), ": keep-alive", chunk("\n\nbody"), "data: [DONE]"], cache)
+
+    assert asyncio.run(collect(client)) == ["# Idea", "\n\nbody"]
+    assert cache.get(request())["content"] == "# Idea\n\nbody"
+
+
+def test_stream_ending_without_done_is_transient_error(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    client = sse_client([chunk("# Idea"), chunk("\n\nbo")], cache)
+
+    with pytest.raises(IncompleteStreamError) as error:
+        asyncio.run(collect(client))
+    assert is_transient(error.value)
+    assert cache.get(request()) is None
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import sqlite3
+
+import the_thing
+from common.config import EXTRACTED_TEXT_FOLDER, NOTES_MAX_ATTEMPTS, NOTES_OUTPUT_FOLDER
+from common.manifest import Manifest, Status
+from common.model import IncompleteStreamError, Model, Role
+from common.notes import PARTIAL_STREAM_FILE
+from common.scheduler import RequestScheduler
+
+NOTE = "# Idea\n\n> gist\n\n## Body\n\nbody\n---\n"
+
+
+class FakeRouter:
+    """Streams given answers, one per request. An answer given together with
+    an error is cut off by it
+    """
+
+    def __init__(self, answers: list[str | tuple[str, Exception]]):
+        self.answers = answers
+        self.requests = []
+
+    @property
+    def calls(self) -> int:
+        return len(self.requests)
+
+    async def stream(self, build, token_count, client, scheduler=None):
+        answer, error = self.answers[self.calls], None
+        if isinstance(answer, tuple):
+            answer, error = answer
+        self.requests.append(build(Model.GeminiFlash))
+        for i in range(0, len(answer), 5):
+            yield answer[i: i + 5]
+        if error is not None:
+            raise error
+
+
+def notes_context(tmp_path, monkeypatch, answers: list[str]) -> the_thing.NotesContext:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(the_thing, "retry_pause", lambda attempt: 0)
+    monkeypatch.setattr(the_thing, "DEDUP_NOTES", False)
+    monkeypatch.setattr(the_thing, "SEARCH_INDEX", False)
+    os.makedirs(EXTRACTED_TEXT_FOLDER)
+    with open(os.path.join(EXTRACTED_TEXT_FOLDER, "smith2020.txt"), "w") as f:
+        f.write("paper text")
+    manifest = Manifest(str(tmp_path / "manifest.sqlite3"))
+    manifest.record_extraction("smith2020", "hash", 100)
+    return the_thing.NotesContext(
+        scheduler=RequestScheduler(), client=None, manifest=manifest, router=FakeRouter(answers)
+    )
+
+
+def test_answer_without_notes_is_retried(tmp_path, monkeypatch):
+    context = notes_context(tmp_path, monkeypatch, ["no notes in here", NOTE])
+
+    asyncio.run(the_thing.notes_for_paper(1, "smith2020", 1, context))
+
+    assert context.router.calls == 2
+    assert context.manifest.notes_status("smith2020") == Status.DONE
+    assert context.manifest.note_count("smith2020") == 1
+    assert os.path.isfile(os.path.join(NOTES_OUTPUT_FOLDER, "smith2020", "Idea.md"))
+
+
+def test_paper_never_getting_notes_is_not_done(tmp_path, monkeypatch):
+    context = notes_context(tmp_path, monkeypatch, [""] * NOTES_MAX_ATTEMPTS)
+
+    asyncio.run(the_thing.notes_for_paper(1, "smith2020", 1, context))
+
+    assert context.router.calls == NOTES_MAX_ATTEMPTS
+    assert context.manifest.notes_status("smith2020") == Status.FAILED
+    assert context.failed == ["smith2020"]
+    assert not the_thing.has_notes("smith2020", context.manifest)
+    assert [k for k, _, _ in context.manifest.failed_notes()] == ["smith2020"]
+
+
+def test_incomplete_stream_resumes_from_partial_output(tmp_path, monkeypatch):
+    second = NOTE.replace("Idea", "Other idea")
+    cut = len(second) // 2
+    context = notes_context(
+        tmp_path, monkeypatch, [(NOTE + second[:cut], IncompleteStreamError("no [DONE]")), second[cut:]]
+    )
+
+    asyncio.run(the_thing.notes_for_paper(1, "smith2020", 1, context))
+
+    resumed = context.router.requests[1].messages[-1]
+    assert resumed.role == Role.ASSISTANT and resumed.content == NOTE + second[:cut]
+    assert context.manifest.notes_status("smith2020") == Status.DONE
+    assert sorted(context.manifest.note_files("smith2020")) == ["Idea", "Other idea"]
+    assert not os.path.exists(os.path.join(NOTES_OUTPUT_FOLDER, "smith2020", PARTIAL_STREAM_FILE))
+
+
+def test_failures_after_notes_are_written_dont_fail_the_paper(tmp_path, monkeypatch, capsys):
+    context = notes_context(tmp_path, monkeypatch, [NOTE])
+    monkeypatch.setattr(the_thing, "DEDUP_NOTES", True)
+    monkeypatch.setattr(the_thing, "SEARCH_INDEX", True)
+
+    def fail(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(the_thing, "deduplicate", fail)
+    monkeypatch.setattr(the_thing.SearchIndex, "update", fail)
+
+    asyncio.run(the_thing.notes_for_paper(1, "smith2020", 1, context))
+
+    assert context.manifest.notes_status("smith2020") == Status.DONE
+    assert context.failed == []
+    output = capsys.readouterr().out
+    assert "Failed to deduplicate notes of smith2020" in output
+    assert "Failed to index notes of smith2020" in output
+
+
+def test_notes_of_a_failed_pack_are_removed(tmp_path, monkeypatch):
+    packed = "=== NOTES 1 ===\n" + NOTE.replace("Idea", "Packed idea")
+    other = NOTE.replace("Idea", "Other idea")
+    context = notes_context(tmp_path, monkeypatch, [(packed, IncompleteStreamError("no [DONE]")), NOTE, other])
+    with open(os.path.join(EXTRACTED_TEXT_FOLDER, "doe2021.txt"), "w") as f:
+        f.write("other paper text")
+    context.manifest.record_extraction("doe2021", "other hash", 100)
+
+    asyncio.run(the_thing.notes_for_pack(1, ["smith2020", "doe2021"], 1, context))
+
+    assert context.router.calls == 3
+    for reference_key, title in [("smith2020", "Idea"), ("doe2021", "Other idea")]:
+        assert context.manifest.notes_status(reference_key) == Status.DONE
+        assert context.manifest.note_files(reference_key) == [title]
+        assert os.listdir(os.path.join(NOTES_OUTPUT_FOLDER, reference_key)) == [title + ".md"]
@@ -0,0 +1,29 @@
+from mock_openrouter import PACKED_PAPER, MockServer, MockSettings
+
+from common.notes import PackParser
+from common.prompts import packed_paper_contents
+
+PAPERS = ["First paper\nwith two lines", "Second paper", "Third paper"]
+
+
+def test_every_paper_header_starts_a_line():
+    contents = packed_paper_contents(PAPERS)
+    assert [int(n) for n in PACKED_PAPER.findall(contents)] == [1, 2, 3]
+    assert [p.strip() for p in PACKED_PAPER.split(contents)[2::2]] == PAPERS
+
+
+def test_packed_round_trip():
+    server = MockServer(MockSettings(notes_per_response=2, words_per_note=5, seed=1))
+    papers = server._packed_papers({"messages": [{"content": packed_paper_contents(PAPERS)}]})
+    assert papers == len(PAPERS)
+
+    answer = server._notes(papers)
+    parser = PackParser(papers)
+    notes = []
+    for i in range(0, len(answer), 7):
+        notes += parser.feed(answer[i: i + 7])
+    notes += parser.close()
+
+    # Text around separators that isn't a note is dropped by `write_note`
+    notes = [(index, note) for index, note in notes if note.startswith("# ")]
+    assert [index for index, _ in notes] == [0, 0, 1, 1, 2, 2]
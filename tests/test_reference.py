@@ -0,0 +1,25 @@
+from common.reference import FuzzyIndex, reference_key_map_generator
+
+PDFS = ["Smith - 2020 - Tokenomics of games", "Doe and Lee - 2019 - NFT market design", "Roe et al. - 2021 - Staking"]
+
+
+def item(key: str, family: str, year: int, title: str) -> dict:
+    return {"id": key, "author": [{"family": family}], "issued": {"date-parts": [[year]]}, "title": title}
+
+
+def test_items_are_matched_to_pdfs():
+    items = [item("smith2020", "Smith", 2020, "Tokenomics of games"), item("nobody2000", "Nobody", 2000, "Nothing")]
+    assert reference_key_map_generator(items, PDFS) == {PDFS[0]: "smith2020"}
+
+
+def test_pdf_is_claimed_by_the_best_item_only():
+    items = [item("smith2019", "Smith", 2019, "Tokenomics of games"), item("smith2020", "Smith", 2020, "Tokenomics of games")]
+    assert reference_key_map_generator(items, PDFS) == {PDFS[0]: "smith2020"}
+
+
+def test_only_values_sharing_tokens_are_scored():
+    index = FuzzyIndex(PDFS, shortlist_size=2)
+    assert index.shortlist("Roe 2021 Staking") == [2]
+    assert index.shortlist("Unrelated title") == []
+    scores = index.scores("Smith - 2020 - Tokenomics of games")
+    assert max(scores) == (100, 0)
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from common import routing
+from common.model import Message, Model, Request, Role
+from common.routing import Router
+from common.scheduler import RequestScheduler
+
+SLOW, FAST = Model.GeminiFlash, Model.OpenAI_4o
+
+# Seconds to the first chunk of every model
+FIRST_CHUNK = {SLOW: 0.5, FAST: 0.1}
+
+CLIENT = SimpleNamespace(cache=None)
+
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch):
+    async def stream(request: Request, client):
+        await asyncio.sleep(FIRST_CHUNK[request.model])
+        yield request.model.value
+
+    monkeypatch.setattr(routing, "STREAM_RESPONSES", True)
+    monkeypatch.setattr(routing, "stream", stream)
+    monkeypatch.setattr(routing, "HEDGE_INITIAL_DEADLINE", 0.05)
+
+
+def build(model: Model) -> Request:
+    return Request(model, [Message(Role.USER, "paper")])
+
+
+def generate(concurrency: int) -> tuple[str, Router, RequestScheduler, int]:
+    router = Router([SLOW.value, FAST.value], hedge=True)
+    scheduler = RequestScheduler(concurrency, 1, concurrency, requests_per_minute=None, tokens_per_minute=None)
+    most_in_flight = 0
+
+    async def run() -> str:
+        nonlocal most_in_flight
+
+        async def watch():
+            nonlocal most_in_flight
+            while True:
+                most_in_flight = max(most_in_flight, scheduler.in_flight)
+                await asyncio.sleep(0.01)
+
+        watcher = asyncio.create_task(watch())
+        try:
+            return await scheduler.run(100, lambda: router.generate(build, 100, CLIENT, scheduler))
+        finally:
+            watcher.cancel()
+
+    return asyncio.run(run()), router, scheduler, most_in_flight
+
+
+def test_hedge_takes_a_slot_of_its_own():
+    output, router, scheduler, most_in_flight = generate(concurrency=2)
+
+    assert output == FAST.value
+    assert most_in_flight == 2
+    assert scheduler.in_flight == 0
+    # Both requests count against the tokens per minute
+    assert scheduler.window_tokens == 200
+    # Time to first output of the hedge is measured from its own start
+    assert router.latencies[FAST][0] == pytest.approx(FIRST_CHUNK[FAST], abs=0.04)
+    # The cancelled request counts with the time it waited, a lower bound
+    assert routing.HEDGE_INITIAL_DEADLINE < router.latencies[SLOW][0] < FIRST_CHUNK[SLOW]
+
+
+def test_hedge_waits_for_a_free_slot():
+    output, _, scheduler, most_in_flight = generate(concurrency=1)
+
+    assert output == SLOW.value
+    assert most_in_flight == 1
+    assert scheduler.in_flight == 0
+
+
+def test_cached_answers_leave_the_deadline_alone(monkeypatch):
+    monkeypatch.setattr(routing, "HEDGE_MIN_SAMPLES", 2)
+    router = Router([FAST.value, SLOW.value], hedge=True)
+    client = SimpleNamespace(cache=SimpleNamespace(has=lambda request: True))
+
+    async def cached_stream(request: Request, client):
+        yield request.model.value
+
+    monkeypatch.setattr(routing, "stream", cached_stream)
+    for _ in range(10):
+        assert asyncio.run(router.generate(build, 100, client)) == FAST.value
+    assert len(router.latencies[FAST]) == 0
+    assert router.deadline(FAST) == routing.HEDGE_INITIAL_DEADLINE
@@ -0,0 +1,36 @@
+import asyncio
+
+import httpx
+
+from common.scheduler import RequestScheduler
+
+
+def too_many_requests() -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://openrouter/chat/completions")
+    response = httpx.Response(429, headers={"Retry-After": "0"}, request=request)
+    return httpx.HTTPStatusError("Too many requests", request=request, response=response)
+
+
+def test_burst_of_429_halves_limit_once():
+    scheduler = RequestScheduler(
+        initial_concurrency=8, min_concurrency=1, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None
+    )
+    started = asyncio.Event()
+    attempts: dict[int, int] = {}
+
+    async def request(i: int) -> int:
+        attempts[i] = attempts.get(i, 0) + 1
+        if attempts[i] == 1:
+            # All the first attempts are in flight when the first 429 comes
+            if len(attempts) == 8:
+                started.set()
+            await started.wait()
+            raise too_many_requests()
+        return i
+
+    async def run() -> list[int]:
+        return await asyncio.gather(*[scheduler.run(1, lambda i=i: request(i)) for i in range(8)])
+
+    assert asyncio.run(run()) == list(range(8))
+    assert scheduler.generation == 1
+    assert 4 <= scheduler.limit < 8
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+from common.manifest import Manifest
+from common.search import SearchIndex
+
+NOTES = {
+    "smith2020": {
+        "Proof of work": "Mining secures the chain, miners spend energy to find blocks",
+        "Energy use": "Mining energy use grows with the hash rate of miners",
+    },
+    "doe2021": {
+        "Token incentives": "Tokens reward players of the game for staking",
+        "Staking": "Staking locks tokens to secure the chain instead of mining",
+    },
+}
+
+
+def write_notes(manifest: Manifest, folder: str, reference_key: str, notes: dict[str, str]):
+    manifest.forget_notes(reference_key)
+    os.makedirs(os.path.join(folder, reference_key), exist_ok=True)
+    for title, body in notes.items():
+        file_name = manifest.add_note(reference_key, title, title, [])
+        with open(os.path.join(folder, reference_key, file_name + ".md"), "w") as f:
+            f.write(f"# {title}\n\n{body}\n\n## References\n\n- [[{reference_key}]]")
+
+
+@pytest.fixture
+def index(tmp_path) -> SearchIndex:
+    folder = str(tmp_path / "notes")
+    index = SearchIndex(Manifest(str(tmp_path / "manifest.sqlite3")), str(tmp_path / "index"), folder)
+    for reference_key, notes in NOTES.items():
+        write_notes(index.manifest, folder, reference_key, notes)
+        index.update(reference_key, compact=False)
+    return index
+
+
+def ranked(index: SearchIndex, query: str, k: int = 4) -> list[str]:
+    return [file_name for _, _, file_name in index.search(query, k)]
+
+
+def test_ranking(index):
+    assert ranked(index, "mining energy", 2) == ["Energy use", "Proof of work"]
+    assert ranked(index, "staking tokens")[0] == "Staking"
+    assert ranked(index, "reward players", 1) == ["Token incentives"]
+    assert ranked(index, "unknown words") == []
+
+
+def test_compaction_keeps_ranking(index):
+    before = index.search("chain mining tokens")
+    index.compact()
+    after = index.search("chain mining tokens")
+    assert [n for _, _, n in after] == [n for _, _, n in before]
+    assert np.allclose([s for s, _, _ in after], [s for s, _, _ in before])
+
+
+@pytest.mark.parametrize("compact_first", [False, True])
+def test_reindexed_paper_stops_counting_its_old_notes(index, compact_first):
+    if compact_first:
+        index.compact()
+    write_notes(index.manifest, index.notes_folder, "smith2020", {"Consensus": "Validators vote on blocks"})
+    index.update("smith2020", compact=False)
+
+    assert ranked(index, "mining energy") == ["Staking"]
+    assert ranked(index, "validators") == ["Consensus"]
+    df = np.array(index._document_frequencies())
+    index.compact()
+    assert np.array_equal(df, index._document_frequencies())
@@ -0,0 +1,49 @@
+import os
+from types import SimpleNamespace
+
+import huggingface_hub
+
+from common import extraction, tokenizer
+from common.tokenizer import TokenEstimator, snapshot_revision, tokenizer_snapshot
+
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+
+def test_branch_is_pinned_to_its_commit(tmp_path, monkeypatch):
+    downloads = []
+    monkeypatch.setattr(tokenizer, "TOKENIZER_FOLDER", str(tmp_path))
+    monkeypatch.setattr(tokenizer, "TOKENIZER_REVISION", "main")
+    monkeypatch.setattr(
+        huggingface_hub, "HfApi", lambda: SimpleNamespace(model_info=lambda repo, revision: SimpleNamespace(sha=COMMIT))
+    )
+    monkeypatch.setattr(huggingface_hub, "snapshot_download", lambda repo, revision, **_: downloads.append(revision))
+
+    assert tokenizer_snapshot() == str(tmp_path)
+    assert tokenizer_snapshot() == str(tmp_path)
+    assert downloads == [COMMIT]
+    assert snapshot_revision() == ("main", COMMIT)
+
+
+def test_snapshot_without_commit(tmp_path, monkeypatch):
+    monkeypatch.setattr(tokenizer, "TOKENIZER_FOLDER", str(tmp_path))
+    with open(os.path.join(tmp_path, tokenizer.REVISION_FILE_NAME), "w") as f:
+        f.write("main")
+    assert snapshot_revision() == ("main", "main")
+
+
+def test_estimates_near_thresholds(tmp_path):
+    estimator = TokenEstimator([1000], str(tmp_path / "calibration.json"))
+    for _ in range(30):
+        estimator.record(4000, 1000)
+    assert estimator.is_near(950)
+    assert not estimator.is_near(800)
+    assert estimator.needs_exact(4000)
+    assert not estimator.needs_exact(2000)
+
+
+def test_pool_workers_never_download(monkeypatch):
+    calls = []
+    monkeypatch.setattr(extraction, "tokenizer_snapshot", lambda: calls.append("parent"))
+    monkeypatch.setattr(extraction, "ProcessPoolExecutor", lambda max_workers, initializer: calls.append("pool"))
+    extraction.extraction_pool(2)
+    assert calls == ["parent", "pool"]
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import time
+
+from common.watch import Watcher
+
+
+def touch(path: str):
+    with open(path, "w") as f:
+        f.write("pdf")
+
+
+def test_changes_while_a_batch_is_processed(tmp_path):
+    folder = str(tmp_path)
+
+    async def run() -> tuple[list[set[str]], float]:
+        batches = []
+        changes = Watcher([folder], [], debounce=0.05).changes()
+        first = asyncio.ensure_future(anext(changes))
+        await asyncio.sleep(0.05)
+        touch(os.path.join(folder, "a.pdf"))
+        batches.append(await first)
+
+        # Processing the batch, events queued meanwhile must not keep the loop busy
+        touch(os.path.join(folder, "b.pdf"))
+        start = time.process_time()
+        await asyncio.sleep(0.5)
+        busy = time.process_time() - start
+
+        batches.append(await anext(changes))
+        await changes.aclose()
+        return batches, busy
+
+    batches, busy = asyncio.run(run())
+    assert batches == [{os.path.join(folder, "a.pdf")}, {os.path.join(folder, "b.pdf")}]
+    assert busy < 0.1